@@ -0,0 +1,7 @@
+"""
+Benchmarks for Minerva.
+
+Run from the repository root, e.g. `python -m bench.run --rows 1000 100000`.
+See `bench.generate` for synthetic libraries and `bench.stub` for a local stand-in
+for the Open Library API.
+"""
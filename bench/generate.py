@@ -0,0 +1,102 @@
+"""
+Generates synthetic libraries for benchmarking.
+"""
+import argparse
+import os
+import random
+import sys
+
+WORDS = ('river', 'shadow', 'garden', 'winter', 'empire', 'silent', 'glass', 'storm',
+         'orchard', 'harbor', 'lantern', 'crown', 'forest', 'ember', 'mirror',
+         'island', 'thunder', 'velvet', 'compass', 'falcon', 'meadow', 'cipher',
+         'ashes', 'tide', 'summer', 'kingdom', 'echo', 'atlas', 'raven', 'hollow',
+         'night', 'stone', 'letters', 'journey', 'machine', 'ocean', 'history',
+         'wolves', 'bridge', 'candle')
+FIRST_NAMES = ('Anna', 'Ben', 'Clara', 'David', 'Elena', 'Felix', 'Greta', 'Hugo',
+               'Ines', 'Jonas', 'Karin', 'Lukas', 'Marta', 'Nils', 'Olga', 'Paul',
+               'Renée', 'Søren', 'Tomás', 'Ursula', 'Václav', 'Wiebke', 'Yusuf', 'Zoë')
+LAST_NAMES = ('Adler', 'Brandt', 'Castillo', 'Dvořák', 'Eriksen', 'Fischer', 'García',
+              'Hoffmann', 'Ibáñez', 'Jansen', 'Kowalski', 'Lindqvist', 'Müller',
+              'Nowak', 'Okafor', 'Petrov', 'Quinn', 'Rossi', 'Schäfer', 'Tanaka',
+              'Ulrich', 'Varga', 'Weber', 'Yilmaz', 'Zimmermann')
+LOCATIONS = (None, 'Living room', 'Study', 'Bedroom', 'Attic', 'Office', 'Lent out')
+
+
+def isbn13(number):
+    """Turn a number into a valid ISBN-13 with the 978 prefix."""
+    digits = '978{:09d}'.format(number % 10 ** 9)
+    total = sum(int(d) * (3 if i % 2 else 1) for i, d in enumerate(digits))
+    return digits + str((10 - total % 10) % 10)
+
+
+def books(count, seed=0):
+    """Generate random books as rows for `model.insert_books`.
+    The same `count` and `seed` always yield the same books; ISBNs are unique."""
+    rng = random.Random(seed)
+    step = rng.randrange(1, 10 ** 6) * 10 + 1    # coprime to 10 ** 9
+    for i in range(count):
+        title = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 4)))
+        yield {'isbn': isbn13(i * step),
+               'title': 'The ' + title.title() if rng.random() < 0.3 else title.title(),
+               'author': '{} {}'.format(rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)),
+               'own': rng.random() < 0.8, 'want': rng.random() < 0.1,
+               'read': rng.random() < 0.5, 'location': rng.choice(LOCATIONS)}
+
+
+def generate(path, count, seed=0, fts=True):
+    """Create a library database with `count` random books.
+    An existing file at `path` is replaced.
+    :param bool fts: Keep the full-text index, as a library searched with
+    `search.FullTextSearch` has; without it the library is like one created by an
+    SQLite without FTS5 support.
+    :return: The path."""
+    import model
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    engine = model.get_engine(path)
+    with engine.begin() as conn:
+        if not fts:
+            for trigger in ('book_fts_insert', 'book_fts_delete', 'book_fts_update'):
+                conn.execute('DROP TRIGGER IF EXISTS ' + trigger)
+            conn.execute('DROP TABLE IF EXISTS ' + model.FTS_TABLE)
+        model.insert_books(conn, books(count, seed), existing=set())
+    engine.dispose()
+    return path
+
+
+def dump(path, count, seed=0):
+    """Write the books of `books(count, seed)` as a gzipped Open Library dump with
+    author and edition records, see `catalog.import_dump`.
+    :return: The path."""
+    import gzip
+    import json
+    authors = {}
+    with gzip.open(path, 'wt', encoding='utf-8') as f:
+        for i, book in enumerate(books(count, seed)):
+            key = authors.get(book['author'])
+            if key is None:
+                key = authors[book['author']] = '/authors/OL{}A'.format(len(authors) + 1)
+                f.write('/type/author\t{}\t1\t2020-01-01T00:00:00\t{}\n'.format(
+                    key, json.dumps({'key': key, 'name': book['author']})))
+            edition = {'key': '/books/OL{}M'.format(i + 1), 'title': book['title'],
+                       'isbn_13': [book['isbn']], 'authors': [{'key': key}],
+                       'covers': [i + 1]}
+            f.write('/type/edition\t{}\t1\t2020-01-01T00:00:00\t{}\n'.format(
+                edition['key'], json.dumps(edition)))
+    return path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=generate.__doc__.splitlines()[0])
+    parser.add_argument('path', help='The database to create.')
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-fts', dest='fts', action='store_false',
+                        help='Drop the full-text index.')
+    args = parser.parse_args(argv)
+    generate(args.path, args.rows, args.seed, args.fts)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
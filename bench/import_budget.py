@@ -0,0 +1,64 @@
+"""
+Checks that importing the headless API stays cheap.
+
+Run from the repository root: `python bench/import_budget.py`. Exits with status 1
+if a module takes longer than its budget to import, or if `import core` pulls in
+one of the heavy dependencies that should only be loaded on first use.
+"""
+import os
+import re
+import subprocess
+import sys
+
+ROOT    = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BUDGETS = {             # module -> cumulative import time in milliseconds
+    'core': 20,
+    'cli':  100,
+}
+HEAVY   = ('sqlalchemy', 'requests', 'isbnlib', 'gi', 'model', 'provider')
+RUNS    = 5             # the fastest run counts, to ignore a cold disk cache
+
+IMPORTTIME = re.compile(r'import time:\s+\d+ \|\s+(\d+) \|\s+(\S+)')
+
+
+def import_time(module):
+    """Import a module in a fresh interpreter.
+    :return: The cumulative import time in milliseconds."""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                             'import ' + module],
+                            cwd=ROOT, stderr=subprocess.PIPE, universal_newlines=True,
+                            check=True)
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME.match(line)
+        if match and match.group(2) == module:
+            return int(match.group(1)) / 1000
+    raise RuntimeError('{} was not imported'.format(module))
+
+
+def loaded_modules(module):
+    """Return the heavy modules that are loaded after importing `module`."""
+    code = ('import sys, {}; print(" ".join(m for m in {!r} if m in sys.modules))'
+            .format(module, HEAVY))
+    result = subprocess.run([sys.executable, '-c', code], cwd=ROOT,
+                            stdout=subprocess.PIPE, universal_newlines=True, check=True)
+    return result.stdout.split()
+
+
+def main():
+    failed = False
+    for module, budget in sorted(BUDGETS.items()):
+        elapsed = min(import_time(module) for _ in range(RUNS))
+        status  = 'ok' if elapsed <= budget else 'FAILED'
+        failed  = failed or elapsed > budget
+        print('import {:<8} {:7.1f} ms  (budget {} ms)  {}'.format(
+            module, elapsed, budget, status))
+
+    heavy = loaded_modules('core')
+    if heavy:
+        failed = True
+        print('import core loads {}'.format(', '.join(heavy)))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,165 @@
+"""
+Runs the benchmark scenarios and writes the results as JSON.
+
+    python -m bench.run --rows 1000 100000 --output results.json
+    python -m bench.run --compare baseline.json
+
+Libraries are generated once per size and seed and kept in `--data`, the Open
+Library stand-in is started on a free port.
+"""
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import statistics
+import subprocess
+import sys
+import time
+from bench import generate, scenarios
+from bench.stub import OpenLibraryStub
+
+ROOT        = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA_DIR    = os.path.join(ROOT, 'bench', 'data')
+THRESHOLD   = 1.2   # slowdown of the median reported as a regression
+
+
+def _commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, check=True,
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                              universal_newlines=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def library(rows, seed, directory):
+    """Return the path of a generated library, creating it if necessary."""
+    path = os.path.join(directory, 'library-{}-{}.sqlite'.format(rows, seed))
+    if not os.path.exists(path):
+        os.makedirs(directory, exist_ok=True)
+        print('Generating {} books...'.format(rows), file=sys.stderr)
+        generate.generate(path + '.part', rows, seed)
+        os.replace(path + '.part', path)
+    return path
+
+
+def summarize(name, rows, durations):
+    return {'scenario': name, 'rows': rows, 'runs': durations,
+            'min': min(durations), 'median': statistics.median(durations),
+            'mean': statistics.mean(durations)}
+
+
+def run(args):
+    import provider
+    selected = [n for n in scenarios.SCENARIOS
+                if not args.scenarios or any(n.startswith(s) for s in args.scenarios)]
+    gui      = scenarios.gui_available()
+    results  = []
+    skipped  = []
+    with OpenLibraryStub(latency=args.latency) as stub:
+        # The stand-in is local, do not slow the benchmark down to Open Library's pace
+        provider.RATE_LIMITS[stub.url] = (args.rate_limit, args.rate_limit)
+        for i, rows in enumerate(args.rows):
+            path = library(rows, args.seed, args.data)
+            for name in selected:
+                function, needs_gui, sized = scenarios.SCENARIOS[name]
+                if not sized and i > 0:
+                    continue
+                if needs_gui and not gui:
+                    skipped.append(name)
+                    continue
+                # Edits of earlier scenarios must not leak into the next run
+                work = path + '.run'
+                with open(path, 'rb') as src, open(work, 'wb') as dst:
+                    dst.write(src.read())
+                ctx = scenarios.Context(work, rows, stub.url, args.repeat, args.seed)
+                print('{:<20} {:>8} rows'.format(name, rows), end=' ', file=sys.stderr,
+                      flush=True)
+                durations = function(ctx)
+                if durations is None:
+                    print('unavailable', file=sys.stderr)
+                    skipped.append(name)
+                    continue
+                result = summarize(name, rows if sized else None, durations)
+                print('{:9.2f} ms'.format(result['median'] * 1000), file=sys.stderr)
+                results.append(result)
+        requests = stub.requests
+        for url in [u for u in provider.RATE_LIMITS if u.startswith(stub.url)]:
+            del provider.RATE_LIMITS[url]
+
+    for suffix in ('', '-wal', '-shm'):
+        for rows in args.rows:
+            work = library(rows, args.seed, args.data) + '.run' + suffix
+            if os.path.exists(work):
+                os.remove(work)
+    return {'meta': {'commit': _commit(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                     'python': platform.python_version(),
+                     'sqlite': sqlite3.sqlite_version, 'platform': platform.platform(),
+                     'repeat': args.repeat, 'seed': args.seed, 'latency': args.latency,
+                     'stub_requests': requests, 'skipped': sorted(set(skipped))},
+            'results': results}
+
+
+def compare(baseline, current, threshold=THRESHOLD):
+    """Print the change of the median of every scenario both runs have in common.
+    :return: The number of scenarios slower than `threshold` times the baseline."""
+    before      = {(r['scenario'], r['rows']): r for r in baseline['results']}
+    regressions = 0
+    for result in current['results']:
+        old = before.get((result['scenario'], result['rows']))
+        if old is None or not old['median']:
+            continue
+        ratio = result['median'] / old['median']
+        slow  = ratio > threshold
+        regressions += slow
+        print('{:<20} {:>8} {:9.2f} ms -> {:9.2f} ms  {:5.2f}x{}'.format(
+            result['scenario'], result['rows'] or '', old['median'] * 1000,
+            result['median'] * 1000, ratio, '  REGRESSION' if slow else ''))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the Minerva benchmarks.')
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='Library sizes to run against (1k to 1M).')
+    parser.add_argument('--scenario', dest='scenarios', action='append',
+                        help='Only run scenarios starting with this name '
+                             '(e.g. "search"), can be given several times.')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per scenario.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='Seconds each request to the Open Library stand-in takes.')
+    parser.add_argument('--rate-limit', type=float, default=1000,
+                        help='Requests per second sent to the stand-in.')
+    parser.add_argument('--data', default=DATA_DIR,
+                        help='Where generated libraries are kept.')
+    parser.add_argument('--output', help='Write the results to this JSON file.')
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help='Compare with the results of an earlier run.')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD,
+                        help='Slowdown reported as a regression by --compare.')
+    parser.add_argument('--list', action='store_true', help='List all scenarios.')
+    args = parser.parse_args(argv)
+
+    if args.list:
+        for name, (function, gui, _) in scenarios.SCENARIOS.items():
+            print('{:<20} {}{}'.format(name, function.__doc__.splitlines()[0],
+                                       ' (GTK)' if gui else ''))
+        return 0
+
+    results = run(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    if args.compare:
+        with open(args.compare) as f:
+            return 1 if compare(json.load(f), results, args.threshold) else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
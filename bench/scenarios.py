@@ -0,0 +1,458 @@
+"""
+The benchmark scenarios.
+
+Every scenario is a function taking a `Context` and returning the durations of its
+runs in seconds. Scenarios marked `gui` drive the real GTK widgets and are skipped
+when GTK or a display is not available; their headless counterparts measure the
+same database and search work without the widgets.
+"""
+import random
+import sys
+import time
+from collections import OrderedDict
+
+SCENARIOS   = OrderedDict()     # name -> (function, needs GTK, depends on library size)
+QUERIES     = ('r', 'ri', 'riv', 'rive', 'river', 'river s', 'river st')
+SELECTIONS  = 200               # books looked up per selection run
+EDITS       = 1000              # changed books per save run
+ISBNS       = 200               # ISBNs per bulk provider run
+PAGES       = 3                 # search.json pages per query run
+VISIBLE     = 20                # rows of a result page on screen
+
+
+class Context(object):
+    """What the scenarios run against.
+    :param str path: A library database, see `bench.generate`.
+    :param int rows: The number of books in the library.
+    :param str url: The base URL of the Open Library stand-in, see `bench.stub`.
+    :param int repeat: The number of runs per scenario."""
+
+    def __init__(self, path, rows, url, repeat=5, seed=0):
+        self.path   = path
+        self.rows   = rows
+        self.url    = url
+        self.repeat = repeat
+        self.random = random.Random(seed)
+
+    def isbns(self, count):
+        """Return random ISBNs from the library."""
+        import model
+        engine = model.get_engine(self.path)
+        isbns = [r[0] for r in engine.execute(
+            'SELECT isbn FROM book ORDER BY random() LIMIT {:d}'.format(count))]
+        engine.dispose()
+        return isbns
+
+
+def scenario(name, gui=False, sized=True):
+    """Register a scenario.
+    :param bool gui: The scenario needs GTK.
+    :param bool sized: The results depend on the size of the library, otherwise the
+    scenario only runs against the first library."""
+    def register(function):
+        SCENARIOS[name] = (function, gui, sized)
+        return function
+    return register
+
+
+def timed(function, repeat, setup=None):
+    """Run `function(setup())` `repeat` times.
+    :return: The durations, not counting `setup`."""
+    durations = []
+    for _ in range(repeat):
+        arg = setup() if setup else None
+        start = time.perf_counter()
+        function(arg) if setup else function()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def gui_available():
+    try:
+        import gi
+        gi.require_version('Gtk', '3.0')
+        from gi.repository import Gtk
+    except (ImportError, ValueError):
+        return False
+    return Gtk.init_check(sys.argv)[0]
+
+
+def _iterate_main_loop():
+    from gi.repository import GLib
+    context = GLib.MainContext.default()
+    while context.pending():
+        context.iteration(False)
+
+
+class _Parent(object):
+    """Stands in for the `Minerva` application a `BookList` reports to."""
+    selected_book = None
+
+    def set_active_book(self, book):
+        self.selected_book = book
+
+    def update_filters(self, counts):
+        pass
+
+
+def _show_book_list(path):
+    """Build a `BookList` like `Minerva.__init__`, draw it and wait for the index."""
+    from gi.repository import Gtk
+    from gui.booklist import BookList
+    import model
+    books   = BookList(parent=_Parent(), db=model.get_db(path))
+    window  = Gtk.OffscreenWindow()
+    window.set_default_size(900, 600)
+    window.add(books)
+    window.show_all()
+    while books.index is None:
+        _iterate_main_loop()
+        time.sleep(0.001)
+    _iterate_main_loop()
+    return books
+
+
+# Startup
+
+@scenario('startup.open')
+def startup_open(ctx):
+    """Open the database and load the first screen of rows, like `BookStore`."""
+    import model
+    from sqlalchemy import func, literal_column, select
+    table = model.Book.__table__
+
+    def run():
+        db = model.get_db(ctx.path)
+        db.execute(select([func.count()]).select_from(table)).scalar()
+        db.execute(select([table.c[c] for c in model.Book.COLUMNS] +
+                          [literal_column('book.rowid')])
+                   .order_by(literal_column('book.rowid')).limit(256)).fetchall()
+        db.close()
+    return timed(run, ctx.repeat)
+
+
+@scenario('startup.index')
+def startup_index(ctx):
+    """Build the search engine the `BookList` builds in the background."""
+    import model
+    import search
+    engine = model.get_engine(ctx.path)
+    try:
+        return timed(lambda: search.create_engine(engine, 'auto'), ctx.repeat)
+    finally:
+        engine.dispose()
+
+
+@scenario('startup.booklist', gui=True)
+def startup_booklist(ctx):
+    """Construct, draw and index a `BookList`."""
+    return timed(lambda: _show_book_list(ctx.path), ctx.repeat)
+
+
+# Search
+
+def _type_queries(search):
+    for query in QUERIES:
+        search(query)
+
+
+@scenario('search.index')
+def search_index(ctx):
+    """Type a query letter by letter into the in-memory `SearchIndex`."""
+    import model
+    import search
+    engine = model.get_engine(ctx.path)
+    index = search.SearchIndex.from_db(engine)
+    engine.dispose()
+    # A new query invalidates the narrowing cache of the previous sequence
+    return timed(lambda _: _type_queries(index.search), ctx.repeat,
+                 setup=lambda: index.search('\0'))
+
+
+@scenario('search.fts')
+def search_fts(ctx):
+    """Type a query letter by letter into the full-text index."""
+    import model
+    import search
+    engine = model.get_engine(ctx.path)
+    fts = search.FullTextSearch.from_db(engine)
+    try:
+        if fts is None:
+            return None
+        return timed(lambda: _type_queries(fts.search), ctx.repeat)
+    finally:
+        engine.dispose()
+
+
+@scenario('search.like')
+def search_like(ctx):
+    """Count the matches of each query with the SQL fallback.
+    The `BookList` searches this way until its search engine is ready."""
+    import model
+    from sqlalchemy import func, select
+    db = model.get_db(ctx.path)
+    query = select([func.count()]).select_from(model.Book.__table__)
+
+    def run():
+        for q in QUERIES:
+            db.execute(query.where(model.Book.matching(q))).scalar()
+    try:
+        return timed(run, ctx.repeat)
+    finally:
+        db.close()
+
+
+@scenario('search.booklist', gui=True)
+def search_booklist(ctx):
+    """Type a query letter by letter into `BookList.search` and redraw."""
+    books = _show_book_list(ctx.path)
+
+    def run():
+        for query in QUERIES:
+            books.search(query)
+            _iterate_main_loop()
+    return timed(run, ctx.repeat, setup=lambda: books.search(''))
+
+
+# Selection
+
+@scenario('select.cache')
+def select_cache(ctx):
+    """Look up the selected book through a fresh `BookCache`, then again warm."""
+    import model
+    db      = model.get_db(ctx.path)
+    rows    = [db.execute('SELECT isbn, author, title FROM book WHERE isbn = :isbn',
+                          {'isbn': isbn}).fetchone() for isbn in ctx.isbns(SELECTIONS)]
+
+    def run(cache):
+        for isbn, author, title in rows:
+            cache.fetch(isbn, author, title)
+        for isbn, author, title in rows:
+            cache.fetch(isbn, author, title)
+    try:
+        return timed(run, ctx.repeat, setup=lambda: model.BookCache(db))
+    finally:
+        db.close()
+
+
+@scenario('select.booklist', gui=True)
+def select_booklist(ctx):
+    """Select rows of a `BookList`, which looks up the book for the status bar."""
+    from gi.repository import Gtk
+    books       = _show_book_list(ctx.path)
+    selection   = books.tree_view.get_selection()
+    count       = min(SELECTIONS, len(books.data))
+
+    def run():
+        for index in ctx.random.sample(range(len(books.data)), count):
+            selection.select_path(Gtk.TreePath.new_from_indices([index]))
+            _iterate_main_loop()
+    return timed(run, ctx.repeat)
+
+
+# Sorting
+
+@scenario('sort.load')
+def sort_load(ctx):
+    """Load the title sort keys and sort all books and a third of them, like
+    clicking the title column of a `BookList` with and without a search."""
+    import model
+    import sorting
+    engine = model.get_engine(ctx.path)
+
+    def run():
+        keys = sorting.SortKeys.from_db(engine, sorting.TITLE)
+        rowids = keys.sort()
+        keys.sort(rowids[::3], descending=True)
+    try:
+        return timed(run, ctx.repeat)
+    finally:
+        engine.dispose()
+
+
+@scenario('sort.edit')
+def sort_edit(ctx):
+    """Rename books of a list sorted by title and move each to its new place."""
+    import model
+    import sorting
+    engine  = model.get_engine(ctx.path)
+    keys    = sorting.SortKeys.from_db(engine, sorting.TITLE)
+    rows    = {r[-1]: list(r) for r in engine.execute(
+        'SELECT isbn, title, author, own, want, read, location, rowid FROM book '
+        'ORDER BY random() LIMIT {:d}'.format(EDITS))}
+    engine.dispose()
+    shown   = keys.sort()
+
+    def run():
+        for rowid, row in rows.items():
+            row[1] = row[1][::-1]
+            keys.update(rowid, row)
+            shown.pop(shown.index(rowid))
+            shown.insert(keys.position(shown, rowid), rowid)
+    return timed(run, ctx.repeat)
+
+
+# Saving
+
+def _changes(ctx, flip):
+    import model
+    engine  = model.get_engine(ctx.path)
+    changes = {r[-1]: list(r[:-1]) for r in engine.execute(
+        'SELECT isbn, title, author, own, want, read, location, id FROM book '
+        'ORDER BY random() LIMIT {:d}'.format(EDITS))}
+    engine.dispose()
+    for row in changes.values():
+        row[5] = not row[5] if flip else bool(row[5])
+    return changes
+
+
+@scenario('save.books')
+def save_books(ctx):
+    """Write back edited books like the autosave on quit does."""
+    import model
+    db = model.get_db(ctx.path)
+    try:
+        return timed(lambda changes: model.save_books(db, changes), ctx.repeat,
+                     setup=lambda: _changes(ctx, flip=True))
+    finally:
+        db.close()
+
+
+@scenario('save.on_quit', gui=True)
+def save_on_quit(ctx):
+    """Flush an `Autosave` with pending edits and wait for it, like `on_quit`."""
+    from gui.autosave import Autosave, ChangeTracker
+    tracker     = ChangeTracker()
+    autosave    = Autosave(ctx.path, tracker)
+
+    def setup():
+        for rowid, row in _changes(ctx, flip=True).items():
+            tracker.mark(rowid, row)
+    return timed(lambda _: autosave.flush(wait=True), ctx.repeat, setup=setup)
+
+
+# Providers
+
+def _open_library(ctx):
+    from provider import OpenLibrary
+    return OpenLibrary(base_url=ctx.url)
+
+
+@scenario('provider.isbn', sized=False)
+def provider_isbn(ctx):
+    """Look up ISBNs one at a time, like the add book dialog."""
+    isbns = ctx.isbns(20)
+
+    def run(ol):
+        for isbn in isbns:
+            try:
+                ol.isbn_search(isbn)
+            except Exception:
+                pass
+    return timed(run, ctx.repeat, setup=lambda: _open_library(ctx))
+
+
+@scenario('provider.isbn_many', sized=False)
+def provider_isbn_many(ctx):
+    """Look up a list of ISBNs in batches, like `minerva import`."""
+    isbns = ctx.isbns(ISBNS)
+    return timed(lambda ol: list(ol.isbn_search_many(isbns)), ctx.repeat,
+                 setup=lambda: _open_library(ctx))
+
+
+@scenario('provider.query', sized=False)
+def provider_query(ctx):
+    """Search by title and page through the first results."""
+    from provider import Identifier
+
+    def run(ol):
+        stream = ol.query_pages('river', Identifier.TITLE)
+        for _ in range(PAGES):
+            stream.next_page()
+        stream.close()
+    return timed(run, ctx.repeat, setup=lambda: _open_library(ctx))
+
+
+@scenario('provider.parse', sized=False)
+def provider_parse(ctx):
+    """Parse big search.json pages and show their first rows, without the network."""
+    import json
+    from bench.stub import OpenLibraryStub
+    from provider import OpenLibrary
+    body = json.dumps(OpenLibraryStub(num_found=1000).search(
+        {'title': ['river'], 'limit': ['1000']}))
+
+    def run():
+        for page in range(PAGES):
+            result = OpenLibrary.Result.parse_json(json.loads(body), page)
+            for entry in result.results[:VISIBLE]:
+                entry.title, entry.author
+    return timed(run, ctx.repeat)
+
+
+@scenario('provider.fanout', sized=False)
+def provider_fanout(ctx):
+    """Look up ISBNs and search titles through Open Library and Google Books at
+    once, like the add book dialog with both providers configured."""
+    from fanout import FanOut
+    from provider import GoogleBooks, Identifier, OpenLibrary, RATE_LIMITS
+    isbns = ctx.isbns(20)
+    RATE_LIMITS.setdefault(ctx.url + 'books/v1/', RATE_LIMITS.get(ctx.url))
+
+    def setup():
+        return FanOut([OpenLibrary(base_url=ctx.url),
+                       GoogleBooks(base_url=ctx.url + 'books/v1/')])
+
+    def run(providers):
+        for isbn in isbns:
+            try:
+                providers.isbn_search(isbn)
+            except Exception:
+                pass
+        providers.query_search('river', Identifier.TITLE)
+    return timed(run, ctx.repeat, setup=setup)
+
+
+# Catalog
+
+def _catalog(ctx, dump=None):
+    """Build a catalog of the library's books from a generated dump.
+    :param str dump: The dump, generated if not given."""
+    import catalog
+    import os
+    from bench import generate
+    base = os.path.splitext(ctx.path)[0]
+    if os.path.exists(base + '.catalog.sqlite'):
+        os.remove(base + '.catalog.sqlite')
+    if dump is None:
+        dump = generate.dump(base + '.dump.gz', ctx.rows)
+    catalog.import_dump(dump, base + '.catalog.sqlite')
+    return base + '.catalog.sqlite'
+
+
+@scenario('catalog.import')
+def catalog_import(ctx):
+    """Import a generated Open Library dump into a fresh catalog."""
+    import os
+    from bench import generate
+    dump = generate.dump(os.path.splitext(ctx.path)[0] + '.dump.gz', ctx.rows)
+    return timed(lambda _: _catalog(ctx, dump), ctx.repeat, setup=lambda: None)
+
+
+@scenario('catalog.isbn')
+def catalog_isbn(ctx):
+    """Look up ISBNs and search titles in the local catalog, like the add book
+    dialog with the 'catalog' provider."""
+    import catalog
+    from provider import Identifier
+    provider    = catalog.Catalog(_catalog(ctx))
+    isbns       = ctx.isbns(ISBNS)
+
+    def run():
+        for isbn in isbns:
+            provider.isbn_search(isbn)
+        provider.query_pages('river', Identifier.TITLE).next_page()
+    try:
+        return timed(run, ctx.repeat)
+    finally:
+        provider.close()
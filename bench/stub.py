@@ -0,0 +1,136 @@
+"""
+A local stand-in for the Open Library API.
+"""
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+NUM_FOUND = 500     # results of every search.json query
+
+
+def _number(text):
+    return int(hashlib.sha1(text.encode('utf-8')).hexdigest()[:8], 16)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'   # keep connections alive like Open Library
+
+    def do_GET(self):
+        stub = self.server.stub
+        url = urlsplit(self.path)
+        params = parse_qs(url.query)
+        with stub.lock:
+            stub.requests += 1
+        time.sleep(stub.latency)
+        if url.path == '/api/books':
+            self._send(stub.books(params.get('bibkeys', [''])[0].split(',')))
+        elif url.path == '/search.json':
+            self._send(stub.search(params))
+        elif url.path == '/books/v1/volumes':
+            self._send(stub.volumes(params))
+        else:
+            self._send({'error': 'not found'}, status=404)
+
+    def _send(self, data, status=200):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class OpenLibraryStub(object):
+    """Serves `api/books` and `search.json` like Open Library, on localhost.
+    Responses are generated from the request, so the same request always gets the
+    same answer. Every request is delayed by `latency` seconds.
+
+    Use as a context manager and pass `url` as the base URL of
+    `provider.OpenLibrary`. `books/v1/volumes` stands in for Google Books, pass
+    `url + 'books/v1/'` as the base URL of `provider.GoogleBooks`."""
+
+    def __init__(self, latency=0.05, miss_rate=0.1, num_found=NUM_FOUND, port=0):
+        """Initializes the instance.
+        :param float latency: Seconds each request takes.
+        :param float miss_rate: The share of ISBNs `api/books` knows nothing about.
+        :param int num_found: The number of results of every search.
+        :param int port: The port to listen on, 0 picks a free one.
+        """
+        self.latency    = latency
+        self.miss_rate  = miss_rate
+        self.num_found  = num_found
+        self.requests   = 0
+        self.lock       = threading.Lock()
+        self._server    = ThreadingHTTPServer(('127.0.0.1', port), _Handler)
+        self._server.daemon_threads = True
+        self._server.stub = self
+        self._thread    = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/'.format(self._server.server_address[1])
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _book(self, key):
+        n = _number(key)
+        return {'title': 'Book {}'.format(n % 100000),
+                'authors': [{'name': 'Author {}'.format(n % 997)}]}
+
+    def books(self, bibkeys):
+        """The response of `api/books?bibkeys=...&jscmd=data&format=json`."""
+        return {key: self._book(key) for key in bibkeys
+                if key and _number(key) % 1000 >= self.miss_rate * 1000}
+
+    def volumes(self, params):
+        """The response of Google Books' `volumes?q=...`, see `provider.GoogleBooks`."""
+        query = params.get('q', [''])[0]
+        field, _, value = query.partition(':')
+        if field == 'isbn':
+            book = self.books(['ISBN:' + value]).get('ISBN:' + value)
+            if book is None:
+                return {'totalItems': 0}
+            info = {'title': book['title'], 'authors': [book['authors'][0]['name']],
+                    'industryIdentifiers': [{'type': 'ISBN_13', 'identifier': value}]}
+            return {'totalItems': 1, 'items': [{'volumeInfo': info}]}
+
+        limit = int(params.get('maxResults', ['10'])[0])
+        docs = self.search({'title': [value], 'limit': [str(limit)]})['docs']
+        items = [{'volumeInfo': {
+            'title': d['title'], 'authors': d['author_name'],
+            'industryIdentifiers': [{'type': 'ISBN_13', 'identifier': d['isbn'][0]}]}}
+            for d in docs]
+        return {'totalItems': self.num_found, 'items': items}
+
+    def search(self, params):
+        """The response of `search.json`, see `provider.OpenLibrary._search_page`."""
+        query   = next((params[f][0] for f in ('title', 'author', 'q') if f in params),
+                       '')
+        offset  = int(params.get('offset', ['0'])[0])
+        limit   = int(params.get('limit', ['100'])[0])
+        docs    = []
+        for i in range(offset, min(offset + limit, self.num_found)):
+            n = _number('{}:{}'.format(query, i))
+            docs.append({'title': '{} {}'.format(query.title(), i),
+                         'author_name': ['Author {}'.format(n % 997)],
+                         'isbn': ['978{:010d}'.format(n % 10 ** 10)]})
+        return {'start': offset, 'num_found': self.num_found, 'docs': docs}
@@ -0,0 +1,145 @@
+"""
+A persistent cache for provider responses.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_TTL     = 30 * 24 * 3600    # seconds a found entry stays valid
+NEGATIVE_TTL    = 24 * 3600         # seconds a "no results" answer stays valid
+MAX_BYTES       = 64 * 1024 * 1024  # size of the on-disk cache
+MEMORY_ENTRIES  = 512               # entries kept in memory
+
+SCHEMA = """CREATE TABLE IF NOT EXISTS response (
+                key         TEXT PRIMARY KEY,
+                value       TEXT,
+                expires     REAL NOT NULL,
+                accessed    REAL NOT NULL,
+                size        INTEGER NOT NULL)"""
+
+
+class ResponseCache(object):
+    """Caches JSON-serializable values on disk, with an LRU in memory in front.
+    A value of `None` is a negative entry, i.e. the provider had no results.
+    Expired entries are ignored; once the database grows beyond `max_bytes` the
+    least recently used entries are evicted. Safe to use from several threads."""
+
+    def __init__(self, path, ttl=DEFAULT_TTL, negative_ttl=NEGATIVE_TTL,
+                 max_bytes=MAX_BYTES, memory_entries=MEMORY_ENTRIES):
+        """Initializes the instance.
+        :param str path: The path to the cache database (`~` is expanded).
+        :param int ttl: Seconds until a cached value expires.
+        :param int negative_ttl: Seconds until a cached negative answer expires.
+        :param int max_bytes: The maximum size of all values on disk.
+        :param int memory_entries: The number of entries kept in memory.
+        """
+        path = os.path.expanduser(path)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.ttl            = ttl
+        self.negative_ttl   = negative_ttl
+        self.max_bytes      = max_bytes
+        self.memory_entries = memory_entries
+        self._memory        = OrderedDict()     # key -> (expires, value)
+        self._lock          = threading.Lock()
+        self._size          = None
+        self._conn          = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(SCHEMA)
+        self._conn.execute('CREATE INDEX IF NOT EXISTS response_accessed '
+                           'ON response (accessed)')
+        self._conn.commit()
+
+    def _remember(self, key, expires, value):
+        self._memory[key] = (expires, value)
+        self._memory.move_to_end(key)
+        if len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, key):
+        """Look up a key.
+        :return: A tuple `(hit, value)`, `value` is `None` for negative entries."""
+        now = time.time()
+        with self._lock:
+            cached = self._memory.get(key)
+            if cached is not None:
+                if cached[0] > now:
+                    self._memory.move_to_end(key)
+                    return True, cached[1]
+                del self._memory[key]
+
+            row = self._conn.execute(
+                'SELECT value, expires FROM response WHERE key = ?', (key,)).fetchone()
+            if row is None or row[1] <= now:
+                return False, None
+            self._conn.execute('UPDATE response SET accessed = ? WHERE key = ?',
+                               (now, key))
+            self._conn.commit()
+            value = json.loads(row[0]) if row[0] is not None else None
+            self._remember(key, row[1], value)
+            return True, value
+
+    def set(self, key, value, ttl=None):
+        """Store a value, `None` stores a negative entry.
+        :param int ttl: Overrides the default time to live."""
+        if ttl is None:
+            ttl = self.ttl if value is not None else self.negative_ttl
+        now     = time.time()
+        data    = json.dumps(value) if value is not None else None
+        size    = len(data) if data is not None else 0
+        with self._lock:
+            self._remember(key, now + ttl, value)
+            if self._size is not None:
+                # A replaced entry no longer counts
+                old = self._conn.execute('SELECT size FROM response WHERE key = ?',
+                                         (key,)).fetchone()
+                self._size += size - (old[0] if old else 0)
+            self._conn.execute('INSERT OR REPLACE INTO response VALUES (?, ?, ?, ?, ?)',
+                               (key, data, now + ttl, now, size))
+            self._conn.commit()
+            self._evict(now)
+
+    def delete(self, key):
+        """Remove an entry, unknown keys are ignored."""
+        with self._lock:
+            self._memory.pop(key, None)
+            row = self._conn.execute('SELECT size FROM response WHERE key = ?',
+                                     (key,)).fetchone()
+            if row is None:
+                return
+            self._conn.execute('DELETE FROM response WHERE key = ?', (key,))
+            self._conn.commit()
+            if self._size is not None:
+                self._size -= row[0]
+
+    def _evict(self, now):
+        if self._size is None:
+            self._size = self._conn.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM response').fetchone()[0]
+        if self._size <= self.max_bytes:
+            return
+
+        # Free some headroom so that not every insert has to evict
+        self._conn.execute('DELETE FROM response WHERE expires <= ?', (now,))
+        excess  = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM response'
+                                     ).fetchone()[0] - self.max_bytes * 0.9
+        evicted = []
+        for key, size in self._conn.execute(
+                'SELECT key, size FROM response ORDER BY accessed'):
+            if excess <= 0:
+                break
+            evicted.append((key,))
+            excess -= size
+        self._conn.executemany('DELETE FROM response WHERE key = ?', evicted)
+        self._conn.commit()
+        self._size = None
+        self._memory.clear()
+
+    def clear(self):
+        """Remove all entries."""
+        with self._lock:
+            self._memory.clear()
+            self._conn.execute('DELETE FROM response')
+            self._conn.commit()
+            self._size = 0
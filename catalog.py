@@ -0,0 +1,347 @@
+"""
+A local book catalog built from the Open Library bulk dumps.
+
+The dumps (https://openlibrary.org/developers/dumps) are gzipped text files with
+one record per line: type, key, revision, last modified and the record as JSON,
+separated by tabs. `import_dump` streams them line by line into a SQLite database
+holding the authors, works and editions with an ISBN index and a full-text index
+over titles and authors. `Catalog` searches that database like the web providers
+search the internet, so ISBN lookups are index hits and nothing is sent over the
+network for books the catalog knows.
+"""
+import gzip
+import io
+import json
+import os
+import re
+import sqlite3
+import threading
+from dedupe import to_isbn13
+from exc import InvalidISBNError, NoResultsError
+from provider import Entry, Identifier, Result, ResultStream, register
+
+DEFAULT_PATH    = '~/.cache/minerva/catalog.sqlite'
+BATCH           = 10000     # records per transaction while importing
+PAGE_SIZE       = 50        # results per page of `Catalog.query_pages`
+COVERS_URL      = 'https://covers.openlibrary.org/b/'
+
+SCHEMA = (
+    # Records are keyed by the number of their Open Library key, e.g. 123 for
+    # '/books/OL123M', which keeps the tables and the ISBN index small
+    """CREATE TABLE IF NOT EXISTS author (
+           id           INTEGER PRIMARY KEY,
+           name         TEXT NOT NULL)""",
+    """CREATE TABLE IF NOT EXISTS work (
+           id           INTEGER PRIMARY KEY,
+           author       INTEGER)""",
+    """CREATE TABLE IF NOT EXISTS edition (
+           id           INTEGER PRIMARY KEY,
+           title        TEXT NOT NULL,
+           author       INTEGER,
+           work         INTEGER,
+           by_statement TEXT,
+           isbns        TEXT NOT NULL,
+           cover        INTEGER)""",
+    """CREATE TABLE IF NOT EXISTS isbn (
+           isbn         TEXT PRIMARY KEY,
+           edition      INTEGER NOT NULL) WITHOUT ROWID""",
+)
+FTS_SCHEMA = """CREATE VIRTUAL TABLE IF NOT EXISTS edition_fts USING fts5(
+                    title, author, content='',
+                    tokenize='unicode61 remove_diacritics 2')"""
+
+# The author of an edition, or of its work if the edition does not name one
+AUTHOR = 'COALESCE(author.name, work_author.name, edition.by_statement)'
+JOINS = """
+    FROM edition
+    LEFT JOIN author ON author.id = edition.author
+    LEFT JOIN work ON work.id = edition.work
+    LEFT JOIN author AS work_author ON work_author.id = work.author"""
+SELECT_EDITION = "SELECT edition.isbns, edition.title, COALESCE({}, 'Unknown'), " \
+                 "edition.cover {}".format(AUTHOR, JOINS)
+
+_KEY = re.compile(r'/OL(\d+)[AMW]$')
+
+
+def _id(key):
+    """Turn an Open Library key like '/books/OL123M' into its number."""
+    match = _KEY.search(key or '')
+    return int(match.group(1)) if match else None
+
+
+def _ref(refs, nested=None):
+    """The number of the first key in a list of references like
+    `[{'key': '/authors/OL1A'}]` (or `[{'author': {'key': ...}}]` for `nested`)."""
+    for ref in refs or ():
+        if nested is not None:
+            ref = ref.get(nested) if isinstance(ref, dict) else None
+        if isinstance(ref, dict) and _id(ref.get('key')) is not None:
+            return _id(ref['key'])
+    return None
+
+
+def _open(path):
+    """Open a dump for reading lines, gzipped or not.
+    :return: The file as read from disk (to tell the progress) and its lines."""
+    raw = open(path, 'rb')
+    if raw.peek(2)[:2] == b'\x1f\x8b':
+        data = gzip.GzipFile(fileobj=raw)
+    else:
+        data = raw
+    return raw, io.TextIOWrapper(data, encoding='utf-8', errors='replace')
+
+
+def connect(path=DEFAULT_PATH):
+    """Open a catalog database, creating its tables if needed.
+    :return: The `sqlite3.Connection` and whether SQLite supports FTS5."""
+    path = os.path.expanduser(path)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    conn = sqlite3.connect(path, check_same_thread=False)
+    for statement in SCHEMA:
+        conn.execute(statement)
+    try:
+        conn.execute(FTS_SCHEMA)
+        fts = True
+    except sqlite3.OperationalError:    # no such module: fts5
+        fts = False
+    conn.commit()
+    return conn, fts
+
+
+def parse_line(line):
+    """Parse a line of a dump into a row for one of the catalog tables.
+    :return: A tuple `(table, row)`, or `None` for records the catalog ignores
+    (other types, editions without ISBN or title)."""
+    parts = line.split('\t', 4)
+    if len(parts) != 5:
+        return None
+    kind = parts[0]
+    if kind == '/type/edition':
+        data    = json.loads(parts[4])
+        isbns   = []
+        for isbn in data.get('isbn_13', []) + data.get('isbn_10', []):
+            isbn = to_isbn13(isbn)
+            if isbn and isbn not in isbns:
+                isbns.append(isbn)
+        title   = data.get('title')
+        if not isbns or not title:
+            return None
+        if data.get('subtitle'):
+            title = '{}: {}'.format(title, data['subtitle'])
+        covers  = [c for c in data.get('covers', ()) if isinstance(c, int) and c > 0]
+        return 'edition', (_id(parts[1]), title, _ref(data.get('authors')),
+                           _ref(data.get('works')), data.get('by_statement'),
+                           ' '.join(isbns), covers[0] if covers else None)
+    if kind == '/type/author':
+        data = json.loads(parts[4])
+        if not data.get('name'):
+            return None
+        return 'author', (_id(parts[1]), data['name'])
+    if kind == '/type/work':
+        data = json.loads(parts[4])
+        return 'work', (_id(parts[1]), _ref(data.get('authors'), nested='author'))
+    return None
+
+
+INSERTS = {
+    'author':   'INSERT OR REPLACE INTO author VALUES (?, ?)',
+    'work':     'INSERT OR REPLACE INTO work VALUES (?, ?)',
+    'edition':  'INSERT OR REPLACE INTO edition VALUES (?, ?, ?, ?, ?, ?, ?)',
+}
+
+
+def import_dump(path, catalog=DEFAULT_PATH, progress=None, index=True):
+    """Import an editions, works, authors or 'all types' dump into the catalog.
+    The dump is read line by line, so its size does not matter; records already
+    in the catalog are replaced.
+    :param str path: The dump, gzipped or not.
+    :param str catalog: The catalog database.
+    :param progress: Called with the number of bytes read so far (of the
+    compressed file) after every batch.
+    :param bool index: Rebuild the full-text index at the end, see `build_index`.
+    When importing several dumps, only the last import needs to.
+    :return: A dictionary mapping 'author', 'work' and 'edition' to the number of
+    imported records."""
+    conn, fts   = connect(catalog)
+    counts      = dict.fromkeys(INSERTS, 0)
+    # The catalog can be rebuilt from the dump, durability is not worth the time
+    synchronous = conn.execute('PRAGMA synchronous').fetchone()[0]
+    conn.execute('PRAGMA synchronous = OFF')
+    conn.execute('PRAGMA journal_mode = MEMORY')
+    raw, lines  = _open(path)
+    try:
+        with raw, lines:
+            batch = {table: [] for table in INSERTS}
+            size = 0
+            for line in lines:
+                try:
+                    parsed = parse_line(line)
+                except ValueError:  # a broken record
+                    continue
+                if parsed is None or parsed[1][0] is None:
+                    continue
+                batch[parsed[0]].append(parsed[1])
+                size += 1
+                if size == BATCH:
+                    _write(conn, batch, counts)
+                    size = 0
+                    if progress is not None:
+                        progress(raw.tell())
+            _write(conn, batch, counts)
+            if progress is not None:
+                progress(raw.tell())
+        if fts and index:
+            build_index(conn)
+    finally:
+        conn.execute('PRAGMA synchronous = {:d}'.format(synchronous))
+        conn.close()
+    return counts
+
+
+def _write(conn, batch, counts):
+    with conn:
+        for table, rows in batch.items():
+            if not rows:
+                continue
+            conn.executemany(INSERTS[table], rows)
+            if table == 'edition':
+                conn.executemany('INSERT OR REPLACE INTO isbn VALUES (?, ?)',
+                                 [(isbn, row[0]) for row in rows
+                                  for isbn in row[5].split()])
+            counts[table] += len(rows)
+            del rows[:]
+
+
+def build_index(conn):
+    """Rebuild the full-text index over the titles and authors of all editions.
+    It is built once after an import rather than with every record, because the
+    author of an edition is only known once the authors dump has been imported."""
+    with conn:
+        conn.execute("INSERT INTO edition_fts (edition_fts) VALUES ('delete-all')")
+        conn.execute('INSERT INTO edition_fts (rowid, title, author) '
+                     'SELECT edition.id, edition.title, {} {}'.format(AUTHOR, JOINS))
+
+
+def _fts_query(query, identifier):
+    """Match all words of the query as prefixes in the title or author column."""
+    words = re.findall(r'\w+', query.lower())
+    if not words:
+        return None
+    return '{}: ({})'.format(identifier.value,
+                             ' '.join('"{}"*'.format(w) for w in words))
+
+
+@register('catalog')
+class Catalog(object):
+    """Searches the local catalog, see `import_dump`.
+    Has the interface of the web providers; books it does not know raise
+    `NoResultsError`, so `fanout.Fallback` can ask the web providers instead."""
+    LABEL = 'the local catalog'
+    LOCAL = True
+
+    def __init__(self, path=DEFAULT_PATH, **kwargs):
+        """Initializes the instance.
+        :param str path: The catalog database (`~` is expanded).
+        :param kwargs: The arguments of the web providers (e.g. `cache`), ignored.
+        """
+        self.path               = path
+        self._conn, self.fts    = connect(path)
+        self._lock              = threading.Lock()
+
+    def _query(self, statement, params=()):
+        with self._lock:
+            return self._conn.execute(statement, params).fetchall()
+
+    @staticmethod
+    def _entry(row):
+        isbns, title, author, cover = row
+        return Entry(isbns=isbns.split(), title=title, author=author,
+                     covers=[cover] if cover else None)
+
+    def isbn_search(self, isbn):
+        """Look up a book by its ISBN number, see `OpenLibrary.isbn_search`.
+        :rtype: provider.Entry"""
+        isbn13 = to_isbn13(isbn)
+        if not isbn13:
+            raise InvalidISBNError(isbn + ' is not a valid ISBN number.')
+        rows = self._query(SELECT_EDITION + ' WHERE edition.id = '
+                           '(SELECT edition FROM isbn WHERE isbn = ?)', (isbn13,))
+        if not rows:
+            raise NoResultsError('No book was found with the ISBN ' + isbn)
+        entry       = self._entry(rows[0])
+        entry.isbns = [isbn13]
+        return entry
+
+    def isbn_search_many(self, isbns, **kwargs):
+        """Look up several books, see `OpenLibrary.isbn_search_many`.
+        :return: A generator of `(isbn, entry or exception)` tuples."""
+        for isbn in isbns:
+            try:
+                yield isbn, self.isbn_search(isbn)
+            except (InvalidISBNError, NoResultsError) as e:
+                yield isbn, e
+
+    def _search(self, query, identifier, offset=0, limit=None):
+        """Return the raw rows of the editions matching a title or author query,
+        best matches first, and their total number."""
+        if self.fts:
+            match = _fts_query(query, identifier)
+            if match is None:
+                return [], 0
+            total = self._query('SELECT count(*) FROM edition_fts WHERE edition_fts '
+                                'MATCH ?', (match,))[0][0]
+            rows = self._query(
+                SELECT_EDITION + ' JOIN (SELECT rowid, bm25(edition_fts) AS rank FROM '
+                'edition_fts WHERE edition_fts MATCH ? ORDER BY rank LIMIT ? OFFSET ?) '
+                'AS hit ON hit.rowid = edition.id ORDER BY hit.rank',
+                (match, -1 if limit is None else limit, offset))
+            return rows, total
+        # Without FTS5 only titles can be searched, by their beginning
+        if identifier != Identifier.TITLE:
+            return [], 0
+        pattern = query.strip().replace('%', '').replace('_', '') + '%'
+        total = self._query('SELECT count(*) FROM edition WHERE title LIKE ?',
+                            (pattern,))[0][0]
+        rows = self._query(SELECT_EDITION + ' WHERE edition.title LIKE ? LIMIT ? '
+                           'OFFSET ?', (pattern, -1 if limit is None else limit, offset))
+        return rows, total
+
+    def count(self, query, identifier):
+        """The number of editions matching a title or author query."""
+        return self._search(query, identifier, limit=0)[1]
+
+    def query_search(self, query, identifier, limit=PAGE_SIZE):
+        """Search for books by title or author, see `OpenLibrary.query_search`.
+        :rtype: provider.Result"""
+        rows, total = self._search(query, identifier, limit=limit)
+        if not rows:
+            raise NoResultsError(
+                'No book was found with the {} {}'.format(identifier.value, query))
+        return Result(start=0, num_found=total, page=0,
+                      results=[self._entry(row) for row in rows])
+
+    def query_pages(self, query, identifier, limit=PAGE_SIZE, fields=None):
+        """Page through the results of a title or author search, see
+        `OpenLibrary.query_pages`.
+        :rtype: provider.ResultStream"""
+        return ResultStream(lambda offset: self._page(query, identifier, offset, limit),
+                            describe='the {} {}'.format(identifier.value, query))
+
+    def _page(self, query, identifier, offset, limit):
+        """A page of results in the format of Open Library's search.json."""
+        rows, total = self._search(query, identifier, offset, limit)
+        return {'start': offset, 'num_found': total,
+                'docs': [{'isbn': isbns.split(), 'title': title, 'author_name': [author],
+                          'cover': [cover] if cover else None}
+                         for isbns, title, author, cover in rows]}
+
+    def get_cover(self, entry, size='M'):
+        """Retrieve the URL for the cover of the given entry, see
+        `OpenLibrary.get_cover`. Entries of the catalog hold their cover ID."""
+        if isinstance(entry.covers, list) and entry.covers:
+            return '{}id/{}-{}.jpg'.format(COVERS_URL, entry.covers[0], size)
+        return '{}ISBN/{}-{}.jpg'.format(COVERS_URL, entry.isbns[0], size)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,294 @@
+"""
+Command line interface for importing and exporting the library without the GUI.
+Heavy modules are imported by the commands that need them, see `core`.
+"""
+import click
+import core
+import csv
+import instrument
+import io
+import json
+import os
+import sys
+from utils import log_error
+
+FORMATS     = ('csv', 'jsonl', 'isbn')
+EXTENSIONS  = {'.csv': 'csv', '.jsonl': 'jsonl', '.json': 'jsonl', '.txt': 'isbn'}
+TRUE        = ('1', 'true', 'yes', 'y', 'x')
+
+
+def _guess_format(path, fmt):
+    if fmt:
+        return fmt
+    fmt = EXTENSIONS.get(os.path.splitext(path)[1].lower())
+    if fmt is None:
+        log_error('Cannot guess the format of {}, use --format'.format(path))
+    return fmt
+
+
+def _flag(value, default):
+    if value is None or value == '':
+        return default
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in TRUE
+
+
+def _book_row(raw):
+    """Turn a parsed record into a complete row for `model.insert_books`.
+    :return: The row, or `None` if title, author or ISBN are missing (books are
+    stored by ISBN, the library only has room for a single book without one)."""
+    import isbnlib
+    title   = (raw.get('title') or '').strip()
+    author  = (raw.get('author') or '').strip()
+    isbn    = (raw.get('isbn') or '').strip()
+    if not title or not author or not isbn:
+        return None
+    isbn = isbnlib.to_isbn13(isbn) or isbn
+    return {'isbn': isbn, 'title': title, 'author': author,
+            'own': _flag(raw.get('own'), True), 'want': _flag(raw.get('want'), False),
+            'read': _flag(raw.get('read'), False),
+            'location': (raw.get('location') or '').strip() or None}
+
+
+def read_csv(f):
+    """Read records from a CSV file with a header row (see `model.Book.COLUMNS`)."""
+    return csv.DictReader(f)
+
+
+def read_jsonl(f):
+    """Read records from a file with one JSON object per line."""
+    for line in f:
+        if line.strip():
+            yield json.loads(line)
+
+
+def read_isbns(f):
+    """Look up the books of an ISBN list.
+    Every line may contain one ISBN, surrounded by anything else (e.g. a MARC 020
+    field like `020 ## $a 0261103342 (pbk.)`). Books Open Library does not know
+    are reported and skipped."""
+    import isbnlib
+
+    def isbns():
+        for line in f:
+            for isbn in isbnlib.get_isbnlike(line, level='normal')[:1]:
+                yield isbnlib.canonical(isbn)
+
+    for isbn, result in core.lookup_isbns(isbns()):
+        if isinstance(result, Exception):
+            click.secho(str(result), err=True, fg='yellow')
+            continue
+        yield {'isbn': result.isbns[0], 'title': result.title, 'author': result.author}
+
+
+def write_csv(f, rows, columns):
+    writer = csv.writer(f)
+    writer.writerow(columns)
+    writer.writerows(rows)
+
+
+def write_jsonl(f, rows, columns):
+    for row in rows:
+        f.write(json.dumps(dict(zip(columns, row))) + '\n')
+
+
+def write_isbns(f, rows, columns):
+    for row in rows:
+        if row[0]:
+            f.write(row[0] + '\n')
+
+
+READERS = {'csv': read_csv, 'jsonl': read_jsonl}
+WRITERS = {'csv': write_csv, 'jsonl': write_jsonl, 'isbn': write_isbns}
+
+
+@click.group()
+@click.option('--db', 'db_path', type=click.Path(dir_okay=False),
+              help='The database to use instead of the one in ~/.libraryrc.')
+@click.option('--trace', 'trace_path', type=click.Path(dir_okay=False, writable=True),
+              help='Record timings of database queries and HTTP requests to this '
+                   'file (Chrome trace format).')
+@click.pass_context
+def minerva(ctx, db_path, trace_path):
+    """Manage your library from the command line."""
+    ctx.obj = db_path
+    if trace_path:
+        instrument.enable(trace=True)
+        ctx.call_on_close(lambda: instrument.export_trace(trace_path))
+
+
+@minerva.command('import')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False, allow_dash=True))
+@click.option('--format', 'fmt', type=click.Choice(FORMATS),
+              help='The file format, guessed from the extension by default.')
+@click.pass_obj
+def import_books(db_path, path, fmt):
+    """Import books from a CSV, JSON Lines or ISBN list file.
+    Books whose ISBN (as ISBN-10 or ISBN-13) is already in the library are skipped,
+    records without ISBN, title or author are reported as invalid."""
+    fmt = _guess_format(path, fmt)
+    library = core.open_library(db_path)
+    raw = sys.stdin.buffer if path == '-' else open(path, 'rb')
+    f   = io.TextIOWrapper(raw, encoding='utf-8', newline='')
+    if fmt == 'isbn':
+        records = read_isbns(f)
+    else:
+        records = READERS[fmt](f)
+
+    invalid = []
+
+    def rows():
+        for record in records:
+            row = _book_row(record)
+            if row is None:
+                invalid.append(record)
+            else:
+                yield row
+
+    def tracked(bar):
+        position = 0
+        for row in rows():
+            if raw.tell() != position:
+                bar.update(raw.tell() - position)
+                position = raw.tell()
+            yield row
+
+    try:
+        if path == '-':
+            # The length of a pipe is unknown, count rows instead of bytes
+            with click.progressbar(rows(), label='Importing', file=sys.stderr) as bar:
+                inserted, skipped = library.import_rows(bar)
+        else:
+            with click.progressbar(length=os.path.getsize(path), label='Importing',
+                                   file=sys.stderr) as bar:
+                inserted, skipped = library.import_rows(tracked(bar))
+    finally:
+        f.close()
+
+    click.echo('Imported {} books, skipped {} duplicates and {} invalid records.'.format(
+        inserted, skipped, len(invalid)), err=True)
+
+
+@minerva.command('export')
+@click.argument('path', type=click.Path(dir_okay=False, writable=True, allow_dash=True))
+@click.option('--format', 'fmt', type=click.Choice(FORMATS),
+              help='The file format, guessed from the extension by default.')
+@click.pass_obj
+def export_books(db_path, path, fmt):
+    """Export all books to a CSV, JSON Lines or ISBN list file."""
+    fmt     = _guess_format(path, fmt)
+    library = core.open_library(db_path)
+    with click.open_file(path, 'w', encoding='utf-8') as f:
+        WRITERS[fmt](f, library.rows(), library.model.Book.COLUMNS)
+
+
+@minerva.command('duplicates')
+@click.option('--threshold', type=click.FloatRange(0, 1), default=0.85,
+              help='The similarity from which books are reported (0 to 1).')
+@click.option('--json', 'as_json', is_flag=True,
+              help='Print one JSON array of books per group.')
+@click.pass_obj
+def find_duplicates(db_path, threshold, as_json):
+    """List groups of books that are probably stored more than once, e.g. with an
+    ISBN-10 and an ISBN-13 or with differently written authors."""
+    import dedupe
+    library = core.open_library(db_path)
+    groups  = dedupe.group(dedupe.scan(library.engine, threshold), threshold)
+    for books in groups:
+        if as_json:
+            click.echo(json.dumps([{'isbn': b.isbn, 'title': b.title, 'author': b.author}
+                                   for b in books]))
+        else:
+            for b in books:
+                click.echo('{:<14} {} ({})'.format(b.isbn or '-', b.title, b.author))
+            click.echo()
+    click.echo('Found {} groups of possible duplicates.'.format(len(groups)), err=True)
+
+
+@minerva.command('enrich')
+@click.option('--provider', 'providers', default='openlibrary',
+              help='The providers to ask, comma separated (e.g. catalog,openlibrary).')
+@click.option('--catalog', 'catalog_path', type=click.Path(dir_okay=False),
+              help='The catalog of the catalog provider.')
+@click.option('--restart', is_flag=True,
+              help='Start from the first book instead of where the last run stopped.')
+@click.option('--workers', type=click.IntRange(1, 32), default=4,
+              help='The number of concurrent lookups.')
+@click.pass_obj
+def enrich_books(db_path, providers, catalog_path, restart, workers):
+    """Fill in missing ISBNs and normalize authors of the whole library by looking
+    the books up. Progress is saved after every batch, an interrupted run resumes
+    where it stopped."""
+    import enrich
+    from fanout import create_providers
+    from provider import PROVIDERS
+    names   = [n.strip() for n in providers.split(',') if n.strip()]
+    unknown = [n for n in names if n not in PROVIDERS]
+    if not names or unknown:
+        log_error('Unknown providers: {} (available: {})'.format(
+            ', '.join(unknown), ', '.join(sorted(PROVIDERS))))
+    settings = {'catalog': {'path': catalog_path}} if catalog_path else None
+    library  = core.open_library(db_path)
+    if restart:
+        enrich.reset(library.engine)
+    total    = len(library)
+    enricher = enrich.Enricher(library.engine, create_providers(names, settings=settings),
+                               workers=workers)
+    with click.progressbar(length=total, label='Enriching', file=sys.stderr) as bar:
+        done = library.engine.execute('SELECT count(*) FROM book WHERE rowid <= ?',
+                                      enrich.position(library.engine)).scalar()
+        bar.update(done)
+
+        def progress(rowid):
+            bar.update(min(enricher.batch_size, total - bar.pos))
+        enricher.on_progress = progress
+        try:
+            if not enricher.run() and enricher.error is not None:
+                click.echo('\nStopped: {}; run again to resume.'.format(enricher.error),
+                           err=True)
+        except KeyboardInterrupt:
+            click.echo('\nStopped, run again to resume.', err=True)
+    click.echo('Completed {} books.'.format(enricher.changed), err=True)
+
+
+@minerva.command('serve')
+@click.option('--host', default='127.0.0.1', show_default=True,
+              help='The address to listen on, 0.0.0.0 for the whole network.')
+@click.option('--port', type=click.IntRange(1, 65535), default=8080, show_default=True)
+@click.option('--pool', 'pool_size', type=click.IntRange(1, 64), default=4,
+              show_default=True, help='The number of read-only database connections.')
+@click.pass_obj
+def serve(db_path, host, port, pool_size):
+    """Serve the library as a read-only JSON API (see `server`), e.g.
+    GET /books/<isbn>, /books, /books.jsonl, /search?q= and /facets."""
+    import server
+    library = core.open_library(db_path)  # upgrades the schema before going read-only
+    library.engine.dispose()
+    click.echo('Serving {} on http://{}:{}/'.format(library.path, host, port), err=True)
+    server.serve(library.path, host, port, pool_size)
+
+
+@minerva.command('catalog')
+@click.argument('dumps', nargs=-1, required=True,
+                type=click.Path(exists=True, dir_okay=False))
+@click.option('--catalog', 'catalog_path', type=click.Path(dir_okay=False),
+              help='The catalog to build, ~/.cache/minerva/catalog.sqlite by default.')
+def build_catalog(dumps, catalog_path):
+    """Import Open Library bulk dumps (editions, works and authors, gzipped) into
+    the local catalog, which the 'catalog' provider searches without network
+    access. Import the authors and works dumps as well to know every author."""
+    import catalog
+    for path in dumps:
+        with click.progressbar(length=os.path.getsize(path), file=sys.stderr,
+                               label='Importing ' + os.path.basename(path)) as bar:
+            def progress(position, bar=bar):
+                bar.update(position - bar.pos)
+            counts = catalog.import_dump(path, catalog_path or catalog.DEFAULT_PATH,
+                                         progress, index=path == dumps[-1])
+        click.echo('Imported {edition} editions, {work} works and {author} '
+                   'authors.'.format(**counts), err=True)
+
+
+if __name__ == '__main__':
+    minerva()
@@ -0,0 +1,31 @@
+"""
+The library logic without the GUI, for scripts and the command line.
+
+Heavy dependencies (SQLAlchemy, requests, isbnlib) are only imported once the part
+of the API needing them is first used, so `import core` itself is cheap.
+"""
+import importlib
+
+_EXPORTS = {
+    'Library':          'core.library',
+    'open_library':     'core.library',
+    'search':           'core.search',
+    'lookup_isbn':      'core.providers',
+    'lookup_isbns':     'core.providers',
+    'search_books':     'core.providers',
+}
+
+__all__ = sorted(_EXPORTS)
+
+
+def __getattr__(name):
+    module = _EXPORTS.get(name)
+    if module is None:
+        raise AttributeError("module 'core' has no attribute '{}'".format(name))
+    value = getattr(importlib.import_module(module), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return __all__
@@ -0,0 +1,71 @@
+"""
+Access to a library database.
+"""
+
+
+class Library(object):
+    """A book collection stored in an SQLite database.
+    Opening a library upgrades its schema, see `migrations`."""
+
+    def __init__(self, path):
+        """Initializes the instance.
+        :param str path: The path to the SQLite database.
+        """
+        import model    # SQLAlchemy's declarative machinery is slow to import
+        self.model      = model
+        self.path       = path
+        self.engine     = model.get_engine(path)
+        self._session   = None
+
+    @property
+    def session(self):
+        """An SQLAlchemy session for working with `model.Book` objects."""
+        if self._session is None:
+            from sqlalchemy.orm import sessionmaker
+            self._session = sessionmaker(bind=self.engine)()
+        return self._session
+
+    def __len__(self):
+        from sqlalchemy import func, select
+        return self.engine.execute(
+            select([func.count()]).select_from(self.model.Book.__table__)).scalar()
+
+    def get(self, isbn):
+        """Return the book with the given ISBN, or `None`."""
+        return self.model.Book.exists(isbn, self.session)
+
+    def find(self, author, title):
+        """Return a book by author and title (ignoring case and accents), or `None`."""
+        return self.model.Book.exists_author_title(author, title, self.session)
+
+    def rows(self):
+        """Iterate over all books as rows (see `model.Book.to_list`) without loading
+        them into memory."""
+        from sqlalchemy import select
+        table = self.model.Book.__table__
+        query = select([table.c[c] for c in self.model.Book.COLUMNS])
+        with self.engine.connect() as conn:
+            for row in conn.execution_options(stream_results=True).execute(query):
+                yield row
+
+    def import_rows(self, rows):
+        """Insert books in one transaction, skipping ISBNs that are already stored.
+        :param rows: An iterable of dictionaries with the keys of `model.Book.COLUMNS`.
+        :return: A tuple with the number of inserted and skipped rows."""
+        with self.engine.begin() as conn:
+            return self.model.insert_books(conn, rows)
+
+    def search(self, query, limit=None):
+        """Search the library, see `core.search.search`."""
+        from core.search import search
+        return search(self, query, limit=limit)
+
+
+def open_library(path=None):
+    """Open a library database.
+    :param str path: The database, defaults to the one configured in ~/.libraryrc.
+    :rtype: Library"""
+    if path is None:
+        from utils import read_config_file
+        path = read_config_file()['db_path']
+    return Library(path)
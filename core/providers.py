@@ -0,0 +1,32 @@
+"""
+Looking up book metadata from online providers.
+"""
+_default = None
+
+
+def default_provider():
+    """Return the shared `provider.OpenLibrary` instance, created on first use."""
+    global _default
+    if _default is None:
+        from provider import OpenLibrary
+        _default = OpenLibrary()
+    return _default
+
+
+def lookup_isbn(isbn, provider=None):
+    """Look up a single book, see `provider.OpenLibrary.isbn_search`."""
+    return (provider or default_provider()).isbn_search(isbn)
+
+
+def lookup_isbns(isbns, provider=None):
+    """Look up many books in batches, see `provider.OpenLibrary.isbn_search_many`.
+    :return: A generator of `(isbn, entry or exception)` tuples."""
+    return (provider or default_provider()).isbn_search_many(isbns)
+
+
+def search_books(query, identifier='title', provider=None):
+    """Search books by title or author, see `provider.OpenLibrary.query_pages`.
+    :param str identifier: 'title' or 'author'.
+    :rtype: provider.ResultStream"""
+    from provider import Identifier
+    return (provider or default_provider()).query_pages(query, Identifier(identifier))
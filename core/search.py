@@ -0,0 +1,21 @@
+"""
+Searching a library without keeping it in memory.
+"""
+
+
+def search(library, query, limit=None):
+    """Search the ISBN, title, author and location of all books.
+    Uses the full-text index (matching word prefixes, best matches first) if SQLite
+    supports it, and a substring scan otherwise.
+    :param core.Library library: The library to search.
+    :param str query: The search term.
+    :param int limit: The maximum number of results.
+    :return: A list of ISBNs."""
+    model = library.model
+    if model.has_fts(library.engine):
+        return model.search_fts(library.engine, query, limit=limit)
+
+    from sqlalchemy import select
+    book    = model.Book
+    stmt    = select([book.isbn]).where(book.matching(query)).limit(limit)
+    return [r[0] for r in library.engine.execute(stmt)]
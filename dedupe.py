@@ -0,0 +1,248 @@
+"""
+Finds books that are probably stored twice.
+
+Books are only compared with books sharing a blocking key: their ISBN-13, or an
+author name token combined with a title word. Within a block a string similarity
+of the normalized authors and titles decides; blocks that are too large to compare
+all pairs are sorted by title and only neighbours are compared. Together this
+keeps a scan of the whole library near-linear.
+"""
+import isbnlib
+import json
+from collections import defaultdict, namedtuple
+from difflib import SequenceMatcher
+from utils import fold, log_warning
+
+THRESHOLD       = 0.85  # similarity from which two books are reported
+MAX_BLOCK       = 25    # larger blocks are compared with their neighbours only
+WINDOW          = 10    # neighbours compared in large blocks
+MAX_GROUP       = 20    # larger groups are dropped, they are not one book
+AUTHOR_WEIGHT   = 0.4
+TITLE_WEIGHT    = 0.6
+ISBN_PENALTY    = 0.85  # factor for books with different ISBNs (other editions)
+STOPWORDS       = frozenset(('a', 'an', 'and', 'the', 'of', 'der', 'die', 'das',
+                             'ein', 'eine', 'le', 'la', 'les', 'el', 'il', 'de'))
+
+Candidate = namedtuple('Candidate', 'first second score')
+
+
+def to_isbn13(isbn):
+    """Normalize an ISBN-10 or ISBN-13 (with or without hyphens) to ISBN-13.
+    :return: The ISBN-13, or an empty string if `isbn` is not a valid ISBN."""
+    return isbnlib.to_isbn13(isbn or '') or ''
+
+
+class Record(object):
+    """The normalized form of a book that is compared."""
+    __slots__ = ('key', 'isbn', 'author', 'title', 'isbn13', 'surname', 'words',
+                 'author_text', 'title_text', 'signature')
+
+    def __init__(self, key, isbn, author, title):
+        """Initializes the instance.
+        :param key: Identifies the book, e.g. its rowid.
+        """
+        self.key            = key
+        self.isbn           = isbn
+        self.author         = author
+        self.title          = title
+        self.isbn13         = to_isbn13(isbn)
+        tokens              = sorted(fold(author).split())
+        # Numbers (e.g. years) are not names and must not make initials
+        names               = [t for t in tokens if t.isalpha()]
+        title_tokens        = fold(title).split()
+        self.words          = [w for w in title_tokens if w not in STOPWORDS] or \
+            title_tokens
+        self.author_text    = ' '.join(tokens)
+        self.title_text     = ' '.join(self.words)
+        # The longest name and the initials of the others, so that 'Tolkien, J.R.R.'
+        # and 'John Ronald Reuel Tolkien' are the same author
+        others              = list(names)
+        self.surname        = others.pop(others.index(max(names, key=len))) \
+            if names else ''
+        self.signature      = self.surname + ' ' + ''.join(t[0] for t in others)
+
+    def blocking_keys(self):
+        keys = set()
+        if self.isbn13:
+            keys.add('isbn:' + self.isbn13)
+        if self.surname and self.words:
+            for word in {self.words[0], max(self.words, key=len)}:
+                keys.add('{}:{}'.format(self.surname, word))
+        return sorted(keys)
+
+
+def blocking_keys(isbn, author, title):
+    """The keys books are compared by, as a JSON array (registered as the SQL
+    function `migrations.BLOCKS_FUNCTION`)."""
+    return json.dumps(Record(None, isbn, author, title).blocking_keys())
+
+
+def refresh_blocks(bind):
+    """Store the blocking keys of the books added or changed since the last call,
+    which triggers queue in `book_block_stale` (see `migrations.queue_block_keys`).
+    :param bind: An SQLAlchemy engine, connection or session; a connection's
+    transaction is joined, otherwise the keys are written in their own.
+    :return: The number of books whose keys were stored."""
+    from sqlalchemy import text
+    if hasattr(bind, 'get_bind'):
+        bind = bind.get_bind()
+    if bind.execute(text('SELECT 1 FROM book_block_stale LIMIT 1')).scalar() is None:
+        return 0
+    with bind.begin() as conn:
+        # Write first, so that the queue cannot change until it is emptied
+        conn.execute(text('DELETE FROM book_block WHERE book IN '
+                          '(SELECT book FROM book_block_stale)'))
+        rows = conn.execute(text(
+            'SELECT book.rowid, book.isbn, book.author, book.title '
+            'FROM book_block_stale JOIN book ON book.rowid = book_block_stale.book'
+        )).fetchall()
+        keys = [{'key': key, 'book': row[0]}
+                for row in rows for key in Record(*row).blocking_keys()]
+        if keys:
+            conn.execute(text('INSERT INTO book_block (key, book) VALUES (:key, :book)'),
+                         keys)
+        conn.execute(text('DELETE FROM book_block_stale'))
+    return len(rows)
+
+
+def similarity(a, b, threshold=0.0):
+    """Score how likely two records are the same book, between 0 and 1.
+    :param float threshold: Scores below it may be returned as 0 without comparing
+    the strings."""
+    if a.isbn13 and a.isbn13 == b.isbn13:
+        return 1.0
+    factor = ISBN_PENALTY if a.isbn13 and b.isbn13 else 1.0
+    # The similarity of two strings is at most 2 * min(lengths) / sum(lengths)
+    lengths = len(a.title_text) + len(b.title_text)
+    best = 2 * min(len(a.title_text), len(b.title_text)) / lengths if lengths else 1.0
+    if (AUTHOR_WEIGHT + TITLE_WEIGHT * best) * factor < threshold:
+        return 0.0
+
+    if a.signature == b.signature:
+        author = 1.0
+    else:
+        author = SequenceMatcher(None, a.author_text, b.author_text).ratio()
+    if (AUTHOR_WEIGHT * author + TITLE_WEIGHT * best) * factor < threshold:
+        return 0.0
+    if a.title_text == b.title_text:
+        title = 1.0
+    else:
+        title = SequenceMatcher(None, a.title_text, b.title_text).ratio()
+    return (AUTHOR_WEIGHT * author + TITLE_WEIGHT * title) * factor
+
+
+def _pairs(block):
+    if len(block) <= MAX_BLOCK:
+        for i, a in enumerate(block):
+            for b in block[i + 1:]:
+                yield a, b
+    else:
+        block = sorted(block, key=lambda r: r.title_text)
+        for i, a in enumerate(block):
+            for b in block[i + 1:i + 1 + WINDOW]:
+                yield a, b
+
+
+def find_duplicates(records, threshold=THRESHOLD):
+    """Compare records within their blocks.
+    :param records: An iterable of `Record` objects.
+    :param float threshold: The minimum similarity of reported pairs.
+    :return: A list of `Candidate` pairs, most similar first."""
+    blocks = defaultdict(list)
+    for record in records:
+        for key in record.blocking_keys():
+            blocks[key].append(record)
+
+    seen        = set()
+    candidates  = []
+    for block in blocks.values():
+        for a, b in _pairs(block):
+            pair = (a.key, b.key) if a.key < b.key else (b.key, a.key)
+            if pair in seen:
+                continue
+            seen.add(pair)
+            score = similarity(a, b, threshold)
+            if score >= threshold:
+                candidates.append(Candidate(a, b, score))
+    candidates.sort(key=lambda c: c.score, reverse=True)
+    return candidates
+
+
+def group(candidates, threshold=THRESHOLD, max_size=MAX_GROUP):
+    """Merge candidate pairs into groups of books that are all the same book.
+    Pairs are taken most similar first; a book only joins a group (and two groups
+    are only merged) if it is similar to every book of it, so that A ~ B and B ~ C
+    do not put A and C together if they differ.
+    :param candidates: Candidate pairs as returned by `find_duplicates`.
+    :param float threshold: The minimum similarity of all books in a group.
+    :param int max_size: Larger groups are dropped with a warning.
+    :return: A list of lists of `Record` objects."""
+    scores  = {}
+    for candidate in candidates:
+        scores[frozenset((candidate.first.key, candidate.second.key))] = candidate.score
+
+    def similar(a, b):
+        score = scores.get(frozenset((a.key, b.key)))
+        if score is None:
+            score = scores[frozenset((a.key, b.key))] = similarity(a, b, threshold)
+        return score >= threshold
+
+    groups  = {}    # key -> the list of records of its group
+    for candidate in sorted(candidates, key=lambda c: c.score, reverse=True):
+        first   = groups.get(candidate.first.key, [candidate.first])
+        second  = groups.get(candidate.second.key, [candidate.second])
+        if first is second or \
+                not all(similar(a, b) for a in first for b in second):
+            continue
+        merged = first + second
+        for record in merged:
+            groups[record.key] = merged
+
+    result  = []
+    seen    = set()
+    for members in groups.values():
+        if id(members) in seen:
+            continue
+        seen.add(id(members))
+        if len(members) > max_size:
+            log_warning('Skipped a group of {} similar books, e.g. "{}" by {}'.format(
+                len(members), members[0].title, members[0].author))
+            continue
+        result.append(sorted(members, key=lambda r: r.key))
+    return result
+
+
+def scan(bind, threshold=THRESHOLD):
+    """Find duplicates in the whole library.
+    :param bind: An SQLAlchemy engine, connection or session.
+    :return: See `find_duplicates`, records are keyed by rowid."""
+    from sqlalchemy import text
+    rows = bind.execute(text('SELECT rowid, isbn, author, title FROM book'))
+    return find_duplicates((Record(*row) for row in rows), threshold)
+
+
+def check(bind, isbn, author, title, threshold=THRESHOLD):
+    """Find books in the library that a new book probably duplicates.
+    Only books sharing a blocking key are loaded, via the `book_block` table
+    (brought up to date first, see `refresh_blocks`).
+    :param bind: An SQLAlchemy engine, connection or session.
+    :return: A list of `Candidate` pairs (the new book is `first`, with key
+    `None`), most similar first."""
+    from sqlalchemy import bindparam, text
+    new = Record(None, isbn, author, title)
+    keys = new.blocking_keys()
+    if not keys:
+        return []
+    refresh_blocks(bind)
+    query = text('SELECT DISTINCT book.rowid, book.isbn, book.author, book.title '
+                 'FROM book_block JOIN book ON book.rowid = book_block.book '
+                 'WHERE book_block.key IN :keys'
+                 ).bindparams(bindparam('keys', expanding=True))
+    candidates = []
+    for row in bind.execute(query, {'keys': keys}):
+        record = Record(*row)
+        score = similarity(new, record, threshold)
+        if score >= threshold:
+            candidates.append(Candidate(new, record, score))
+    candidates.sort(key=lambda c: c.score, reverse=True)
+    return candidates
@@ -0,0 +1,286 @@
+"""
+Fills in missing metadata of the books in the library in the background.
+
+Books are read in batches by rowid (keyset pagination, so every batch is an index
+range scan however far the walk got) and looked up through a provider: books with
+a valid ISBN in bulk, books without one by title. Each batch is written in its own
+short transaction together with the position reached, so a walk that is
+interrupted resumes where it stopped and the GUI's autosave is never locked out
+for long. A batch whose lookups failed (e.g. the network is down or the provider
+limits the rate) is retried after a pause and never checkpointed, the walk stops
+after `RETRIES` failed attempts and resumes at that batch.
+"""
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from dedupe import THRESHOLD, Record, similarity, to_isbn13
+from exc import InvalidISBNError, NoResultsError, ProviderError
+from provider import Entry, Identifier
+from sqlalchemy import text
+from utils import log_warning
+
+JOB         = 'enrich'  # the name of the checkpoint, see `migrations.add_jobs`
+BATCH       = 100       # books looked up and written per transaction
+WORKERS     = 4         # concurrent lookups
+RETRIES     = 3         # failed attempts at a batch before the walk stops
+BACKOFF     = 5         # seconds before retrying a failed batch, doubled every time
+COVER_SIZE  = 'M'
+
+# A book that was changed: its rowid, the ISBN it was stored under before and its
+# new row (see `model.Book.to_list`)
+Change = namedtuple('Change', 'rowid stored_isbn row')
+
+
+def position(bind, job=JOB):
+    """Return the rowid a job has reached, 0 if it has not started."""
+    return bind.execute(text('SELECT position FROM job WHERE name = :name'),
+                        {'name': job}).scalar() or 0
+
+
+def reset(bind, job=JOB):
+    """Forget the checkpoint of a job, so that it starts from the first book."""
+    with bind.begin() as conn:
+        conn.execute(text('DELETE FROM job WHERE name = :name'), {'name': job})
+
+
+def improve(book, entry, threshold=THRESHOLD):
+    """Decide which fields of a book a provider's entry fills in or corrects.
+    The ISBN and an empty title are filled in; the author is replaced by the
+    provider's spelling if both name the same person (e.g. 'Tolkien, J.R.R.' and
+    'J. R. R. Tolkien'). Entries describing a different book change nothing.
+    :param Record book: The book as stored.
+    :param provider.Entry entry: What the provider found for it.
+    :return: A dictionary of changed columns, empty if nothing changes."""
+    if entry.author == 'Unknown' or not entry.title:
+        return {}
+    found = Record(None, (entry.isbns or [''])[0], entry.author, entry.title)
+    if not book.isbn13 and (not book.title_text or
+                            similarity(book, found) < threshold):
+        return {}
+
+    changes = {}
+    if not book.isbn13 and found.isbn13:
+        changes['isbn'] = found.isbn13
+    if not book.title.strip():
+        changes['title'] = entry.title
+    if not book.author_text:
+        changes['author'] = entry.author
+    elif book.signature == found.signature and book.author != entry.author:
+        changes['author'] = entry.author
+    return changes
+
+
+class Enricher(object):
+    """Walks the whole library once, see the module documentation.
+    Runs on its own thread with its own database connections; `stop` makes it
+    finish the current batch and keep its checkpoint."""
+
+    def __init__(self, engine, provider, batch_size=BATCH, workers=WORKERS,
+                 on_changed=None, on_covers=None, on_progress=None):
+        """Initializes the instance.
+        :param engine: An SQLAlchemy engine of the library, see `model.get_engine`.
+        :param provider: Looks up the books, e.g. a `provider.OpenLibrary` or a
+        `fanout.FanOut`.
+        :param int batch_size: The number of books per batch and transaction.
+        :param int workers: The number of concurrent lookups.
+        :param on_changed: Called with the list of `Change` tuples of every batch
+        (on the worker thread).
+        :param on_covers: Called with `(isbn, size, url)` tuples of the covers of
+        the found books, e.g. to prefetch them into a `gui.covers.CoverCache`.
+        :param on_progress: Called with the rowid reached after every batch.
+        """
+        self.engine         = engine
+        self.provider       = provider
+        self.batch_size     = batch_size
+        self.workers        = workers
+        self.on_changed     = on_changed
+        self.on_covers      = on_covers
+        self.on_progress    = on_progress
+        self.changed        = 0
+        self.error          = None  # why the last walk stopped early, if it did
+        self._stop          = threading.Event()
+        self._thread        = None
+
+    def start(self):
+        """Run the walk on a daemon thread."""
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run_logged, daemon=True)
+            self._thread.start()
+
+    def stop(self, wait=False):
+        """Stop after the current batch.
+        :param bool wait: Block until the batch is written."""
+        self._stop.set()
+        if wait and self._thread is not None:
+            self._thread.join()
+
+    def _run_logged(self):
+        try:
+            self.run()
+        except Exception as e:
+            log_warning('Enriching the library failed: {}'.format(e))
+        else:
+            if self.error is not None:
+                log_warning('Enriching the library stopped: {}'.format(self.error))
+
+    def run(self):
+        """Walk the library from the checkpoint to the end (or until `stop`).
+        :return: `True` if the end was reached, the checkpoint is then removed;
+        `False` if the walk was stopped or a batch kept failing (see `error`)."""
+        last        = position(self.engine)
+        failures    = 0
+        self.error  = None
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while not self._stop.is_set():
+                rows = self.engine.execute(
+                    text('SELECT rowid, isbn, author, title FROM book '
+                         'WHERE rowid > :last ORDER BY rowid LIMIT :limit'),
+                    {'last': last, 'limit': self.batch_size}).fetchall()
+                if not rows:
+                    reset(self.engine)
+                    return True
+                books           = {row[0]: Record(*row) for row in rows}
+                found, errors   = self._lookup(books, pool)
+                if errors:
+                    # Keep what was found, but look the batch up again
+                    self._write(books, found, None)
+                    failures += 1
+                    if failures > RETRIES:
+                        self.error = errors[0]
+                        return False
+                    self._stop.wait(BACKOFF * 2 ** (failures - 1))
+                    continue
+                failures    = 0
+                last        = rows[-1][0]
+                self._write(books, found, last)
+                if self.on_progress:
+                    self.on_progress(last)
+        return False
+
+    def _lookup(self, books, pool):
+        """Look up a batch of books.
+        :return: A dictionary mapping rowids to the entries found, and the list of
+        `ProviderError`s of the lookups that got no answer."""
+        found   = {}
+        errors  = []
+        by_isbn = {}
+        for rowid, book in books.items():
+            if book.isbn13:
+                by_isbn.setdefault(book.isbn, []).append(rowid)
+        if by_isbn:
+            for isbn, entry in self._search_isbns(list(by_isbn), pool):
+                if isinstance(entry, ProviderError):
+                    errors.append(entry)
+                elif not isinstance(entry, Exception):
+                    for rowid in by_isbn[isbn]:
+                        found[rowid] = entry
+
+        def search_title(rowid):
+            try:
+                return self._search_title(books[rowid]), None
+            except ProviderError as e:
+                return None, e
+
+        without_isbn = [r for r, b in books.items() if not b.isbn13 and b.title_text]
+        for rowid, (entry, error) in zip(without_isbn,
+                                         pool.map(search_title, without_isbn)):
+            if error is not None:
+                errors.append(error)
+            elif entry is not None:
+                found[rowid] = entry
+        return found, errors
+
+    def _search_isbns(self, isbns, pool):
+        """Look up ISBNs in bulk if the provider can, one by one otherwise.
+        :return: An iterable of `(isbn, entry or exception)` tuples."""
+        if hasattr(self.provider, 'isbn_search_many'):
+            return self.provider.isbn_search_many(isbns, max_workers=self.workers)
+
+        def search(isbn):
+            try:
+                return isbn, self.provider.isbn_search(isbn)
+            except (InvalidISBNError, NoResultsError, ProviderError) as e:
+                return isbn, e
+        return pool.map(search, isbns)
+
+    def _search_title(self, book):
+        """Find a book without ISBN by its title, see `improve`.
+        :return: The most similar result, or `None`.
+        :raises minerva.exc.ProviderError: If the provider could not answer."""
+        try:
+            results = self.provider.query_search(book.title, Identifier.TITLE).results
+        except (InvalidISBNError, NoResultsError):
+            return None
+        scored = [(similarity(book, Record(None, (e.isbns or [''])[0], e.author,
+                                           e.title)), i)
+                  for i, e in enumerate(results) if e.isbns]
+        if not scored:
+            return None
+        score, index = max(scored)
+        return results[index] if score >= THRESHOLD else None
+
+    def _write(self, books, found, last):
+        """Store the improvements of a batch and the checkpoint in one transaction.
+        A book is only updated if it still has the values it was read with, edits
+        made in the meantime (e.g. by the GUI) win.
+        :param int last: The rowid reached, `None` to keep the checkpoint."""
+        changes = []
+        covers  = []
+        update  = text('UPDATE book SET isbn = :isbn, title = :title, author = :author '
+                       'WHERE rowid = :rowid AND isbn = :old_isbn '
+                       'AND title = :old_title AND author = :old_author')
+        with self.engine.begin() as conn:
+            for rowid, entry in found.items():
+                book    = books[rowid]
+                values  = improve(book, entry)
+                isbn    = values.get('isbn', book.isbn)
+                if to_isbn13(isbn):
+                    covers.append((isbn, COVER_SIZE, self.provider.get_cover(
+                        _with_isbn(entry, isbn), COVER_SIZE)))
+                if not values:
+                    continue
+                if 'isbn' in values and conn.execute(
+                        text('SELECT 1 FROM book WHERE isbn = :isbn'),
+                        {'isbn': isbn}).scalar():
+                    del values['isbn']  # the found edition is in the library already
+                    if not values:
+                        continue
+                params = {'rowid': rowid, 'old_isbn': book.isbn,
+                          'old_title': book.title, 'old_author': book.author,
+                          'isbn': book.isbn, 'title': book.title, 'author': book.author}
+                params.update(values)
+                if conn.execute(update, params).rowcount:
+                    changes.append((rowid, book.isbn))
+            if last is not None:
+                conn.execute(text('INSERT OR REPLACE INTO job (name, position, updated) '
+                                  "VALUES (:name, :position, strftime('%s', 'now'))"),
+                             {'name': JOB, 'position': last})
+            rows = _rows(conn, [rowid for rowid, _ in changes])
+
+        self.changed += len(changes)
+        if changes and self.on_changed:
+            self.on_changed([Change(rowid, stored, rows[rowid])
+                             for rowid, stored in changes])
+        if covers and self.on_covers:
+            self.on_covers(covers)
+
+
+def _with_isbn(entry, isbn):
+    """The entry of a found book as `get_cover` expects it."""
+    if entry.isbns and entry.isbns[0] == isbn:
+        return entry
+    return Entry(isbns=[isbn], title=entry.title, author=entry.author,
+                 covers=entry.covers)
+
+
+def _rows(conn, rowids):
+    """Read books as rows (see `model.Book.to_list`), keyed by rowid."""
+    if not rowids:
+        return {}
+    from sqlalchemy import bindparam
+    query = text('SELECT rowid, isbn, title, author, own, want, read, location '
+                 'FROM book WHERE rowid IN :rowids'
+                 ).bindparams(bindparam('rowids', expanding=True))
+    return {r[0]: [r[1], r[2], r[3], bool(r[4]), bool(r[5]), bool(r[6]), r[7]]
+            for r in conn.execute(query, {'rowids': rowids})}
@@ -6,3 +6,8 @@ class InvalidISBNError(Exception):
 class NoResultsError(Exception):
     def __init__(self, ex):
         super(NoResultsError, self).__init__(ex)
+
+
+class ProviderError(Exception):
+    def __init__(self, ex):
+        super(ProviderError, self).__init__(ex)
@@ -0,0 +1,183 @@
+"""
+Sidebar filters (own, want, read and location) kept as bitsets over rowids.
+"""
+from model import Book
+from sqlalchemy import func, literal_column, select
+
+ALL         = 'all'
+FLAGS       = ('own', 'want', 'read')
+COLUMNS     = {'own': 3, 'want': 4, 'read': 5}     # see `model.Book.to_list`
+LOCATION    = 6
+PREFIX      = 'location:'
+
+# The positions of the set bits of every byte value
+_OFFSETS = [tuple(i for i in range(8) if b >> i & 1) for b in range(256)]
+
+
+def location_facet(location):
+    return PREFIX + location
+
+
+def popcount(bits):
+    try:
+        return bits.bit_count()
+    except AttributeError:  # Python < 3.10
+        return bin(bits).count('1')
+
+
+def to_bits(keys):
+    """Turn integer keys into a bitset in time linear in their number."""
+    keys = list(keys)
+    if not keys:
+        return 0
+    data = bytearray(max(keys) // 8 + 1)
+    for key in keys:
+        data[key >> 3] |= 1 << (key & 7)
+    return int.from_bytes(data, 'little')
+
+
+def from_bits(bits):
+    """Return the keys of a bitset in ascending order."""
+    data = bits.to_bytes((bits.bit_length() + 7) // 8, 'little')
+    keys = []
+    for index, byte in enumerate(data):
+        if byte:
+            base = index * 8
+            keys.extend([base + offset for offset in _OFFSETS[byte]])
+    return keys
+
+
+class Facets(object):
+    """The own, want and read flags and the location of every book, as one integer
+    bitset per flag or location with bit `rowid` set for matching books.
+    Selecting a facet, intersecting it with search results and counting the books
+    of every facet only take a few big integer operations, whatever the size of the
+    library. Facets are named 'all', 'own', 'want', 'read' or 'location:<name>'."""
+
+    def __init__(self):
+        self.all        = 0
+        self.flags      = dict.fromkeys(FLAGS, 0)
+        self.locations  = {}    # location -> bitset
+        self._location  = {}    # rowid -> location
+
+    def __len__(self):
+        return len(self._location)
+
+    @classmethod
+    def from_db(cls, bind):
+        """Load the flags and locations of all books.
+        :param bind: An SQLAlchemy engine or connection (see `SearchIndex.from_db`).
+        :return: The facets, keyed by the books' rowids."""
+        table   = Book.__table__
+        rowid   = literal_column('book.rowid')
+        size    = (bind.execute(select([func.max(rowid)]).select_from(table)).scalar()
+                   or 0) // 8 + 1
+        flags   = {name: bytearray(size) for name in FLAGS}
+        places  = {}
+        facets  = cls()
+        query   = select([rowid, table.c.own, table.c.want, table.c.read,
+                          table.c.location])
+        for key, own, want, read, location in bind.execute(query):
+            byte, bit = key >> 3, 1 << (key & 7)
+            if own:
+                flags['own'][byte] |= bit
+            if want:
+                flags['want'][byte] |= bit
+            if read:
+                flags['read'][byte] |= bit
+            if location:
+                data = places.get(location)
+                if data is None:
+                    data = places[location] = bytearray(size)
+                data[byte] |= bit
+            facets._location[key] = location or None
+
+        facets.all = to_bits(facets._location)
+        facets.flags = {name: int.from_bytes(data, 'little')
+                        for name, data in flags.items()}
+        facets.locations = {name: int.from_bytes(data, 'little')
+                            for name, data in places.items()}
+        return facets
+
+    def add(self, key, row):
+        """Add a book from a row as returned by `model.Book.to_list`, replacing it
+        if the key is already known."""
+        if key in self._location:
+            self.remove(key)
+        bit = 1 << key
+        self.all |= bit
+        for name in FLAGS:
+            if row[COLUMNS[name]]:
+                self.flags[name] |= bit
+        location = row[LOCATION] or None
+        if location:
+            self.locations[location] = self.locations.get(location, 0) | bit
+        self._location[key] = location
+
+    update = add
+
+    def remove(self, key):
+        """Remove a book, unknown keys are ignored."""
+        if key not in self._location:
+            return
+        mask = ~(1 << key)
+        self.all &= mask
+        for name in FLAGS:
+            self.flags[name] &= mask
+        location = self._location.pop(key)
+        if location:
+            bits = self.locations[location] & mask
+            if bits:
+                self.locations[location] = bits
+            else:
+                del self.locations[location]
+
+    def bits(self, facet):
+        """Return the bitset of a facet (empty for unknown facets)."""
+        if facet == ALL:
+            return self.all
+        if facet in self.flags:
+            return self.flags[facet]
+        if facet.startswith(PREFIX):
+            return self.locations.get(facet[len(PREFIX):], 0)
+        return 0
+
+    def counts(self, within=None):
+        """Count the books of every facet.
+        :param int within: Only count books in this bitset (e.g. search results).
+        :return: A dictionary mapping facets to counts."""
+        facets = dict(self.flags, **{location_facet(location): bits
+                                     for location, bits in self.locations.items()})
+        facets[ALL] = self.all
+        if within is not None:
+            return {facet: popcount(bits & within) for facet, bits in facets.items()}
+        return {facet: popcount(bits) for facet, bits in facets.items()}
+
+    def select(self, facet, keys=None, within=None):
+        """Restrict search results to a facet.
+        :param keys: The search results: `None` for all books, a set of keys, or a
+        list of keys whose order is kept (ranked results).
+        :param int within: `to_bits(keys)` if it has been computed already.
+        :return: The matching keys as a list, in ascending order unless `keys` is
+        a list."""
+        bits = self.bits(facet)
+        if keys is None:
+            return from_bits(bits)
+        if isinstance(keys, list):
+            mask = bits.to_bytes((bits.bit_length() + 7) // 8, 'little')
+            size = len(mask) * 8
+            return [k for k in keys if k < size and mask[k >> 3] >> (k & 7) & 1]
+        if within is None:
+            within = to_bits(keys)
+        return from_bits(bits & within)
+
+    @staticmethod
+    def clause(facet):
+        """A SQL expression selecting the books of a facet, e.g. while the bitsets
+        are being loaded.
+        :return: The expression, or `None` for all books."""
+        if facet in FLAGS:
+            return getattr(Book, facet).is_(True)
+        if facet.startswith(PREFIX):
+            return Book.location == facet[len(PREFIX):]
+        return None
@@ -0,0 +1,509 @@
+"""
+Queries several providers at once and merges their answers.
+"""
+import catalog  # noqa: F401 (registers the 'catalog' provider)
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dedupe import to_isbn13
+from exc import InvalidISBNError, NoResultsError, ProviderError
+from provider import PROVIDERS, Result, create_provider
+from utils import fold
+
+BUDGET          = 3.0   # seconds a search may take in total
+TIMEOUT         = 5.0   # seconds a single provider may take
+FAILURES        = 3     # failures in a row that open a circuit breaker
+IN_FLIGHT       = 2     # calls a provider may have running before it is skipped
+FALLBACK_CHUNK  = 500   # ISBNs looked up locally before the misses are sent out
+RESET_AFTER     = 60    # seconds until an open circuit breaker lets a request through
+
+
+class CircuitBreaker(object):
+    """Stops sending requests to a provider that keeps failing.
+    After `failures` failures in a row the breaker opens and `allow` returns
+    `False`; after `reset_after` seconds one trial request is let through, which
+    closes the breaker again if it succeeds."""
+
+    def __init__(self, failures=FAILURES, reset_after=RESET_AFTER):
+        self.failures       = failures
+        self.reset_after    = reset_after
+        self._count         = 0
+        self._opened        = None
+        self._trial         = False
+        self._lock          = threading.Lock()
+
+    @property
+    def open(self):
+        return self._opened is not None
+
+    def allow(self):
+        """Whether a request may be sent now."""
+        with self._lock:
+            if self._opened is None:
+                return True
+            if not self._trial and time.monotonic() - self._opened >= self.reset_after:
+                self._trial = True
+                return True
+            return False
+
+    def record(self, success):
+        """Record the outcome of a request."""
+        with self._lock:
+            self._trial = False
+            if success:
+                self._count  = 0
+                self._opened = None
+            else:
+                self._count += 1
+                if self._count >= self.failures:
+                    self._opened = time.monotonic()
+
+
+def sufficient(entry):
+    """Whether an entry is good enough to stop waiting for other providers."""
+    return bool(entry.isbns and entry.title and entry.author and
+                entry.author != 'Unknown')
+
+
+def _key(entry):
+    if entry.isbns:
+        return entry.isbns[0]
+    return fold(entry.author) + '\n' + fold(entry.title)
+
+
+def merge(entries):
+    """Merge entries describing the same book (by ISBN, or by author and title).
+    Earlier entries win, later ones only fill in missing ISBNs and covers.
+    :return: The merged entries in order of their first appearance."""
+    merged = {}
+    for entry in entries:
+        known = merged.get(_key(entry))
+        if known is None:
+            merged[_key(entry)] = entry
+            continue
+        for isbn in entry.isbns or ():
+            if isbn not in known.isbns:
+                known.isbns.append(isbn)
+        if not known.covers:
+            known.covers = entry.covers
+        if known.author == 'Unknown':
+            known.author = entry.author
+    return list(merged.values())
+
+
+class FanOut(object):
+    """Sends every search to several providers concurrently.
+    An ISBN search returns the first sufficient answer; a query search merges the
+    results all providers returned within the latency budget. Each provider also
+    has its own timeout, its own threads and a `CircuitBreaker`, so a slow or
+    broken provider neither stalls a search, nor takes threads away from the other
+    providers, nor keeps being asked. A call missing its timeout counts as a
+    failure as soon as the timeout has passed, and a provider with `in_flight`
+    calls still running is skipped. Has the interface of `provider.OpenLibrary`
+    used by the add book dialog."""
+
+    def __init__(self, providers, budget=BUDGET, timeout=TIMEOUT, timeouts=None,
+                 in_flight=IN_FLIGHT):
+        """Initializes the instance.
+        :param providers: The providers, most trusted first. The first provider
+        offering `query_pages` pages through query results.
+        :param float budget: Seconds a search may take in total.
+        :param float timeout: Seconds a single provider may take, also passed on
+        to the providers' HTTP requests.
+        :param dict timeouts: Overrides `timeout` per provider name.
+        :param int in_flight: The number of calls a provider may have running.
+        """
+        self.providers  = list(providers)
+        self.budget     = budget
+        self.in_flight  = in_flight
+        self.timeouts   = {p: (timeouts or {}).get(p.NAME, timeout)
+                           for p in self.providers}
+        for p in self.providers:
+            if hasattr(p, 'timeout'):
+                p.timeout = self.timeouts[p]
+        self.breakers   = {p: CircuitBreaker() for p in self.providers}
+        self._executors = {p: ThreadPoolExecutor(max_workers=in_flight)
+                           for p in self.providers}
+        self._running   = {p: {} for p in self.providers}  # future -> deadline
+        self._judged    = set()     # futures whose outcome the breaker has seen
+        self._lock      = threading.Lock()
+        # Waits for the providers that cannot page, see `query_pages`
+        self._collector = ThreadPoolExecutor(max_workers=1)
+
+    @classmethod
+    def from_names(cls, names, budget=BUDGET, timeouts=None, **kwargs):
+        """Create the registered providers with the given names.
+        :param kwargs: Passed on to every provider, e.g. `cache`."""
+        return cls([create_provider(name, **kwargs) for name in names],
+                   budget=budget, timeouts=timeouts)
+
+    def _submit(self, call, providers=None):
+        """Call `call(provider)` for every provider whose breaker is closed and
+        that has fewer than `in_flight` calls running.
+        :return: A dictionary mapping futures to providers."""
+        futures = {}
+        for p in self.providers if providers is None else providers:
+            self._expire(p)
+            with self._lock:
+                if len(self._running[p]) >= self.in_flight:
+                    continue
+            if not self.breakers[p].allow():
+                continue
+            future = self._executors[p].submit(call, p)
+            with self._lock:
+                self._running[p][future] = time.monotonic() + self.timeouts[p]
+            future.add_done_callback(self._recorder(p))
+            futures[future] = p
+        return futures
+
+    def _expire(self, provider):
+        """Count the calls of a provider that are past their timeout as failures,
+        without waiting for them to return."""
+        now = time.monotonic()
+        with self._lock:
+            late = [f for f, deadline in self._running[provider].items()
+                    if deadline <= now and f not in self._judged]
+            self._judged.update(late)
+        for _ in late:
+            self.breakers[provider].record(False)
+
+    def _recorder(self, provider):
+        """Update the breaker once a call returns, unless it missed its timeout
+        and was counted as a failure already."""
+        def record(future):
+            with self._lock:
+                deadline = self._running[provider].pop(future, None)
+                judged   = future in self._judged
+                self._judged.discard(future)
+            if judged:
+                return
+            error = future.exception()
+            late  = deadline is not None and time.monotonic() > deadline
+            # Not finding anything is a valid answer
+            self.breakers[provider].record(
+                not late and (error is None or isinstance(error, NoResultsError)))
+        return record
+
+    def _as_completed(self, futures, budget):
+        """Yield `(provider, future, error)` in order of completion. `error` is
+        `None` if the call returned (see the future), a `ProviderError` if the
+        provider missed its timeout or the budget."""
+        start       = time.monotonic()
+        pending     = dict(futures)
+        deadlines   = {f: start + min(self.timeouts[p], budget)
+                       for f, p in pending.items()}
+        while pending:
+            timeout = max(0, min(deadlines[f] for f in pending) - time.monotonic())
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future, None
+            now = time.monotonic()
+            for future in [f for f in pending if deadlines[f] <= now]:
+                provider = pending.pop(future)
+                self._expire(provider)
+                yield provider, future, ProviderError('{} did not answer in time'.format(
+                    provider.NAME))
+
+    @staticmethod
+    def _raise(errors, message):
+        """Raise `NoResultsError` if a provider answered that it has no result,
+        `ProviderError` if no provider answered at all."""
+        if any(isinstance(e, NoResultsError) for e in errors):
+            raise NoResultsError(message)
+        raise ProviderError('; '.join(str(e) for e in errors) or
+                            'No provider is available')
+
+    def isbn_search(self, isbn):
+        """Search for a book by its ISBN number, see `OpenLibrary.isbn_search`.
+        Returns as soon as a provider has a sufficient answer, otherwise the merged
+        partial answers that arrived within the budget."""
+        if not to_isbn13(isbn):
+            raise InvalidISBNError(isbn + ' is not a valid ISBN number.')
+        errors  = []
+        partial = []
+        for provider, future, late in self._as_completed(
+                self._submit(lambda p: p.isbn_search(isbn)), self.budget):
+            error = late or future.exception()
+            if error is not None:
+                errors.append(error)
+                continue
+            entry = future.result()
+            if sufficient(entry):
+                return entry
+            partial.append(entry)
+        if partial:
+            return merge(partial)[0]
+        self._raise(errors, 'No book was found with the ISBN ' + isbn)
+
+    def _query_all(self, query, identifier, providers, budget):
+        """Run `query_search` on the given providers.
+        :return: The found entries (in provider order) and the errors."""
+        futures = self._submit(lambda p: p.query_search(query, identifier), providers)
+        results = {}
+        errors  = []
+        for provider, future, late in self._as_completed(futures, budget):
+            error = late or future.exception()
+            if error is not None:
+                errors.append(error)
+            elif not future.result().results:
+                errors.append(NoResultsError('{} found nothing'.format(provider.NAME)))
+            else:
+                results[provider] = future.result().results
+        entries = [e for p in self.providers for e in results.get(p, ())]
+        return entries, errors
+
+    def query_search(self, query, identifier):
+        """Search all providers, see `OpenLibrary.query_search`.
+        :return: The merged results that arrived within the budget.
+        :rtype: provider.Result"""
+        entries, errors = self._query_all(query, identifier, None, self.budget)
+        if not entries:
+            self._raise(errors, 'No book was found with the {} {}'.format(
+                identifier.value, query))
+        results = merge(entries)
+        return Result(start=0, num_found=len(results), page=0, results=results)
+
+    def query_pages(self, query, identifier):
+        """Search all providers and page through the results of the first one that
+        supports paging, see `OpenLibrary.query_pages`.
+        :rtype: MergedStream"""
+        pager = next((p for p in self.providers if hasattr(p, 'query_pages') and
+                      self.breakers[p].allow()), None)
+        others = [p for p in self.providers if p is not pager]
+        extra = self._collector.submit(self._query_all, query, identifier, others,
+                                       self.budget)
+        if pager is None:
+            return MergedStream(None, extra,
+                                describe='the {} {}'.format(identifier.value, query))
+        return MergedStream(pager.query_pages(query, identifier), extra,
+                            self.breakers[pager], timeout=self.timeouts[pager],
+                            budget=self.budget, name=pager.NAME,
+                            describe='the {} {}'.format(identifier.value, query))
+
+    def isbn_search_many(self, isbns, **kwargs):
+        """Look up many ISBNs with the first provider supporting it, see
+        `OpenLibrary.isbn_search_many`."""
+        for p in self.providers:
+            if hasattr(p, 'isbn_search_many'):
+                return p.isbn_search_many(isbns, **kwargs)
+        return ((isbn, self._result_or_error(isbn)) for isbn in isbns)
+
+    def _result_or_error(self, isbn):
+        try:
+            return self.isbn_search(isbn)
+        except (InvalidISBNError, NoResultsError, ProviderError) as e:
+            return e
+
+    def get_cover(self, entry, size='M'):
+        """Retrieve the URL for the cover of the given entry, see
+        `OpenLibrary.get_cover`."""
+        for p in self.providers:
+            if hasattr(p, 'get_cover'):
+                return p.get_cover(entry, size)
+
+
+class Fallback(object):
+    """Asks local providers first and the web providers only for what they do not
+    know. Has the interface of `provider.OpenLibrary` used by the add book dialog."""
+
+    def __init__(self, local, remote):
+        """Initializes the instance.
+        :param local: The local providers (e.g. `catalog.Catalog`), asked in order.
+        :param remote: The provider asked last, e.g. a `FanOut`.
+        """
+        self.local  = list(local)
+        self.remote = remote
+
+    def isbn_search(self, isbn):
+        """Search for a book by its ISBN number, see `OpenLibrary.isbn_search`."""
+        for p in self.local:
+            try:
+                return p.isbn_search(isbn)
+            except NoResultsError:
+                pass
+        return self.remote.isbn_search(isbn)
+
+    def isbn_search_many(self, isbns, **kwargs):
+        """Look up many ISBNs, see `OpenLibrary.isbn_search_many`. The input is
+        consumed in chunks; the misses of each chunk are looked up together."""
+        chunk = []
+        for isbn in isbns:
+            chunk.append(isbn)
+            if len(chunk) == FALLBACK_CHUNK:
+                yield from self._isbn_chunk(chunk, kwargs)
+                chunk = []
+        if chunk:
+            yield from self._isbn_chunk(chunk, kwargs)
+
+    def _isbn_chunk(self, isbns, kwargs):
+        missing = deque(isbns)
+        for p in self.local:
+            pending, missing = missing, deque()
+            for isbn, result in p.isbn_search_many(pending):
+                if isinstance(result, NoResultsError):
+                    missing.append(isbn)
+                else:
+                    yield isbn, result
+        if missing:
+            yield from self.remote.isbn_search_many(missing, **kwargs)
+
+    def query_search(self, query, identifier):
+        """Search for books by title or author, see `OpenLibrary.query_search`."""
+        for p in self.local:
+            try:
+                return p.query_search(query, identifier)
+            except NoResultsError:
+                pass
+        return self.remote.query_search(query, identifier)
+
+    def query_pages(self, query, identifier):
+        """Page through the results of the first provider that has any, see
+        `OpenLibrary.query_pages`. The first page a local provider fetched to
+        tell is the first page of its stream."""
+        for p in self.local:
+            stream = p.query_pages(query, identifier)
+            try:
+                found = stream.has_next()
+            except Exception:
+                stream.close()
+                raise
+            if found:
+                return stream
+            stream.close()
+        return self.remote.query_pages(query, identifier)
+
+    def get_cover(self, entry, size='M'):
+        """Retrieve the URL for the cover of the given entry, see
+        `OpenLibrary.get_cover`."""
+        for p in self.local + [self.remote]:
+            if hasattr(p, 'get_cover'):
+                return p.get_cover(entry, size)
+
+
+def create_providers(names, budget=BUDGET, settings=None, **kwargs):
+    """Create the providers listed in the config file.
+    :param names: Names of registered providers, see `provider.register`.
+    :param dict settings: Maps provider names to extra arguments, e.g.
+    `{'catalog': {'path': ...}}`.
+    :param kwargs: Passed on to every provider, e.g. `cache`.
+    :return: The provider if there is only one, a `FanOut` over the web providers
+    otherwise, behind a `Fallback` if there are local providers."""
+    def create(name):
+        return create_provider(name, **dict(kwargs, **(settings or {}).get(name, {})))
+
+    local   = [create(n) for n in names if getattr(PROVIDERS[n], 'LOCAL', False)]
+    remote  = [create(n) for n in names if not getattr(PROVIDERS[n], 'LOCAL', False)]
+    if len(local) + len(remote) == 1:
+        return (local + remote)[0]
+    if not remote:
+        return Fallback(local[:-1], local[-1])
+    remote = remote[0] if len(remote) == 1 else FanOut(remote, budget=budget)
+    return Fallback(local, remote) if local else remote
+
+
+class MergedStream(object):
+    """A `provider.ResultStream` whose first page also holds the results of the
+    providers that cannot page (deduplicated, see `merge`)."""
+
+    def __init__(self, primary, extra, breaker=None, timeout=None, budget=None,
+                 name='', describe=''):
+        """Initializes the instance.
+        :param provider.ResultStream primary: Pages through the main results, may
+        be `None`.
+        :param concurrent.futures.Future extra: Gives the entries and errors of the
+        other providers, see `FanOut._query_all`.
+        :param CircuitBreaker breaker: The breaker of the primary provider.
+        :param float timeout: Seconds the primary provider may take for a page.
+        :param float budget: Seconds the first page may take in total, from now.
+        :param str name: The primary provider's name, for error messages.
+        """
+        self.num_found  = None
+        self.page       = 0
+        self._primary   = primary
+        self._extra     = extra
+        self._breaker   = breaker
+        self._timeout   = timeout
+        self._deadline  = None if timeout is None else \
+            time.monotonic() + min(timeout, budget if budget is not None else timeout)
+        self._name      = name
+        self._describe  = describe
+        self._seen      = set()
+
+    @property
+    def exhausted(self):
+        return self.page > 0 and (self._primary is None or self._primary.exhausted)
+
+    def _next_primary(self, timeout=None):
+        """The next page of the primary provider.
+        :param float timeout: Seconds to wait for it, a page missing it counts as
+        a failure of the provider."""
+        if not self._primary.wait_next(timeout):
+            self._primary.close()
+            if self._breaker is not None:
+                self._breaker.record(False)
+            raise ProviderError('{} did not answer in time'.format(self._name))
+        try:
+            result = self._primary.next_page()
+        except NoResultsError:
+            raise
+        except Exception:
+            if self._breaker is not None:
+                self._breaker.record(False)
+            raise
+        if self._breaker is not None:
+            self._breaker.record(True)
+        return result
+
+    def next_page(self):
+        """Return the next page, see `provider.ResultStream.next_page`."""
+        if self.page > 0:
+            if self.exhausted:
+                return None
+            result = self._next_primary(self._timeout)
+            if result is None:
+                return None
+            result.results = self._unseen(result.results)
+            self.page += 1
+            return result
+
+        result, error = None, None
+        if self._primary is not None:
+            timeout = None if self._deadline is None else \
+                max(0, self._deadline - time.monotonic())
+            try:
+                result = self._next_primary(timeout)
+            except (NoResultsError, ProviderError) as e:
+                error = e
+                self._primary = None
+        entries, errors = self._extra.result()
+        if error is not None:
+            errors.append(error)
+        merged = self._unseen((result.results if result else []) + entries)
+        self.page += 1
+        if not merged:
+            self.close()
+            if errors and not any(isinstance(e, NoResultsError) for e in errors):
+                raise ProviderError('; '.join(str(e) for e in errors))
+            raise NoResultsError('No book was found with {}'.format(self._describe))
+        # The primary provider's results that have not been paged through yet
+        remaining = result.num_found - len(result.results) if result else 0
+        self.num_found = len(merged) + remaining
+        return Result(start=0, num_found=self.num_found, page=0, results=merged)
+
+    def _unseen(self, entries):
+        entries = [e for e in merge(entries) if _key(e) not in self._seen]
+        self._seen.update(_key(e) for e in entries)
+        return entries
+
+    def __iter__(self):
+        result = self.next_page()
+        while result is not None:
+            for entry in result.results:
+                yield entry
+            result = self.next_page()
+
+    def close(self):
+        if self._primary is not None:
+            self._primary.close()
+            self._primary = None
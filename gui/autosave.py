@@ -0,0 +1,122 @@
+"""
+Keeps track of edited rows and writes them back to the database in the background.
+"""
+from gi.repository import GLib
+
+import instrument
+import model
+import threading
+from utils import log_warning
+
+AUTOSAVE_INTERVAL = 30  # seconds
+
+
+class ChangeTracker(object):
+    """Records which books were modified since they were last saved.
+    Books are keyed by their rowid, which unlike the ISBN does not change when a
+    book is edited."""
+
+    def __init__(self):
+        self._lock      = threading.Lock()
+        self._dirty     = {}    # rowid -> current row
+
+    def __len__(self):
+        return len(self._dirty)
+
+    def mark(self, rowid, row):
+        """Mark a row as modified.
+        :param int rowid: The rowid of the book.
+        :param row: The row after the edit (as returned by `model.Book.to_list`)."""
+        values = list(row)
+        with self._lock:
+            self._dirty[rowid] = values
+
+    def discard(self, rowid):
+        """Forget pending changes of a row, e.g. because it was deleted."""
+        with self._lock:
+            self._dirty.pop(rowid, None)
+
+    def take(self):
+        """Remove and return all pending changes.
+        :return: A dictionary mapping rowids to rows, see `model.save_books`."""
+        with self._lock:
+            changes     = self._dirty
+            self._dirty = {}
+        return changes
+
+    def restore(self, changes):
+        """Put back changes that could not be saved.
+        Rows that were edited again in the meantime keep their newer values."""
+        with self._lock:
+            for rowid, values in changes.items():
+                self._dirty.setdefault(rowid, values)
+
+
+class Autosave(object):
+    """Periodically flushes a `ChangeTracker` to the database.
+    Writing happens on a worker thread with its own session, so saving never
+    blocks the GTK main loop and the cost only depends on the number of edits."""
+
+    def __init__(self, db_path, tracker, interval=AUTOSAVE_INTERVAL, on_saved=None,
+                 on_rejected=None):
+        """Initializes the instance.
+        :param str db_path: The path to the SQLite database.
+        :param ChangeTracker tracker: The tracker to flush.
+        :param int interval: Seconds between two automatic saves.
+        :param on_saved: Called on the main loop with the number of saved rows.
+        :param on_rejected: Called on the main loop with the rows the database
+        refused (see `model.save_books`), they stay marked as modified.
+        """
+        self.tracker        = tracker
+        self.interval       = interval
+        self.on_saved       = on_saved
+        self.on_rejected    = on_rejected
+        self.db         = model.get_db(db_path)
+        self._lock      = threading.Lock()
+        self._source_id = None
+
+    def start(self):
+        if self._source_id is None:
+            self._source_id = GLib.timeout_add_seconds(self.interval, self._on_timeout)
+
+    def stop(self):
+        if self._source_id is not None:
+            GLib.source_remove(self._source_id)
+            self._source_id = None
+
+    def _on_timeout(self):
+        self.flush()
+        return True
+
+    def flush(self, wait=False):
+        """Save all pending changes.
+        :param bool wait: Block until the changes are written (used on quit)."""
+        changes = self.tracker.take()
+        if not changes:
+            if wait:
+                with self._lock:    # let a running save finish
+                    pass
+            return
+        worker = threading.Thread(target=self._write, args=(changes,), daemon=True)
+        worker.start()
+        if wait:
+            worker.join()
+
+    def _write(self, changes):
+        rejected = {}
+        with self._lock:
+            try:
+                with instrument.span('save', books=len(changes)):
+                    saved = model.save_books(self.db, changes, rejected=rejected)
+            except Exception as e:
+                self.tracker.restore(changes)
+                log_warning('Autosave failed: {}'.format(e))
+                return
+        if self.on_saved:
+            GLib.idle_add(self.on_saved, saved)
+        if rejected:
+            self.tracker.restore(rejected)
+            log_warning('Autosave could not save {} book(s): {}'.format(
+                len(rejected), ', '.join(row[0] for row in rejected.values())))
+            if self.on_rejected:
+                GLib.idle_add(self.on_rejected, list(rejected.values()))
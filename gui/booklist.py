@@ -1,8 +1,16 @@
 import gi
 gi.require_version('Gtk', '3.0')
-from gi.repository import Gtk
+from gi.repository import GLib, Gtk
 
-from model import Book
+import instrument
+import threading
+from facets import ALL, Facets, to_bits
+from gui.autosave import ChangeTracker
+from gui.bookstore import BookStore
+from model import Book, BookCache
+from sorting import SortKeys, order_by
+from sqlalchemy import and_
+import search
 
 
 class BookList(Gtk.ScrolledWindow):
@@ -10,26 +18,107 @@ class BookList(Gtk.ScrolledWindow):
     TITLE = 1
     AUTHOR = 2
 
-    def __init__(self, parent, books):
+    def __init__(self, parent, db, search_engine='auto'):
         super(BookList, self).__init__()
         self.parent = parent
+        self.changes = ChangeTracker()
+        self.cache = BookCache(db)
         self.set_vexpand(True)
         self.set_hexpand(True)
-        self.add(self._setup_view(books))
+        self.add(self._setup_view(db))
         select = self.tree_view.get_selection()
         select.connect('changed', self.on_selection_changed)
+        self._build_index(db, search_engine)
+
+    def _build_index(self, db, engine):
+        """Build the search index (see `search.create_engine`) and the sidebar's
+        `facets.Facets` on a worker thread. Until they are ready searches and
+        filters are run against the database, changes made in the meantime are
+        replayed onto them once they arrive."""
+        self.index          = None
+        self.facets         = None
+        self._index_backlog = []
+        bind                = db.get_bind()
+
+        def build():
+            with instrument.span('startup.facets'):
+                facets = Facets.from_db(bind)
+            with instrument.span('startup.index', engine=engine):
+                index = search.create_engine(bind, engine)
+            GLib.idle_add(self._on_index_ready, index, facets)
+
+        threading.Thread(target=build, daemon=True).start()
+
+    def _on_index_ready(self, index, facets):
+        for rowid, row in self.data.edited_rows.items():
+            index.update(rowid, row)
+            facets.update(rowid, row)
+        for update in self._index_backlog:
+            update(index, facets)
+        self._index_backlog = None
+        self.index  = index
+        self.facets = facets
+        if self.filter_by or self.facet != ALL or self.sort:
+            self._refilter()
+        else:
+            self._count_facets()
+        return False
 
-    def _setup_view(self, books):
-        """Populate ListStore and add a filter."""
-        self.data = Gtk.ListStore(str, str, str, bool, bool, bool, str)
-
-        for b in books:
-            self.data.append(b.to_list())
+    def _update_index(self, update):
+        """Apply `update(index, facets)` now or once both have been built."""
+        if self.index is not None:
+            update(self.index, self.facets)
+        else:
+            self._index_backlog.append(update)
+
+    def _load_sort_keys(self, column):
+        """Load the sort keys of a column (see `sorting.SortKeys`) on a worker
+        thread unless they are loaded or being loaded already."""
+        if column in self.sort_keys or column in self._sort_backlog:
+            return
+        self._sort_backlog[column] = []
+
+        def load():
+            with instrument.span('gui.sort_keys', column=column):
+                keys = SortKeys.from_db(self._bind, column)
+            GLib.idle_add(self._on_sort_keys_ready, keys)
+
+        threading.Thread(target=load, daemon=True).start()
+
+    def _on_sort_keys_ready(self, keys):
+        for rowid, row in self.data.edited_rows.items():
+            keys.update(rowid, row)
+        for update in self._sort_backlog.pop(keys.column):
+            update(keys)
+        self.sort_keys[keys.column] = keys
+        if self.sort and self.sort[0] == keys.column:
+            self._refilter()
+        return False
+
+    def _update_sort_keys(self, update):
+        """Apply `update(sort_keys)` to the loaded sort keys of every column and
+        replay it onto the ones still being loaded."""
+        for keys in self.sort_keys.values():
+            update(keys)
+        for backlog in self._sort_backlog.values():
+            backlog.append(update)
+
+    def _setup_view(self, db):
+        """Set up the lazily loaded model and the columns."""
+        self.data = BookStore(db)
+        self._bind = db.get_bind()
 
         self.filter_by = None
-        self.filter = self.data.filter_new()
-        self.filter.set_visible_func(self._filter_data_func)
-        self.tree_view = Gtk.TreeView.new_with_model(self.filter)
+        self.facet = ALL
+        self.facet_counts = None
+        self._results = None    # bitset of the search results, see `facets.to_bits`
+        self.sort = None        # (column, descending), see `sorting.COLUMNS`
+        self.sort_keys = {}     # column -> `sorting.SortKeys`
+        self._sort_backlog = {}  # column -> updates made while its keys load
+        self._sort_columns = {}  # column -> Gtk.TreeViewColumn
+        self.tree_view = Gtk.TreeView.new_with_model(self.data)
+        # Measuring every row would load the whole library
+        self.tree_view.set_fixed_height_mode(True)
 
         self.isbn_renderer      = Gtk.CellRendererText(editable=True)
         self.isbn_renderer.connect('edited', self.on_isbn_edited)
@@ -40,36 +129,81 @@ class BookList(Gtk.ScrolledWindow):
         self.author_renderer    = Gtk.CellRendererText(editable=True)
         self.author_renderer.connect('edited', self.on_author_edited)
 
-        self.tree_view.append_column(
-            Gtk.TreeViewColumn('ISBN', self.isbn_renderer, text=self.ISBN))
-        self.tree_view.append_column(
-            Gtk.TreeViewColumn('Title', self.title_renderer, text=self.TITLE))
-        self.tree_view.append_column(
-            Gtk.TreeViewColumn('Author', self.author_renderer, text=self.AUTHOR))
+        self._append_column('ISBN', self.isbn_renderer, 140, text=self.ISBN)
+        self._append_column('Title', self.title_renderer, 300, sort='title',
+                            text=self.TITLE)
+        self._append_column('Author', self.author_renderer, 200, sort='author',
+                            text=self.AUTHOR)
 
         self.own_renderer = Gtk.CellRendererToggle()
         self.own_renderer.connect('toggled', self.on_own_toggled)
-        own_column = Gtk.TreeViewColumn('Own', self.own_renderer, active=3)
-        self.tree_view.append_column(own_column)
+        self._append_column('Own', self.own_renderer, 50, sort='own', active=3)
 
         self.want_renderer = Gtk.CellRendererToggle()
         self.want_renderer.connect('toggled', self.on_want_toggled)
-        want_column = Gtk.TreeViewColumn('Want', self.want_renderer, active=4)
-        self.tree_view.append_column(want_column)
+        self._append_column('Want', self.want_renderer, 50, sort='want', active=4)
 
         self.read_renderer = Gtk.CellRendererToggle()
         self.read_renderer.connect('toggled', self.on_read_toggled)
-        read_column = Gtk.TreeViewColumn('Read', self.read_renderer, active=5)
-        self.tree_view.append_column(read_column)
+        self._append_column('Read', self.read_renderer, 50, sort='read', active=5)
 
         self.location_renderer = Gtk.CellRendererText(editable=True)
         self.location_renderer.set_property('editable', True)
         self.location_renderer.connect('edited', self.on_location_edited)
-        self.tree_view.append_column(
-            Gtk.TreeViewColumn('Location', self.location_renderer, text=6))
+        self._append_column('Location', self.location_renderer, 150, sort='location',
+                            text=6)
 
         return self.tree_view
 
+    def _append_column(self, title, renderer, width, sort=None, **attributes):
+        """Append a fixed width column (required by fixed height mode).
+        :param str sort: The sort order of the column (see `sorting.COLUMNS`),
+        clicking its header sorts by it if given."""
+        column = Gtk.TreeViewColumn(title, renderer, **attributes)
+        column.set_sizing(Gtk.TreeViewColumnSizing.FIXED)
+        column.set_fixed_width(width)
+        column.set_resizable(True)
+        if sort is not None:
+            column.set_clickable(True)
+            column.connect('clicked', self.on_column_clicked, sort)
+            self._sort_columns[sort] = column
+        self.tree_view.append_column(column)
+
+    def on_column_clicked(self, column, sort):
+        """Sort by a column, clicking it again reverses the order."""
+        self.set_sort(sort, self.sort == (sort, False))
+
+    def set_sort(self, column, descending=False):
+        """Sort the list by a column (see `sorting.COLUMNS`).
+        Until its sort keys are loaded the database sorts the books."""
+        self.sort = (column, descending)
+        for name, view_column in self._sort_columns.items():
+            view_column.set_sort_indicator(name == column)
+        self._sort_columns[column].set_sort_order(
+            Gtk.SortType.DESCENDING if descending else Gtk.SortType.ASCENDING)
+        self._load_sort_keys(column)
+        self._refilter()
+
+    def _sort_order(self):
+        """The `sorting.SortKeys` of the current sort order, `None` if the list is
+        not sorted or they are not loaded yet."""
+        return self.sort_keys.get(self.sort[0]) if self.sort else None
+
+    def _resort(self, index, rowid, follow=True):
+        """Move a book that was just changed to where it sorts now.
+        :param bool follow: Select the book at its new place.
+        :return: The new index of the book."""
+        order = self._sort_order()
+        if order is None or self.data.keys is None:
+            return index
+        new_index = self.data.move(index, lambda keys: order.position(keys, rowid,
+                                                                      self.sort[1]))
+        if new_index != index and follow:
+            path = Gtk.TreePath.new_from_indices([new_index])
+            self.tree_view.get_selection().select_path(path)
+            self.tree_view.scroll_to_cell(path, None, False, 0, 0)
+        return new_index
+
     @property
     def editing(self):
         return (self.isbn_renderer.get_property('editing') or
@@ -78,67 +212,64 @@ class BookList(Gtk.ScrolledWindow):
                 self.location_renderer.get_property('editing'))
 
     def on_isbn_edited(self, cell, path, new_text):
-        abs_path = self._convert_filtered_path_to_path(path)
-        self.data[abs_path][0] = new_text
+        self._set_value(path, 0, new_text)
 
     def on_title_edited(self, cell, path, new_text):
-        abs_path = self._convert_filtered_path_to_path(path)
-        self.data[abs_path][1] = new_text
+        self._set_value(path, 1, new_text)
 
     def on_author_edited(self, cell, path, new_text):
-        abs_path = self._convert_filtered_path_to_path(path)
-        self.data[abs_path][2] = new_text
+        self._set_value(path, 2, new_text)
 
     def on_location_edited(self, cell, path, new_text):
-        abs_path = self._convert_filtered_path_to_path(path)
-        self.data[abs_path][6] = new_text
+        self._set_value(path, 6, new_text)
 
     def on_own_toggled(self, cellrenderer_toggle, path):
-        abs_path = self._convert_filtered_path_to_path(path)
-        self.data[abs_path][3] = not self.data[abs_path][3]
+        self._toggle_value(path, 3)
 
     def on_want_toggled(self, cellrenderer_toggle, path):
-        abs_path = self._convert_filtered_path_to_path(path)
-        self.data[abs_path][4] = not self.data[abs_path][4]
+        self._toggle_value(path, 4)
 
     def on_read_toggled(self, cellrenderer_toggle, path):
-        abs_path = self._convert_filtered_path_to_path(path)
-        self.data[abs_path][5] = not self.data[abs_path][5]
-
-    def _convert_filtered_path_to_path(self, child_path):
-        """Converts a filtered path to an absolute path.
-        Once the TreeView gets filtered, the reported indices no longer
-        correspond to the original model, therefore they need to be
-        recalculated.
-        :param child_path: The path in the filtered TreeView.
-        :returns int: The index of the child path.
-        """
-        path = Gtk.TreePath(child_path)
-        model = self.tree_view.get_model()
-        abs_path = model.convert_path_to_child_path(path)
-        return abs_path.get_indices()[0]
-
-    def _filter_data_func(self, model, iter, data):
-        """Filter columns ISBN, Title, Author by query."""
-        if self.filter_by is None or self.filter_by == '':
-            return True
-
-        location = model[iter][6].lower() if model[iter][6] else ''
-
-        return (self.filter_by in model[iter][self.ISBN].lower() or
-                self.filter_by in model[iter][self.TITLE].lower() or
-                self.filter_by in model[iter][self.AUTHOR].lower() or
-                self.filter_by in location)
+        self._toggle_value(path, 5)
+
+    def _set_value(self, path, column, value):
+        """Set a value of the row at the given path and record the change."""
+        index = self._path_to_index(path)
+        row = self.data.get_row(index)
+        if row[column] == value:
+            return
+        isbn = row[self.ISBN]
+        row = self.data.set_value(index, column, value)
+        rowid = row[BookStore.ROWID]
+        self.changes.mark(rowid, row[:BookStore.ROWID])
+        self.cache.update(isbn, row[:BookStore.ROWID])
+        if self.index is not None:
+            self.index.update(rowid, row)
+            self.facets.update(rowid, row)
+            self._count_facets()
+        self._update_sort_keys(lambda keys: keys.update(rowid, row))
+        self._resort(index, rowid)
+        if column == self.ISBN:
+            # The selected book was dropped from the cache
+            self.on_selection_changed(self.tree_view.get_selection())
+
+    def _toggle_value(self, path, column):
+        index = self._path_to_index(path)
+        self._set_value(path, column, not self.data.get_row(index)[column])
+
+    @staticmethod
+    def _path_to_index(path):
+        """Converts a path as reported by a cell renderer to a row index."""
+        return Gtk.TreePath(path).get_indices()[0]
 
     def on_selection_changed(self, selection):
         model, iter = selection.get_selected()
         if iter is not None:
             self.selected_path = model.get_path(iter)
-            self.selected_book = Book.fetch(
+            self.selected_book = self.cache.fetch(
                 model[iter][self.ISBN],
-                model[iter][self.TITLE],
                 model[iter][self.AUTHOR],
-                self.parent.db
+                model[iter][self.TITLE]
             )
             self.parent.set_active_book(self.selected_book)
         else:
@@ -146,14 +277,118 @@ class BookList(Gtk.ScrolledWindow):
             self.selected_book = None
 
     def append(self, entry):
-        """Append an entry to the list."""
-        self.data.append(entry.to_list())
+        """Append a book that was just stored in the database to the list."""
+        rowid = self.data.append(entry)
+        self.cache.add(entry)
+
+        def add(index, facets):
+            index.add(rowid, entry.isbn, entry.title, entry.author, entry.location)
+            facets.add(rowid, entry.to_list())
+        self._update_index(add)
+        if self.index is not None:
+            self._count_facets()
+        self._update_sort_keys(lambda keys: keys.add(rowid, entry.to_list()))
+        if self.data.keys is not None:
+            self._resort(len(self.data) - 1, rowid)
+
+    @property
+    def selected_rowid(self):
+        """The rowid of the selected book."""
+        return self.data.get_row(self.selected_path.get_indices()[0])[BookStore.ROWID]
 
     def remove_selected(self):
         """Remove the currently selected entry from the list."""
-        self.data.remove(self.data.get_iter(self.selected_path))
-
+        index = self.selected_path.get_indices()[0]
+        if self.selected_book is not None:
+            self.cache.remove(self.selected_book)
+        rowid = self.data.remove(index)
+        self.changes.discard(rowid)
+
+        def remove(index, facets):
+            index.remove(rowid)
+            facets.remove(rowid)
+        self._update_index(remove)
+        if self.index is not None:
+            self._count_facets()
+        self._update_sort_keys(lambda keys: keys.remove(rowid))
+
+    def update_books(self, changes):
+        """Show books a background job changed in the database (see
+        `enrich.Enricher`). Edits of this session win over the job's changes.
+        :param changes: A list of `enrich.Change` tuples."""
+        edited = self.data.edited_rows
+        for change in changes:
+            if change.rowid in edited:
+                # Save the edit again in case it was saved before the job ran
+                self.changes.mark(change.rowid, edited[change.rowid][:BookStore.ROWID])
+            else:
+                self.cache.update(change.stored_isbn, change.row)
+        changes = [c for c in changes if c.rowid not in edited]
+        self.data.update_rows({c.rowid: c.row for c in changes})
+
+        def update(index, facets):
+            for change in changes:
+                index.update(change.rowid, change.row)
+                facets.update(change.rowid, change.row)
+        self._update_index(update)
+
+        def update_keys(keys):
+            for change in changes:
+                keys.update(change.rowid, change.row)
+        self._update_sort_keys(update_keys)
+        if self._sort_order() is not None and self.data.keys is not None:
+            for change in changes:
+                try:
+                    index = self.data.keys.index(change.rowid)
+                except ValueError:
+                    continue    # not shown
+                self._resort(index, change.rowid, follow=False)
+
+    @instrument.timed('search')
     def search(self, query):
         """Filter the list by the given term."""
         self.filter_by = query.lower()
-        self.filter.refilter()
+        self._refilter()
+
+    def set_facet(self, facet):
+        """Only show the books of a sidebar facet (see `facets.Facets`)."""
+        self.facet = facet or ALL
+        self._refilter()
+
+    def _refilter(self):
+        """Show the books matching both the search term and the facet."""
+        # Swapping the view's model is cheaper than signalling every changed row
+        self.tree_view.set_model(None)
+        with instrument.span('search.refilter', query=self.filter_by, facet=self.facet):
+            ordering    = order_by(*self.sort) if self.sort else None
+            order       = self._sort_order()
+            if self.index is None:
+                clauses = [c for c in (Book.matching(self.filter_by)
+                                       if self.filter_by else None,
+                                       Facets.clause(self.facet)) if c is not None]
+                self.data.set_where(and_(*clauses) if clauses else None, ordering)
+            else:
+                with instrument.span('search.index', query=self.filter_by):
+                    keys = self.index.search(self.filter_by or '')
+                self._results = to_bits(keys) if keys is not None else None
+                if keys is None and self.facet == ALL:
+                    if order is None:
+                        self.data.set_where(None, ordering)
+                    else:
+                        self.data.set_keys(order.sort(None, self.sort[1]))
+                else:
+                    if self.facet != ALL:
+                        keys = self.facets.select(self.facet, keys, self._results)
+                    elif order is None and not self.index.RANKED:
+                        keys = sorted(keys)
+                    if order is not None:
+                        with instrument.span('gui.sort', column=self.sort[0]):
+                            keys = order.sort(keys, self.sort[1])
+                    self.data.set_keys(keys)
+                self._count_facets()
+        self.tree_view.set_model(self.data)
+
+    def _count_facets(self):
+        """Count the search results in every facet and tell the parent."""
+        self.facet_counts = self.facets.counts(self._results)
+        self.parent.update_filters(self.facet_counts)
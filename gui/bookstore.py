@@ -0,0 +1,272 @@
+"""
+A lazily paged `Gtk.TreeModel` over the book table.
+"""
+import gi
+gi.require_version('Gtk', '3.0')
+from gi.repository import GObject, Gtk
+
+import instrument
+from collections import OrderedDict
+from model import Book
+from sqlalchemy import func, literal_column, select
+
+WINDOW_SIZE = 256   # rows fetched per query
+MAX_WINDOWS = 64    # windows kept in the row cache
+
+
+class BookStore(GObject.Object, Gtk.TreeModel):
+    """A list model that only loads the rows that are actually displayed.
+    Rows are fetched in windows of `window_size` consecutive rows (ordered by the
+    SQLite rowid, which does not change when a book is edited) and kept in a
+    bounded LRU cache. The columns match `Book.to_list`, followed by the rowid.
+
+    The model can either show all books (optionally restricted by a SQL `where`
+    clause and sorted by SQL `order_by` clauses) or an explicit list of rowids,
+    see `set_where` and `set_keys`.
+    Changing the view does not emit any signals, detach the model from its view
+    while doing so."""
+    COLUMN_TYPES    = (str, str, str, bool, bool, bool, str, int)
+    ROWID           = 7
+
+    def __init__(self, db, window_size=WINDOW_SIZE, max_windows=MAX_WINDOWS):
+        """Initializes the instance.
+        :param sqlalchemy.orm.session.Session db: An SQLAlchemy session.
+        :param int window_size: The number of rows fetched at once.
+        :param int max_windows: The number of windows kept in memory.
+        """
+        GObject.Object.__init__(self)
+        self.db             = db
+        self.window_size    = window_size
+        self.max_windows    = max_windows
+        self.table          = Book.__table__
+        self.rowid          = literal_column('book.rowid')
+        self._windows       = OrderedDict()  # window number -> rows
+        self._edited        = {}             # rowid -> row, edits of this session
+        self._where         = None
+        self._order_by      = None
+        self._keys          = None
+        self._length        = self._count()
+
+    def __len__(self):
+        return self._length
+
+    def _select(self):
+        return select([self.table.c[c] for c in Book.COLUMNS] + [self.rowid])
+
+    def _count(self):
+        if self._keys is not None:
+            return len(self._keys)
+        query = select([func.count()]).select_from(self.table)
+        if self._where is not None:
+            query = query.where(self._where)
+        return self.db.execute(query).scalar()
+
+    def _fetch_window(self, number):
+        start = number * self.window_size
+        if self._keys is not None:
+            keys    = self._keys[start:start + self.window_size]
+            query   = self._select().where(self.rowid.in_(keys))
+            rows    = {r[self.ROWID]: list(r) for r in self.db.execute(query)}
+            return [rows.get(k) or self._missing_row(k) for k in keys]
+
+        query = self._select().order_by(*(self._order_by or [self.rowid]))
+        if self._where is not None:
+            query = query.where(self._where)
+        query = query.limit(self.window_size).offset(start)
+        return [list(r) for r in self.db.execute(query)]
+
+    @staticmethod
+    def _missing_row(rowid):
+        return ['', '', '', False, False, False, '', rowid]
+
+    def _invalidate(self, index=0, end=None):
+        """Drop all cached windows from the window containing `index` onwards (up
+        to the window containing `end`)."""
+        first   = index // self.window_size
+        last    = end // self.window_size if end is not None else float('inf')
+        for number in [n for n in self._windows if first <= n <= last]:
+            del self._windows[number]
+
+    def get_row(self, index):
+        """Return the row at the given index as a list (see `COLUMN_TYPES`)."""
+        number = index // self.window_size
+        window = self._windows.get(number)
+        if window is None:
+            with instrument.span('gui.fetch_window', window=number):
+                window = self._fetch_window(number)
+            self._windows[number] = window
+            if len(self._windows) > self.max_windows:
+                self._windows.popitem(last=False)
+        else:
+            self._windows.move_to_end(number)
+
+        offset = index % self.window_size
+        row = window[offset] if offset < len(window) else self._missing_row(0)
+        return self._edited.get(row[self.ROWID], row)
+
+    def set_value(self, index, column, value):
+        """Change a single value and notify the view.
+        :return: The updated row."""
+        row         = list(self.get_row(index))
+        row[column] = value
+        self._edited[row[self.ROWID]] = row
+        path = Gtk.TreePath.new_from_indices([index])
+        self.row_changed(path, self.get_iter(path))
+        return row
+
+    def append(self, book):
+        """Show a book that was just added to the database.
+        :return: The rowid of the book."""
+        rowid = self.db.execute(
+            select([self.rowid]).where(self.table.c.isbn == book.isbn)).scalar()
+        if self._keys is not None:
+            self._keys.append(rowid)
+            length = len(self._keys)
+        else:
+            length = self._count()
+        self._invalidate(self._length)
+        for index in range(self._length, length):
+            self._length = index + 1
+            path = Gtk.TreePath.new_from_indices([index])
+            self.row_inserted(path, self.get_iter(path))
+        return rowid
+
+    def remove(self, index):
+        """Remove the row at `index` after its book was deleted from the database.
+        :return: The rowid of the removed book."""
+        rowid = self.get_row(index)[self.ROWID]
+        self._edited.pop(rowid, None)
+        if self._keys is not None:
+            del self._keys[index]
+        self._length -= 1
+        self._invalidate(index)
+        self.row_deleted(Gtk.TreePath.new_from_indices([index]))
+        return rowid
+
+    def move(self, index, position):
+        """Move a row within a list of rowids, e.g. after an edit changed where it
+        sorts. Only the windows between the old and the new index are dropped.
+        :param int index: The index of the row.
+        :param position: Called with the rowids without the row, returns the index
+        to insert it at (see `sorting.SortKeys.position`).
+        :return: The new index."""
+        rowid       = self._keys.pop(index)
+        new_index   = position(self._keys)
+        if new_index == index:
+            self._keys.insert(index, rowid)
+            return index
+        self._invalidate(min(index, new_index), max(index, new_index))
+        self._length -= 1
+        self.row_deleted(Gtk.TreePath.new_from_indices([index]))
+        self._keys.insert(new_index, rowid)
+        self._length += 1
+        path = Gtk.TreePath.new_from_indices([new_index])
+        self.row_inserted(path, self.get_iter(path))
+        return new_index
+
+    def update_rows(self, rows):
+        """Show rows that were changed in the database elsewhere, e.g. by
+        `enrich.Enricher`. Rows edited in this session keep their edits.
+        :param dict rows: Maps rowids to rows as returned by `Book.to_list`."""
+        for number, window in self._windows.items():
+            for offset, row in enumerate(window):
+                rowid = row[self.ROWID]
+                if rowid in rows and rowid not in self._edited:
+                    window[offset] = list(rows[rowid]) + [rowid]
+                    path = Gtk.TreePath.new_from_indices(
+                        [number * self.window_size + offset])
+                    self.row_changed(path, self.get_iter(path))
+
+    def set_where(self, where, order_by=None):
+        """Show all books matching a SQL expression (or all books if `None`).
+        :param order_by: A list of ORDER BY clauses, by rowid if `None`."""
+        self._where     = where
+        self._order_by  = order_by
+        self._keys      = None
+        self.refresh()
+
+    def set_keys(self, keys):
+        """Show the books with the given rowids in the given order."""
+        self._where     = None
+        self._order_by  = None
+        self._keys      = list(keys)
+        self.refresh()
+
+    @property
+    def keys(self):
+        """The rowids shown, `None` unless set with `set_keys`."""
+        return self._keys
+
+    @property
+    def edited_rows(self):
+        """The rows edited in this session, keyed by rowid."""
+        return self._edited
+
+    def refresh(self):
+        """Drop all cached rows, e.g. after the database was changed elsewhere."""
+        self._windows.clear()
+        self._length = self._count()
+
+    def _make_iter(self, index):
+        # user_data is a pointer, 0 would turn into NULL
+        it = Gtk.TreeIter()
+        it.user_data = index + 1
+        return it
+
+    @staticmethod
+    def _index(it):
+        return it.user_data - 1
+
+    def do_get_flags(self):
+        return Gtk.TreeModelFlags.LIST_ONLY
+
+    def do_get_n_columns(self):
+        return len(self.COLUMN_TYPES)
+
+    def do_get_column_type(self, column):
+        return self.COLUMN_TYPES[column]
+
+    def do_get_iter(self, path):
+        indices = path.get_indices()
+        if len(indices) == 1 and 0 <= indices[0] < self._length:
+            return (True, self._make_iter(indices[0]))
+        return (False, None)
+
+    def do_get_path(self, it):
+        return Gtk.TreePath.new_from_indices([self._index(it)])
+
+    def do_get_value(self, it, column):
+        return self.get_row(self._index(it))[column]
+
+    def do_iter_next(self, it):
+        index = self._index(it) + 1
+        if index < self._length:
+            it.user_data = index + 1
+            return (True, it)
+        return (False, None)
+
+    def do_iter_previous(self, it):
+        index = self._index(it) - 1
+        if index >= 0:
+            it.user_data = index + 1
+            return (True, it)
+        return (False, None)
+
+    def do_iter_children(self, parent):
+        if parent is None and self._length > 0:
+            return (True, self._make_iter(0))
+        return (False, None)
+
+    def do_iter_has_child(self, it):
+        return False
+
+    def do_iter_n_children(self, it):
+        return self._length if it is None else 0
+
+    def do_iter_nth_child(self, parent, n):
+        if parent is None and 0 <= n < self._length:
+            return (True, self._make_iter(n))
+        return (False, None)
+
+    def do_iter_parent(self, child):
+        return (False, None)
@@ -0,0 +1,152 @@
+"""
+Loads book covers, caching them on disk and in memory.
+"""
+import gi
+gi.require_version('GdkPixbuf', '2.0')
+from gi.repository import GdkPixbuf, GLib
+
+import hashlib
+import instrument
+import os
+from cache import ResponseCache
+from collections import OrderedDict
+from gui.tasks import TaskRunner
+from provider import TIMEOUT, create_session, rate_limiter
+
+MEMORY_BYTES    = 32 * 1024 * 1024  # decoded pixels kept in memory
+INDEX_TTL       = 365 * 24 * 3600   # seconds until a cover is downloaded again
+CHUNK_SIZE      = 16 * 1024
+COVERS_URL      = 'https://covers.openlibrary.org/'
+
+
+class CoverCache(object):
+    """Loads covers by ISBN and size ('S', 'M' or 'L').
+    Image files are stored content-addressed (by SHA-1) below `directory`, an index
+    maps ISBN and size to the file (or records that there is no cover). Decoded
+    images are kept in an LRU bounded by their size in bytes. Downloads are
+    decoded while they arrive, without going through a temporary file."""
+
+    def __init__(self, directory, max_bytes=MEMORY_BYTES, max_workers=4):
+        """Initializes the instance.
+        :param str directory: The cache directory (`~` is expanded).
+        :param int max_bytes: The maximum size of decoded images kept in memory.
+        :param int max_workers: The number of concurrent downloads.
+        """
+        self.directory  = os.path.expanduser(directory)
+        self.index      = ResponseCache(os.path.join(self.directory, 'index.sqlite'),
+                                        ttl=INDEX_TTL)
+        self.max_bytes  = max_bytes
+        self.tasks      = TaskRunner(max_workers=max_workers)
+        self.session    = create_session(pool_size=max_workers)
+        self.limiter    = rate_limiter(COVERS_URL)
+        self._pixbufs   = OrderedDict()     # (isbn, size) -> Pixbuf
+        self._bytes     = 0
+        self._pending   = {}                # (isbn, size) -> callbacks
+
+    def _path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest[2:])
+
+    def get(self, isbn, size):
+        """Return a cover from memory.
+        :return: The cover, or `None` if it has not been loaded yet."""
+        pixbuf = self._pixbufs.get((isbn, size))
+        if pixbuf is not None:
+            self._pixbufs.move_to_end((isbn, size))
+        return pixbuf
+
+    def load(self, isbn, size, url, on_loaded=None):
+        """Load a cover in the background.
+        :param str url: Where to download the cover from if it is not cached.
+        :param on_loaded: Called on the main loop with the `Pixbuf`, or with `None`
+        if there is no cover."""
+        key = (isbn, size)
+        pixbuf = self.get(isbn, size)
+        if pixbuf is not None:
+            if on_loaded:
+                on_loaded(pixbuf)
+            return
+
+        callbacks = self._pending.get(key)
+        if callbacks is not None:
+            if on_loaded:
+                callbacks.append(on_loaded)
+            return
+        self._pending[key] = [on_loaded] if on_loaded else []
+        self.tasks.submit(self._fetch, key, url,
+                          on_done=lambda pb: self._on_fetched(key, pb),
+                          on_error=lambda e: self._on_fetched(key, None))
+
+    def prefetch(self, covers):
+        """Load several covers without waiting for them.
+        :param covers: An iterable of `(isbn, size, url)` tuples."""
+        for isbn, size, url in covers:
+            self.load(isbn, size, url)
+
+    def _on_fetched(self, key, pixbuf):
+        if pixbuf is not None:
+            self._remember(key, pixbuf)
+        for callback in self._pending.pop(key, []):
+            callback(pixbuf)
+
+    def _remember(self, key, pixbuf):
+        self._pixbufs[key] = pixbuf
+        self._bytes += pixbuf.get_byte_length()
+        while self._bytes > self.max_bytes and len(self._pixbufs) > 1:
+            _, evicted = self._pixbufs.popitem(last=False)
+            self._bytes -= evicted.get_byte_length()
+
+    def _fetch(self, key, url):
+        """Read a cover from disk or download it (runs on a worker thread)."""
+        hit, digest = self.index.get('{}-{}'.format(*key))
+        if hit and digest is None:
+            return None
+        if hit and os.path.exists(self._path(digest)):
+            try:
+                with open(self._path(digest), 'rb') as f:
+                    pixbuf = self._decode(iter(lambda: f.read(CHUNK_SIZE), b''))[0]
+            except GLib.Error:
+                pixbuf = None
+            if pixbuf is not None:
+                return pixbuf
+            # A truncated or corrupt file, forget it and download the cover again
+            self.index.delete('{}-{}'.format(*key))
+            try:
+                os.remove(self._path(digest))
+            except OSError:
+                pass
+        return self._download(key, url)
+
+    def _download(self, key, url):
+        self.limiter.acquire()
+        with instrument.span('http.covers', url=url):
+            r = self.session.get(url, params={'default': 'false'}, stream=True,
+                                 timeout=TIMEOUT)
+            if r.status_code == 404:
+                self.index.set('{}-{}'.format(*key), None)
+                return None
+            r.raise_for_status()
+            pixbuf, data = self._decode(r.iter_content(CHUNK_SIZE))
+        digest = hashlib.sha1(data).hexdigest()
+        path = self._path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + '.part', 'wb') as f:
+                f.write(data)
+            os.replace(path + '.part', path)
+        self.index.set('{}-{}'.format(*key), digest)
+        return pixbuf
+
+    @staticmethod
+    def _decode(chunks):
+        """Feed chunks to a `PixbufLoader` as they arrive.
+        :return: The decoded image and the raw data."""
+        loader = GdkPixbuf.PixbufLoader()
+        data = bytearray()
+        for chunk in chunks:
+            loader.write(chunk)
+            data.extend(chunk)
+        loader.close()
+        return loader.get_pixbuf(), bytes(data)
+
+    def shutdown(self):
+        self.tasks.shutdown()
@@ -1,16 +1,28 @@
 import gi
-import requests
 gi.require_version('Gtk', '3.0')
-from exc import InvalidISBNError, NoResultsError
+import dedupe
+import isbnlib
+import traceback
+from exc import InvalidISBNError, NoResultsError, ProviderError
+from ..tasks import TaskRunner
 from ..utils import setup_info_bar
-from gi.repository import Gdk, Gtk
-from gi.repository.GdkPixbuf import Pixbuf
-from model import Book
+from gi.repository import Gdk, GLib, Gtk
+from model import Book, existing_isbns
 from provider import Identifier, OpenLibrary
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from utils import log_warning
+
+COVER_SIZE      = 'M'
+SCAN_WORKERS    = 8     # concurrent lookups in scan mode
+SCAN_BATCH      = 10    # found books committed per transaction
+SCAN_FLUSH      = 3     # seconds after which fewer found books are committed
 
 
 class AddBookHandler(object):
-    def __init__(self, db, parent):
+    def __init__(self, db, parent, provider=None, covers=None, on_added=None):
+        """Initializes the instance.
+        :param on_added: Called with the list of books the scan mode committed
+        (see `_commit_scans`), e.g. to show them in the book list."""
         self.builder            = Gtk.Builder()
         self.builder.add_from_file('./gui/dialogs/add_book.glade')
         self.dialog             = self.builder.get_object('dialog_add_book')
@@ -23,21 +35,43 @@ class AddBookHandler(object):
         self.current_entry      = None
         self.current_page       = 'SEARCH'
         self.result             = None
-        self.ol                 = OpenLibrary()
+        self.stream             = None
+        self.loading_more       = False
+        self.ol                 = provider or OpenLibrary()
+        self.tasks              = TaskRunner()
+        self.covers             = covers
+        self.closed             = False
+        self.duplicate_warned   = None
         self.db                 = db
+        self.on_added           = on_added
+        self.scan_tasks         = None  # lookups of the scan mode, see `_start_scan`
+        self.known_isbns        = None  # in the library or scanned already, as ISBN-13
+        self.scan_rows          = {}    # ISBN -> iter of the scan list, until added
+        self.scan_found         = []    # found books that are not committed yet
+        self.scan_counts        = dict.fromkeys(('pending', 'added', 'failed',
+                                                 'skipped'), 0)
+        self._flush_timer       = None
 
         self.dialog.set_transient_for(parent)
+        self.dialog.connect('destroy', self.on_dialog_destroy)
 
         setup_info_bar(self)
         self.vbox.pack_end(self.info_bar, False, True, 0)
 
         self.tv_results = self.builder.get_object('treeview_results')
+        self.builder.get_object('win_results').get_vadjustment().connect(
+            'value-changed', self.on_results_scrolled)
         render_text     = Gtk.CellRendererText(width_chars=150, wrap_width=150)
         self.tv_results.append_column(Gtk.TreeViewColumn('Title', render_text,
                                                          text=0))
         self.tv_results.append_column(Gtk.TreeViewColumn('Author', render_text,
                                                          text=1))
 
+        self.tv_scan    = self.builder.get_object('treeview_scan')
+        for column, title in enumerate(('ISBN', 'Title', 'Author', 'Status')):
+            self.tv_scan.append_column(Gtk.TreeViewColumn(
+                title, Gtk.CellRendererText(), text=column))
+
         self.lbl_message.modify_fg(Gtk.StateType.NORMAL, Gdk.color_parse('red'))
         self.lbl_manual_message.modify_fg(Gtk.StateType.NORMAL, Gdk.color_parse('red'))
         self.builder.connect_signals(self)
@@ -47,6 +81,8 @@ class AddBookHandler(object):
             if self.current_entry:
                 self.added_book = self.current_entry.to_book(self.current_entry.isbns[0])
                 if not Book.exists(self.added_book.isbn, self.db):
+                    if self._warn_duplicate(self.added_book):
+                        return
                     self.db.add(self.added_book)
                     self.is_new = True
                 self.dialog.close()
@@ -72,9 +108,30 @@ class AddBookHandler(object):
                                    own=own, want=want, read=read)
             if ((isbn != '' and not Book.exists(isbn, self.db)) or
                     not Book.exists_author_title(author, title, self.db)):
+                if self._warn_duplicate(self.added_book):
+                    return
                 self.db.add(self.added_book)
                 self.is_new = True
             self.dialog.close()
+        elif self.current_page == 'SCAN':
+            self._commit_scans()
+
+    def _warn_duplicate(self, book):
+        """Warn if a book is probably in the library already, e.g. under its
+        ISBN-10 or with the author written differently (see `dedupe.check`).
+        Adding the same book again goes ahead.
+        :return: `True` if the user was warned and the book should not be added."""
+        key = (book.isbn, book.author, book.title)
+        if self.duplicate_warned == key:
+            return False
+        candidates = dedupe.check(self.db, book.isbn, book.author, book.title)
+        if not candidates:
+            return False
+        self.duplicate_warned = key
+        found = candidates[0].second
+        self.show_message('"{}" by {} may already be in your library. Add the book '
+                          'again to add it anyway.'.format(found.title, found.author))
+        return True
 
     def _has_query(self, entry):
         if entry.get_text().strip() == '':
@@ -86,31 +143,72 @@ class AddBookHandler(object):
 
     def _search_by_isbn(self, entry):
         isbn = entry.get_text().strip()
-        try:
-            book                = self.ol.isbn_search(isbn)
-            self.current_entry  = book
-            store               = self.builder.get_object('resultstore')
-            store.clear()
-            store.append([book.title, book.author])
-            self.tv_results.set_cursor(Gtk.TreePath.new_from_indices([0]))
-            self._set_result_entry(book)
-            self.lbl_message.hide()
-        except InvalidISBNError as e:
-            self.show_message(str(e))
-        except NoResultsError as e:
-            self.show_message(str(e))
+        self._close_stream()
+        self.tasks.submit(self.ol.isbn_search, isbn, key='search',
+                          on_done=self._show_isbn_result,
+                          on_error=self._show_search_error)
+
+    def _show_isbn_result(self, book):
+        self.result         = None
+        self.current_entry  = book
+        store               = self.builder.get_object('resultstore')
+        store.clear()
+        store.append([book.title, book.author])
+        self.tv_results.set_cursor(Gtk.TreePath.new_from_indices([0]))
+        self._set_result_entry(book)
+        self.lbl_message.hide()
 
     def _search_by_query(self, entry, identifier):
         query = entry.get_text().strip()
-        try:
-            self.result = self.ol.query_search(query, identifier)
-            store       = self.builder.get_object('resultstore')
-            store.clear()
-            for r in self.result.results:
-                store.append([r.title, r.author])
-            self.lbl_message.hide()
-        except NoResultsError as e:
-            self.show_message(str(e))
+        self._close_stream()
+        self.stream = self.ol.query_pages(query, identifier)
+        self.tasks.submit(self.stream.next_page, key='search',
+                          on_done=self._show_query_result,
+                          on_error=self._show_search_error)
+
+    def _load_more_results(self):
+        """Append the next page of results (already prefetched by the stream)."""
+        if self.stream is None or self.stream.exhausted or self.loading_more:
+            return
+        self.loading_more = True
+        self.tasks.submit(self.stream.next_page, key='search',
+                          on_done=self._append_query_result,
+                          on_error=self._show_search_error)
+
+    def _append_query_result(self, result):
+        self.loading_more = False
+        if result is None:
+            return
+        store = self.builder.get_object('resultstore')
+        self.result.results.extend(result.results)
+        for r in result.results:
+            store.append([r.title, r.author])
+
+    def _close_stream(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+        self.loading_more = False
+
+    def _show_query_result(self, result):
+        self.result = result
+        store       = self.builder.get_object('resultstore')
+        store.clear()
+        for r in self.result.results:
+            store.append([r.title, r.author])
+        self.lbl_message.hide()
+        # Rows are only laid out on the next iteration of the main loop
+        GLib.idle_add(self._prefetch_visible_covers)
+
+    def _show_search_error(self, error):
+        self.loading_more = False
+        if isinstance(error, (InvalidISBNError, NoResultsError, ProviderError)):
+            self.show_message(str(error))
+        else:
+            log_warning('Searching failed:\n{}'.format(''.join(
+                traceback.format_exception(type(error), error, error.__traceback__))))
+            self._close_stream()
+            self.show_message('Searching failed unexpectedly, please try again.')
 
     def _search(self, entry_search):
         if self._has_query(entry_search):
@@ -120,7 +218,11 @@ class AddBookHandler(object):
                 self._search_by_query(entry_search, self.identifier)
 
     def _set_result_entry(self, entry):
-        self._set_result(entry.isbns[0], entry.title, entry.author)
+        if entry.isbns:
+            self._set_result(entry.isbns[0], entry.title, entry.author,
+                             self.ol.get_cover(entry, COVER_SIZE))
+        else:
+            self._set_result('', entry.title, entry.author)
 
     def _set_result(self, isbn, title, author, cover=None):
         tbl_result  = self.builder.get_object('table_result')
@@ -128,20 +230,168 @@ class AddBookHandler(object):
         img_cover   = self.builder.get_object('img_cover')
 
         lbl_details.set_text('{}\n{}\n{}'.format(isbn, title, author))
-        if cover:
-            r       = requests.get(cover, stream=True)    # load cover from web
-            with open('cover.jpg', 'wb') as img:
-                for chunk in r:
-                    img.write(chunk)
-            pb      = Pixbuf.new_from_file('cover.jpg')
-            img_cover.set_from_pixbuf(pb)
+        img_cover.clear()
+        if cover and self.covers:
+            def on_loaded(pixbuf):
+                # Another result might have been selected in the meantime
+                if pixbuf and not self.closed and self.current_entry and \
+                        self.current_entry.isbns and self.current_entry.isbns[0] == isbn:
+                    img_cover.set_from_pixbuf(pixbuf)
+            self.covers.load(isbn, COVER_SIZE, cover, on_loaded)
         tbl_result.show()
 
+    def _prefetch_visible_covers(self):
+        visible = self.tv_results.get_visible_range()
+        if self.covers and self.result and visible:
+            start, end  = visible[0].get_indices()[0], visible[1].get_indices()[0]
+            entries     = self.result.results[start:end + 1]
+            self.covers.prefetch(
+                (e.isbns[0], COVER_SIZE, self.ol.get_cover(e, COVER_SIZE))
+                for e in entries if e.isbns)
+        return False
+
+    def _start_scan(self):
+        """Prepare the scan mode the first time its page is shown."""
+        if self.known_isbns is None:
+            self.known_isbns    = existing_isbns(self.db.get_bind())
+            self.scan_tasks     = TaskRunner(max_workers=SCAN_WORKERS)
+            self._update_scan_status()
+        self.builder.get_object('entry_scan').grab_focus()
+
+    def _scan(self, text):
+        """Queue a scanned ISBN for a lookup, unless the book is in the library or
+        was scanned already. Lookups run concurrently, so the next ISBN can be
+        scanned right away."""
+        isbn = isbnlib.to_isbn13(text)
+        if not isbn:
+            self._add_scan_row(text, 'Not a valid ISBN', 'failed')
+        elif isbn in self.scan_rows:
+            self._add_scan_row(isbn, 'Scanned already', 'skipped')
+        elif isbn in self.known_isbns:
+            self._add_scan_row(isbn, 'Already in the library', 'skipped')
+        else:
+            self.known_isbns.add(isbn)
+            self.scan_rows[isbn] = self._add_scan_row(isbn, 'Looking up', 'pending')
+            self.scan_tasks.submit(
+                self.ol.isbn_search, isbn,
+                on_done=lambda entry: self._on_scan_found(isbn, entry),
+                on_error=lambda error: self._on_scan_failed(isbn, error))
+
+    def _add_scan_row(self, isbn, status, count):
+        self.scan_counts[count] += 1
+        self._update_scan_status()
+        return self.builder.get_object('scanstore').prepend([isbn, '', '', status])
+
+    def _set_scan_status(self, isbn, status, title=None, author=None):
+        store   = self.builder.get_object('scanstore')
+        it      = self.scan_rows[isbn]
+        store.set_value(it, 3, status)
+        if title is not None:
+            store.set_value(it, 1, title)
+            store.set_value(it, 2, author)
+
+    def _update_scan_status(self):
+        self.builder.get_object('lbl_scan_status').set_text(
+            '{pending} pending, {found} found, {added} added, {failed} failed, '
+            '{skipped} skipped'.format(found=len(self.scan_found), **self.scan_counts))
+
+    def _on_scan_found(self, isbn, entry):
+        if self.closed:
+            return
+        self.scan_counts['pending'] -= 1
+        self.scan_found.append(entry.to_book(isbn))
+        self._set_scan_status(isbn, 'Found', entry.title, entry.author)
+        if len(self.scan_found) >= SCAN_BATCH:
+            self._commit_scans()
+        elif self._flush_timer is None:
+            self._flush_timer = GLib.timeout_add_seconds(SCAN_FLUSH,
+                                                         self._on_flush_timeout)
+        self._update_scan_status()
+
+    def _on_scan_failed(self, isbn, error):
+        if not isinstance(error, (InvalidISBNError, NoResultsError, ProviderError)):
+            log_warning('Looking up {} failed: {!r}'.format(isbn, error))
+        if self.closed:
+            return
+        self.scan_counts['pending'] -= 1
+        self._fail_scan(isbn, str(error) or type(error).__name__)
+        self._update_scan_status()
+
+    def _fail_scan(self, isbn, status):
+        """Mark a scanned book as failed, scanning it again retries it."""
+        self.scan_counts['failed'] += 1
+        self._set_scan_status(isbn, status)
+        del self.scan_rows[isbn]
+        self.known_isbns.discard(isbn)
+
+    def _on_flush_timeout(self):
+        self._flush_timer = None
+        self._commit_scans()
+        return False
+
+    def _commit_scans(self):
+        """Add the found books to the library in one transaction."""
+        if self._flush_timer is not None:
+            GLib.source_remove(self._flush_timer)
+            self._flush_timer = None
+        books, self.scan_found = self.scan_found, []
+        if not books:
+            return
+        self.db.add_all(books)
+        try:
+            try:
+                self.db.commit()
+            except IntegrityError:
+                # Added elsewhere in the meantime, e.g. in the search page
+                self.db.rollback()
+                known = [b for b in books if Book.exists(b.isbn, self.db)]
+                for book in known:
+                    self._set_scan_status(book.isbn, 'Already in the library')
+                    del self.scan_rows[book.isbn]
+                self.scan_counts['skipped'] += len(known)
+                books = [b for b in books if b not in known]
+                self.db.add_all(books)
+                self.db.commit()
+        except SQLAlchemyError as e:
+            self.db.rollback()
+            log_warning('Adding the scanned books failed: {}'.format(e))
+            for book in books:
+                self._fail_scan(book.isbn, 'Could not be added')
+            self._update_scan_status()
+            return
+        for book in books:
+            self._set_scan_status(book.isbn, 'Added')
+            del self.scan_rows[book.isbn]
+        self.scan_counts['added'] += len(books)
+        self._update_scan_status()
+        if self.on_added and books:
+            self.on_added(books)
+
+    def on_dialog_destroy(self, dialog):
+        # Found books are kept, lookups still running are dropped
+        if self.scan_found and not self.closed:
+            self._commit_scans()
+        self.closed = True
+        self._close_stream()
+        self.tasks.shutdown()
+        if self.scan_tasks is not None:
+            self.scan_tasks.shutdown()
+
+    def on_results_scrolled(self, adjustment):
+        self._prefetch_visible_covers()
+        # Load more results once the user scrolled into the last screenful
+        if adjustment.get_value() + 2 * adjustment.get_page_size() >= \
+                adjustment.get_upper():
+            self._load_more_results()
+
     def on_notebook_switch_page(self, notebook, page, page_num):
         if page_num == 0:
             self.current_page = 'SEARCH'
         elif page_num == 1:
             self.current_page = 'MANUAL'
+        elif page_num == 2:
+            self.current_page = 'SCAN'
+            self._start_scan()
 
     def on_btn_add_clicked(self, btn_add):
         self._add_book()
@@ -166,6 +416,12 @@ class AddBookHandler(object):
     def on_entry_search_activate(self, entry_search):
         self._search(entry_search)
 
+    def on_entry_scan_activate(self, entry_scan):
+        text = entry_scan.get_text().strip()
+        entry_scan.set_text('')
+        if text:
+            self._scan(text)
+
     def on_treeview_results_cursor_changed(self, tv):
         if self.result:
             path, col       = tv.get_cursor()
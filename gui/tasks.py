@@ -0,0 +1,75 @@
+"""
+Runs blocking work (e.g. network requests) off the GTK main loop.
+"""
+from gi.repository import GLib
+
+from concurrent.futures import ThreadPoolExecutor
+from utils import log_warning
+
+
+class Task(object):
+    """A handle for work submitted to a `TaskRunner`."""
+    def __init__(self):
+        self.future     = None
+        self.cancelled  = False
+
+    def cancel(self):
+        """Cancel the task, its callbacks will not be called anymore."""
+        self.cancelled = True
+        if self.future is not None:
+            self.future.cancel()
+
+
+class TaskRunner(object):
+    """Runs functions on a thread pool and delivers their results to the main loop.
+    Tasks can be submitted under a key, submitting a new task under the same key
+    cancels the previous one (e.g. a stale search)."""
+
+    def __init__(self, max_workers=4):
+        self._executor  = ThreadPoolExecutor(max_workers=max_workers)
+        self._latest    = {}    # key -> Task
+
+    def submit(self, fn, *args, key=None, on_done=None, on_error=None):
+        """Run `fn(*args)` on a worker thread.
+        :param key: Cancel the last task submitted with this key.
+        :param on_done: Called on the main loop with the result.
+        :param on_error: Called on the main loop with the raised exception.
+        :return: The submitted task.
+        :rtype: Task"""
+        task = Task()
+        if key is not None:
+            self.cancel(key)
+            self._latest[key] = task
+
+        task.future = self._executor.submit(fn, *args)
+        task.future.add_done_callback(
+            lambda f: GLib.idle_add(self._deliver, task, key, on_done, on_error))
+        return task
+
+    def _deliver(self, task, key, on_done, on_error):
+        if key is not None and self._latest.get(key) is task:
+            del self._latest[key]
+        if task.cancelled or task.future.cancelled():
+            return False
+
+        error = task.future.exception()
+        if error is None:
+            if on_done:
+                on_done(task.future.result())
+        elif on_error:
+            on_error(error)
+        else:
+            log_warning('Background task failed: {}'.format(error))
+        return False
+
+    def cancel(self, key):
+        """Cancel the running task submitted under `key`, if any."""
+        task = self._latest.pop(key, None)
+        if task is not None:
+            task.cancel()
+
+    def shutdown(self):
+        """Cancel all keyed tasks and stop the worker threads once they are idle."""
+        for key in list(self._latest):
+            self.cancel(key)
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,246 @@
+"""
+Lightweight timers and counters for the hot paths (SQL, HTTP, search, startup).
+
+Instrumentation is off by default; `span` then returns a shared no-op context
+manager and no SQLAlchemy hooks are installed, so the cost is a global lookup per
+call. Once enabled, every span is aggregated per name and, if tracing, recorded as
+an event that `export_trace` writes in the Chrome trace format (load it into
+chrome://tracing or https://ui.perfetto.dev).
+"""
+import functools
+import json
+import os
+import threading
+import time
+from collections import deque
+
+WINDOW          = 10        # seconds covered by `summary`
+RECENT          = 1000      # durations kept per name for `summary`
+MAX_EVENTS      = 200000    # trace events kept, older ones are dropped
+STATEMENT_CHARS = 200       # characters of SQL kept in trace events
+
+_enabled    = False
+_tracing    = False
+_lock       = threading.Lock()
+_stats      = {}            # name -> Stat
+_events     = deque(maxlen=MAX_EVENTS)
+_origin     = time.perf_counter()
+_engine     = None          # the SQLAlchemy Engine class once hooks are installed
+
+
+class Stat(object):
+    """The timings of one kind of operation."""
+    __slots__ = ('count', 'total', 'max', 'recent')
+
+    def __init__(self):
+        self.count  = 0
+        self.total  = 0.0
+        self.max    = 0.0
+        self.recent = deque(maxlen=RECENT)  # (end, duration, count)
+
+    def add(self, end, duration, n=1):
+        self.count += n
+        self.total += duration
+        self.max    = max(self.max, duration)
+        self.recent.append((end, duration, n))
+
+    def to_dict(self):
+        return {'count': self.count, 'total_ms': self.total * 1000,
+                'mean_ms': self.total / self.count * 1000 if self.count else 0,
+                'max_ms': self.max * 1000}
+
+
+class _Span(object):
+    __slots__ = ('name', 'args', 'start')
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        record(self.name, self.start, time.perf_counter(), self.args)
+
+
+class _NullSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def enabled():
+    return _enabled
+
+
+def enable(trace=False):
+    """Start collecting timings.
+    :param bool trace: Also keep every span as a trace event, see `export_trace`."""
+    global _enabled, _tracing
+    _enabled = True
+    _tracing = trace
+    _install_sql_hooks()
+
+
+def disable():
+    """Stop collecting timings; what was collected so far is kept."""
+    global _enabled, _tracing
+    _enabled = False
+    _tracing = False
+    _remove_sql_hooks()
+
+
+def reset():
+    """Forget all collected timings and events."""
+    with _lock:
+        _stats.clear()
+        _events.clear()
+
+
+def span(name, **args):
+    """Time a block: `with instrument.span('search', query=query): ...`
+    :param str name: What is timed; the part before the first dot is its category
+    in traces, e.g. 'sql', 'http', 'search' or 'startup'.
+    :param args: Details shown in the trace event."""
+    if not _enabled:
+        return _NULL_SPAN
+    return _Span(name, args)
+
+
+def timed(name):
+    """Decorate a function to time each of its calls, see `span`."""
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            with _Span(name, None):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def count(name, n=1):
+    """Increase a counter, shown like a span without duration."""
+    if _enabled:
+        now = time.perf_counter()
+        record(name, now, now, n=n)
+
+
+def record(name, start, end, args=None, n=1):
+    """Record an operation timed elsewhere (`start` and `end` from `perf_counter`).
+    :param int n: The number of operations the time was spent on."""
+    if not _enabled:
+        return
+    duration = end - start
+    thread = threading.get_ident()
+    with _lock:
+        stat = _stats.get(name)
+        if stat is None:
+            stat = _stats[name] = Stat()
+        stat.add(end, duration, n)
+        if _tracing:
+            _events.append((name, start, duration, thread, args))
+
+
+def stats():
+    """Return the totals of every operation since the last `reset`.
+    :return: A dictionary mapping names to `Stat.to_dict` dictionaries."""
+    with _lock:
+        return {name: stat.to_dict() for name, stat in _stats.items()}
+
+
+def summary(window=WINDOW, limit=4):
+    """Summarize the operations of the last `window` seconds by total time spent,
+    e.g. 'sql.select 42× 18.3 ms · search 3× 9.1 ms'.
+    :param int limit: The number of operations shown.
+    :return: The summary, or an empty string if nothing happened."""
+    since = time.perf_counter() - window
+    totals = []
+    with _lock:
+        for name, stat in _stats.items():
+            recent = [(d, n) for end, d, n in stat.recent if end >= since]
+            if recent:
+                totals.append((sum(d for d, _ in recent), sum(n for _, n in recent),
+                               name))
+    totals.sort(reverse=True)
+    return ' · '.join('{} {}× {:.1f} ms'.format(name, n, total * 1000)
+                      for total, n, name in totals[:limit])
+
+
+def export_stats(path):
+    """Write the totals of `stats` as JSON."""
+    with open(os.path.expanduser(path), 'w') as f:
+        json.dump(stats(), f, indent=2, sort_keys=True)
+
+
+def export_trace(path):
+    """Write the recorded spans in the Chrome trace event format."""
+    pid = os.getpid()
+    with _lock:
+        events = list(_events)
+    trace = [{'name': name, 'cat': name.split('.', 1)[0], 'ph': 'X', 'pid': pid,
+              'tid': thread, 'ts': (start - _origin) * 1e6, 'dur': duration * 1e6,
+              'args': args or {}}
+             for name, start, duration, thread, args in events]
+    with open(os.path.expanduser(path), 'w') as f:
+        json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('instrument_start', []).append((context, time.perf_counter()))
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('instrument_start')
+    if not starts:
+        return
+    _, start = starts.pop()
+    verb = statement.lstrip().split(None, 1)[0].lower() if statement.strip() else ''
+    args = None
+    if _tracing:
+        args = {'statement': statement[:STATEMENT_CHARS], 'executemany': executemany}
+    record('sql.' + verb, start, time.perf_counter(), args)
+
+
+def _handle_error(exception_context):
+    """Drop the start of a statement that raised, `after_cursor_execute` is not
+    called for it. Errors raised after the statement ran (e.g. while fetching
+    rows) have no start left for their execution context."""
+    conn = exception_context.connection
+    starts = conn.info.get('instrument_start') if conn is not None else None
+    if starts and starts[-1][0] is exception_context.execution_context:
+        starts.pop()
+
+
+def _install_sql_hooks():
+    """Time every statement of every engine, see `sqlalchemy.events.ConnectionEvents`."""
+    global _engine
+    if _engine is not None:
+        return
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(Engine, 'handle_error', _handle_error)
+    _engine = Engine
+
+
+def _remove_sql_hooks():
+    global _engine
+    if _engine is None:
+        return
+    from sqlalchemy import event
+    event.remove(_engine, 'before_cursor_execute', _before_cursor_execute)
+    event.remove(_engine, 'after_cursor_execute', _after_cursor_execute)
+    event.remove(_engine, 'handle_error', _handle_error)
+    _engine = None
@@ -0,0 +1,287 @@
+"""
+Versioned schema migrations for the library database.
+The schema version is stored in SQLite's `user_version` pragma; every migration
+runs in its own transaction together with the bump of the version by one. pysqlite
+does not put DDL statements in a transaction by itself, so `upgrade` begins it
+explicitly: a migration that fails leaves the schema as it was.
+"""
+import re
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+FOLD_FUNCTION = 'minerva_fold'
+BLOCKS_FUNCTION = 'minerva_blocks'
+TITLE_SORT_FUNCTION = 'minerva_title_sort'
+AUTHOR_SORT_FUNCTION = 'minerva_author_sort'
+
+FTS_SCHEMA = [
+    """CREATE VIRTUAL TABLE book_fts USING fts5(
+           isbn, title, author, location,
+           content='book', content_rowid='rowid', prefix='2 3')""",
+    """CREATE TRIGGER book_fts_insert AFTER INSERT ON book BEGIN
+           INSERT INTO book_fts(rowid, isbn, title, author, location)
+           VALUES (new.rowid, new.isbn, new.title, new.author, new.location);
+       END""",
+    """CREATE TRIGGER book_fts_delete AFTER DELETE ON book BEGIN
+           INSERT INTO book_fts(book_fts, rowid, isbn, title, author, location)
+           VALUES ('delete', old.rowid, old.isbn, old.title, old.author, old.location);
+       END""",
+    """CREATE TRIGGER book_fts_update
+           AFTER UPDATE OF isbn, title, author, location ON book BEGIN
+           INSERT INTO book_fts(book_fts, rowid, isbn, title, author, location)
+           VALUES ('delete', old.rowid, old.isbn, old.title, old.author, old.location);
+           INSERT INTO book_fts(rowid, isbn, title, author, location)
+           VALUES (new.rowid, new.isbn, new.title, new.author, new.location);
+       END""",
+    "INSERT INTO book_fts(book_fts) VALUES ('rebuild')",
+]
+
+
+def _columns(conn, table):
+    return {r[1] for r in conn.execute(text('PRAGMA table_info({})'.format(table)))}
+
+
+def _has_table(conn, name):
+    return conn.execute(
+        text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+        {'name': name}).scalar() is not None
+
+
+def create_book_table(conn):
+    """The original schema (databases created before migrations existed)."""
+    conn.execute(text("""CREATE TABLE IF NOT EXISTS book (
+                             isbn VARCHAR(250) NOT NULL PRIMARY KEY,
+                             title VARCHAR(250) NOT NULL,
+                             author VARCHAR(250) NOT NULL,
+                             own BOOLEAN, want BOOLEAN, read BOOLEAN,
+                             location VARCHAR(250))"""))
+
+
+def add_lookup_keys(conn):
+    """Add normalized author/title columns (see `utils.fold`), maintained by
+    triggers, and index them for duplicate checks."""
+    columns = _columns(conn, 'book')
+    for column in ('author_key', 'title_key'):
+        if column not in columns:
+            conn.execute(text('ALTER TABLE book ADD COLUMN {} VARCHAR(250)'
+                              .format(column)))
+    conn.execute(text('UPDATE book SET author_key = {0}(author), title_key = {0}(title)'
+                      .format(FOLD_FUNCTION)))
+
+    conn.execute(text('CREATE INDEX IF NOT EXISTS book_author_title '
+                      'ON book (author, title)'))
+    conn.execute(text('CREATE INDEX IF NOT EXISTS book_author_title_key '
+                      'ON book (author_key, title_key)'))
+    for name, event in (('book_keys_insert', 'INSERT'),
+                        ('book_keys_update', 'UPDATE OF author, title')):
+        conn.execute(text('DROP TRIGGER IF EXISTS {}'.format(name)))
+        conn.execute(text("""CREATE TRIGGER {0} AFTER {1} ON book BEGIN
+                                 UPDATE book SET author_key = {2}(new.author),
+                                                 title_key = {2}(new.title)
+                                 WHERE rowid = new.rowid;
+                             END""".format(name, event, FOLD_FUNCTION)))
+
+
+def narrow_fts_update_trigger(conn):
+    """Only reindex a book when one of the indexed columns changes, so that
+    maintaining the lookup keys does not touch the full-text index."""
+    if not _has_table(conn, 'book_fts'):
+        return
+    conn.execute(text('DROP TRIGGER IF EXISTS book_fts_update'))
+    conn.execute(text("""CREATE TRIGGER book_fts_update
+                             AFTER UPDATE OF isbn, title, author, location ON book BEGIN
+           INSERT INTO book_fts(book_fts, rowid, isbn, title, author, location)
+           VALUES ('delete', old.rowid, old.isbn, old.title, old.author, old.location);
+           INSERT INTO book_fts(rowid, isbn, title, author, location)
+           VALUES (new.rowid, new.isbn, new.title, new.author, new.location);
+       END"""))
+
+
+def add_block_keys(conn):
+    """Store the blocking keys of every book (see `dedupe.Record.blocking_keys`),
+    maintained by triggers, so that a new book is only compared with the books
+    sharing one of its keys."""
+    conn.execute(text('CREATE TABLE IF NOT EXISTS book_block ('
+                      'key VARCHAR(250) NOT NULL, book INTEGER NOT NULL)'))
+    conn.execute(text('DELETE FROM book_block'))
+    conn.execute(text('INSERT INTO book_block (key, book) '
+                      'SELECT j.value, book.rowid FROM book, '
+                      'json_each({}(book.isbn, book.author, book.title)) AS j'
+                      .format(BLOCKS_FUNCTION)))
+    conn.execute(text('CREATE INDEX IF NOT EXISTS book_block_key ON book_block (key)'))
+    conn.execute(text('CREATE INDEX IF NOT EXISTS book_block_book '
+                      'ON book_block (book)'))
+
+    insert = """INSERT INTO book_block (key, book)
+                SELECT j.value, new.rowid
+                FROM json_each({}(new.isbn, new.author, new.title)) AS j;
+             """.format(BLOCKS_FUNCTION)
+    delete = 'DELETE FROM book_block WHERE book = old.rowid;'
+    for name, event, body in (
+            ('book_block_insert', 'INSERT', insert),
+            ('book_block_update', 'UPDATE OF isbn, author, title', delete + insert),
+            ('book_block_delete', 'DELETE', delete)):
+        conn.execute(text('DROP TRIGGER IF EXISTS {}'.format(name)))
+        conn.execute(text('CREATE TRIGGER {} AFTER {} ON book BEGIN {} END'
+                          .format(name, event, body)))
+
+
+def add_jobs(conn):
+    """Store how far background jobs got, so that they resume after the program
+    was closed (see `enrich.Enricher`)."""
+    conn.execute(text('CREATE TABLE IF NOT EXISTS job ('
+                      'name VARCHAR(250) NOT NULL PRIMARY KEY, '
+                      'position INTEGER NOT NULL, updated INTEGER)'))
+
+
+def add_sort_keys(conn):
+    """Add the keys the book list sorts titles and authors by (see
+    `utils.title_sort_key` and `utils.author_sort_key`) and index them. The lookup
+    key triggers are replaced to maintain all keys with a single UPDATE."""
+    columns = _columns(conn, 'book')
+    for column in ('title_sort', 'author_sort'):
+        if column not in columns:
+            conn.execute(text('ALTER TABLE book ADD COLUMN {} VARCHAR(250)'
+                              .format(column)))
+    conn.execute(text('UPDATE book SET title_sort = {}(title), author_sort = {}(author)'
+                      .format(TITLE_SORT_FUNCTION, AUTHOR_SORT_FUNCTION)))
+
+    conn.execute(text('CREATE INDEX IF NOT EXISTS book_title_sort '
+                      'ON book (title_sort, author_sort)'))
+    conn.execute(text('CREATE INDEX IF NOT EXISTS book_author_sort '
+                      'ON book (author_sort, title_sort)'))
+    for name, event in (('book_keys_insert', 'INSERT'),
+                        ('book_keys_update', 'UPDATE OF author, title')):
+        conn.execute(text('DROP TRIGGER IF EXISTS {}'.format(name)))
+        conn.execute(text("""CREATE TRIGGER {0} AFTER {1} ON book BEGIN
+                                 UPDATE book SET author_key = {2}(new.author),
+                                                 title_key = {2}(new.title),
+                                                 author_sort = {3}(new.author),
+                                                 title_sort = {4}(new.title)
+                                 WHERE rowid = new.rowid;
+                             END""".format(name, event, FOLD_FUNCTION,
+                                           AUTHOR_SORT_FUNCTION, TITLE_SORT_FUNCTION)))
+
+
+def queue_block_keys(conn):
+    """Replace the block key triggers by plain SQL ones that only queue the books
+    whose keys are stale in `book_block_stale`, `dedupe.refresh_blocks` stores
+    their keys before they are needed. Writing books then neither computes keys
+    row by row nor needs Minerva's SQL functions for them."""
+    for name in ('book_block_insert', 'book_block_update', 'book_block_delete'):
+        conn.execute(text('DROP TRIGGER IF EXISTS {}'.format(name)))
+    conn.execute(text('CREATE TABLE IF NOT EXISTS book_block_stale ('
+                      'book INTEGER NOT NULL PRIMARY KEY)'))
+
+    queue = 'INSERT OR IGNORE INTO book_block_stale (book) VALUES (new.rowid);'
+    delete = ('DELETE FROM book_block WHERE book = old.rowid;'
+              'DELETE FROM book_block_stale WHERE book = old.rowid;')
+    for name, event, body in (
+            ('book_block_queue_insert', 'INSERT', queue),
+            ('book_block_queue_update', 'UPDATE OF isbn, author, title', queue),
+            ('book_block_delete', 'DELETE', delete)):
+        conn.execute(text('DROP TRIGGER IF EXISTS {}'.format(name)))
+        conn.execute(text('CREATE TRIGGER {} AFTER {} ON book BEGIN {} END'
+                          .format(name, event, body)))
+
+
+def skip_given_keys(conn):
+    """Only compute the lookup and sort keys of a new book if they were not
+    inserted with it, so that bulk imports (see `model.insert_books`) do not
+    update every row a second time."""
+    conn.execute(text('DROP TRIGGER IF EXISTS book_keys_insert'))
+    conn.execute(text("""CREATE TRIGGER book_keys_insert AFTER INSERT ON book
+                             WHEN new.author_key IS NULL OR new.title_key IS NULL
+                                  OR new.author_sort IS NULL OR new.title_sort IS NULL
+                         BEGIN
+                             UPDATE book SET author_key = {0}(new.author),
+                                             title_key = {0}(new.title),
+                                             author_sort = {1}(new.author),
+                                             title_sort = {2}(new.title)
+                             WHERE rowid = new.rowid;
+                         END""".format(FOLD_FUNCTION, AUTHOR_SORT_FUNCTION,
+                                       TITLE_SORT_FUNCTION)))
+
+
+def add_book_id(conn):
+    """Give books an explicit INTEGER PRIMARY KEY. The rowids of a table with a
+    TEXT key may be renumbered by VACUUM, but the full-text index, `book_block`, the
+    book list and background jobs all refer to books by rowid; an INTEGER PRIMARY
+    KEY is an alias of the rowid and never changes. The table is rebuilt from its
+    own CREATE TABLE statement (so defaults and constraints stay), the ISBN key
+    becoming UNIQUE, keeping every rowid, index and trigger."""
+    if 'id' in _columns(conn, 'book'):
+        return
+    columns = ', '.join(r[1] for r in conn.execute(text('PRAGMA table_info(book)')))
+    table = conn.execute(text("SELECT sql FROM sqlite_master "
+                              "WHERE type = 'table' AND name = 'book'")).scalar()
+    table = re.sub(r'\bPRIMARY\s+KEY\b', 'UNIQUE', table, flags=re.IGNORECASE)
+    table = re.sub(r'^CREATE\s+TABLE\s+("?)book\1\s*\(',
+                   'CREATE TABLE book_rebuilt (id INTEGER PRIMARY KEY, ', table,
+                   flags=re.IGNORECASE)
+    schema = [r[0] for r in conn.execute(text(
+        "SELECT sql FROM sqlite_master WHERE tbl_name = 'book' "
+        "AND type IN ('index', 'trigger') AND sql IS NOT NULL"))]
+
+    # Left behind by an attempt that failed before migrations were atomic
+    conn.execute(text('DROP TABLE IF EXISTS book_rebuilt'))
+    conn.execute(text(table))
+    conn.execute(text('INSERT INTO book_rebuilt (id, {0}) SELECT rowid, {0} FROM book'
+                      .format(columns)))
+    conn.execute(text('DROP TABLE book'))
+    conn.execute(text('ALTER TABLE book_rebuilt RENAME TO book'))
+    for statement in schema:
+        conn.execute(text(statement))
+
+
+def add_full_text_index(conn):
+    """Index the ISBN, title, author and location of every book for full-text
+    search (see `model.search_fts`), maintained by triggers. Without FTS5 support
+    in SQLite the library is searched without an index (see `model.has_fts`)."""
+    if _has_table(conn, 'book_fts'):
+        return
+    try:
+        for statement in FTS_SCHEMA:
+            conn.execute(text(statement))
+    except OperationalError:    # no such module: fts5
+        return
+
+
+MIGRATIONS = [
+    create_book_table,
+    add_lookup_keys,
+    narrow_fts_update_trigger,
+    add_block_keys,
+    add_jobs,
+    add_sort_keys,
+    queue_block_keys,
+    skip_given_keys,
+    add_book_id,
+    add_full_text_index,
+]
+
+
+def version(conn):
+    return conn.execute(text('PRAGMA user_version')).scalar()
+
+
+def upgrade(engine):
+    """Run all migrations the database has not seen yet.
+    :param engine: An SQLAlchemy engine.
+    :return: The new schema version."""
+    with engine.connect() as conn:
+        current = version(conn)
+    for number, migration in enumerate(MIGRATIONS[current:], start=current + 1):
+        with engine.connect() as conn:
+            dbapi_connection = conn.connection.connection
+            # Let the explicit BEGIN below, not pysqlite, control the transaction
+            isolation_level = dbapi_connection.isolation_level
+            dbapi_connection.isolation_level = None
+            try:
+                with conn.begin():
+                    conn.execute(text('BEGIN IMMEDIATE'))
+                    migration(conn)
+                    conn.execute(text('PRAGMA user_version = {:d}'.format(number)))
+            finally:
+                dbapi_connection.isolation_level = isolation_level
+    return len(MIGRATIONS)
@@ -1,13 +1,30 @@
 import gi
 gi.require_version('Gdk', '3.0')
 gi.require_version('Gtk', '3.0')
+import facets
+import instrument
 import model
+import os
 import sys
-from gi.repository import Gdk, Gtk
+from cache import ResponseCache
+from enrich import Enricher
+from gi.repository import Gdk, GLib, Gtk
+from gui.autosave import Autosave
 from gui.booklist import BookList
+from gui.covers import CoverCache
 from gui.dialogs.add_book import AddBookHandler
 from gui.utils import setup_info_bar
-from utils import read_config_file
+from fanout import create_providers
+from provider import PROVIDERS
+from utils import config_flag, log_error, read_config_file
+
+INSTRUMENT_INTERVAL = 2     # seconds between two updates of the timings summary
+FILTERS = [                 # label, facet
+    ('All', facets.ALL),
+    ('Books I own', 'own'),
+    ('Books I want', 'want'),
+    ('Books I\'ve read', 'read'),
+]
 
 
 class Minerva(Gtk.Application):
@@ -15,11 +32,31 @@ class Minerva(Gtk.Application):
         super().__init__(*args, **kwargs)
 
         self.config = read_config_file()
-        self.db     = model.get_db(self.config['db_path'])
-        self.books  = []
-        for book in self.db.query(model.Book).all():
-            self.books.append(book)
+        if config_flag(self.config['instrument']) or self.config['trace_path']:
+            instrument.enable(trace=bool(self.config['trace_path']))
+
+        with instrument.span('startup.db'):
+            self.db = model.get_db(self.config['db_path'])
+        with instrument.span('startup.providers'):
+            cache_path  = os.path.join(self.config['cache_dir'], 'responses.sqlite')
+            self.ol     = self._create_providers(ResponseCache(cache_path))
+            self.covers = CoverCache(os.path.join(self.config['cache_dir'], 'covers'))
+        self.enricher = None
+        with instrument.span('startup.window'):
+            self._build_window()
 
+    def _create_providers(self, cache):
+        """Create the providers listed in the config file (comma separated)."""
+        names = [n.strip() for n in self.config['providers'].split(',') if n.strip()]
+        unknown = [n for n in names if n not in PROVIDERS]
+        if not names or unknown:
+            log_error('Unknown providers in ~/.libraryrc: {} (available: {})'.format(
+                ', '.join(unknown), ', '.join(sorted(PROVIDERS))))
+        settings = {'catalog': {'path': self.config['catalog_path']}}
+        return create_providers(names, budget=float(self.config['search_budget']),
+                                settings=settings, cache=cache)
+
+    def _build_window(self):
         builder             = Gtk.Builder()
         builder.add_from_file('./gui/minerva.glade')
         self.window         = builder.get_object('minerva_main')
@@ -28,9 +65,14 @@ class Minerva(Gtk.Application):
         self.statusbar      = builder.get_object('statusbar')
         self.btn_edit       = builder.get_object('btn_edit')
         self.btn_delete     = builder.get_object('btn_delete')
-        self.books          = BookList(parent=self, books=self.books)
-        self.filters        = Gtk.ListStore(str)
+        with instrument.span('startup.booklist'):
+            self.books      = BookList(parent=self, db=self.db,
+                                       search_engine=self.config['search_engine'])
+        self.filters        = Gtk.TreeStore(str, str, str)    # label, facet, count
         self.search_entry   = Gtk.SearchEntry()
+        self.autosave       = Autosave(self.config['db_path'], self.books.changes,
+                                       on_saved=self.on_autosaved,
+                                       on_rejected=self.on_autosave_rejected)
 
         setup_info_bar(self)
         self.vbox.pack_end(self.info_bar, False, True, 0)
@@ -44,13 +86,71 @@ class Minerva(Gtk.Application):
         self.window.connect('key-press-event', self.on_key_press_event)
 
     def _setup_filters(self, store, view):
-        store.append(['All'])
-        store.append(['Books I own'])
-        store.append(['Books I\'ve read'])
+        """Fill the sidebar with the facets of `facets.Facets`. Locations are added
+        once the BookList has loaded them, see `update_filters`."""
+        for label, facet in FILTERS:
+            store.append(None, [label, facet, ''])
+        self.locations_iter = store.append(None, ['Locations', '', ''])
 
+        column = Gtk.TreeViewColumn('Filter')
         text = Gtk.CellRendererText()
+        column.pack_start(text, True)
+        column.add_attribute(text, 'text', 0)
+        count = Gtk.CellRendererText(xalign=1.0, foreground='gray')
+        column.pack_end(count, False)
+        column.add_attribute(count, 'text', 2)
         view.set_model(self.filters)
-        view.append_column(Gtk.TreeViewColumn('Filter', text, text=0))
+        view.append_column(column)
+
+        selection = view.get_selection()
+        selection.set_select_function(
+            lambda selection, model, path, selected: bool(model[path][1]))
+        selection.select_path(Gtk.TreePath.new_first())
+        selection.connect('changed', self.on_filter_selection_changed)
+
+    def update_filters(self, counts):
+        """Show the number of books per facet and the current locations.
+        :param dict counts: Maps facets to counts, see `facets.Facets.counts`."""
+        store = self.filters
+        for row in store:
+            if row[1]:
+                row[2] = '{:,}'.format(counts.get(row[1], 0))
+
+        locations = sorted(f for f in counts if f.startswith(facets.PREFIX))
+        children = store[self.locations_iter].iterchildren()
+        if [row[1] for row in children] != locations:
+            self._rebuild_locations(locations, counts)
+        else:
+            for row in store[self.locations_iter].iterchildren():
+                row[2] = '{:,}'.format(counts[row[1]])
+
+    def _rebuild_locations(self, locations, counts):
+        store       = self.filters
+        selection   = self.tv_filters.get_selection()
+        selected    = self.books.facet
+        # Removing the selected row must not switch the facet on the way
+        selection.handler_block_by_func(self.on_filter_selection_changed)
+        try:
+            it = store.iter_children(self.locations_iter)
+            while it is not None and store.remove(it):
+                pass
+            for facet in locations:
+                store.append(self.locations_iter, [facet[len(facets.PREFIX):], facet,
+                                                   '{:,}'.format(counts[facet])])
+            self.tv_filters.expand_row(store.get_path(self.locations_iter), False)
+            for row in store[self.locations_iter].iterchildren():
+                if row[1] == selected:
+                    selection.select_iter(row.iter)
+        finally:
+            selection.handler_unblock_by_func(self.on_filter_selection_changed)
+        if selection.count_selected_rows() == 0:
+            selection.select_path(Gtk.TreePath.new_first())
+
+    def on_filter_selection_changed(self, selection):
+        model, it = selection.get_selected()
+        facet = model[it][1] if it is not None else facets.ALL
+        if facet != self.books.facet:
+            self.books.set_facet(facet)
 
     def do_startup(self):
         Gtk.Application.do_startup(self)
@@ -61,28 +161,75 @@ class Minerva(Gtk.Application):
         self.window.show_all()
         self.search_entry.grab_focus()
         self.window.connect('delete-event', self.on_quit)
+        self.autosave.start()
+        if config_flag(self.config['enrich']):
+            self._start_enricher()
+        if instrument.enabled():
+            GLib.timeout_add_seconds(INSTRUMENT_INTERVAL, self.on_instrument_timeout)
+
+    def _start_enricher(self):
+        """Fill in missing ISBNs, authors and covers of the whole library in the
+        background, resuming where the last session stopped."""
+        self.enricher = Enricher(
+            model.get_engine(self.config['db_path']), self.ol,
+            on_changed=lambda changes: GLib.idle_add(self.on_enriched, changes),
+            on_covers=lambda covers: GLib.idle_add(self.covers.prefetch, covers))
+        self.enricher.start()
 
     def on_quit(self, action, param):
-        db = model.get_db(self.config['db_path'])
-        for e in self.books.data:
-            b = model.Book(isbn=e[0], title=e[1], author=e[2],
-                           own=e[3], want=e[4], read=e[5],
-                           location=e[6])
-            db.merge(b)
-        db.commit()
+        if self.enricher is not None:
+            self.enricher.stop()
+        self.autosave.stop()
+        self.autosave.flush(wait=True)
+        self.covers.shutdown()
+        if self.config['trace_path']:
+            instrument.export_trace(self.config['trace_path'])
         self.quit()
 
+    def on_instrument_timeout(self):
+        summary = instrument.summary()
+        if summary:
+            self.statusbar.push(self.statusbar.get_context_id('Timings'), summary)
+        return True
+
+    def on_enriched(self, changes):
+        self.books.update_books(changes)
+        self.statusbar.push(self.statusbar.get_context_id('Enrich'),
+                            'Completed the data of {} book(s)'.format(
+                                self.enricher.changed))
+        return False
+
+    def on_autosaved(self, count):
+        self.statusbar.push(self.statusbar.get_context_id('Autosave'),
+                            'Saved {} changed book(s)'.format(count))
+        return False
+
+    def on_autosave_rejected(self, rows):
+        self.statusbar.push(self.statusbar.get_context_id('Autosave'),
+                            'Could not save {} book(s), e.g. "{}": was it deleted or '
+                            'is the ISBN {} already in the library?'.format(
+                                len(rows), rows[0][1], rows[0][0]))
+        return False
+
     def on_add_book_dialog_close(self, dialog):
         if self.add_book_handler.added_book and not self.add_book_handler.is_new:
             self.show_message('"{}" is already in your library'.format(
                 self.add_book_handler.added_book.title))
         elif self.add_book_handler.added_book:
-            self.books.append(self.add_book_handler.added_book)
             self.db.add(self.add_book_handler.added_book)
             self.db.commit()
+            self.books.append(self.add_book_handler.added_book)
+
+    def on_books_scanned(self, books):
+        for book in books:
+            self.books.append(book)
+        self.statusbar.push(self.statusbar.get_context_id('Scan'),
+                            'Added {} scanned book(s)'.format(len(books)))
 
     def on_btn_add_book_clicked(self, button):
-        self.add_book_handler = AddBookHandler(self.db, self.window)
+        self.add_book_handler = AddBookHandler(self.db, self.window, self.ol,
+                                               self.covers,
+                                               on_added=self.on_books_scanned)
         self.add_book_handler.dialog.connect('destroy', self.on_add_book_dialog_close)
         self.add_book_handler.dialog.show_all()
 
@@ -103,9 +250,15 @@ class Minerva(Gtk.Application):
             response = dialog.run()
 
             if response == Gtk.ResponseType.YES:
-                self.db.delete(self.books.selected_book)
-                self.db.commit()
-                self.books.remove_selected()
+                # Pending edits (e.g. of the ISBN) have to reach the database first
+                self.autosave.flush(wait=True)
+                book = self.books.selected_book
+                if model.delete_book(self.db, self.books.selected_rowid):
+                    if book in self.db:
+                        self.db.expunge(book)
+                    self.books.remove_selected()
+                else:
+                    self.show_message('"{}" could not be deleted'.format(book.title))
             else:
                 pass
 
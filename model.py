@@ -1,17 +1,37 @@
 """
 Contains all database models and associated functions.
 """
-from sqlalchemy import Boolean, Column, String
-from sqlalchemy import create_engine
+import dedupe
+import migrations
+import re
+from sqlalchemy import Boolean, Column, Index, String
+from sqlalchemy import and_, bindparam, create_engine, event, literal_column, or_, \
+    select, text
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.orm.exc import NoResultFound
+from utils import author_sort_key, fold, title_sort_key
 
 Base = declarative_base()
 
+PRAGMAS = [
+    'PRAGMA journal_mode = WAL',        # readers do not block the writer
+    'PRAGMA synchronous = NORMAL',      # safe with WAL, no fsync per commit
+    'PRAGMA cache_size = -65536',       # 64 MiB page cache
+    'PRAGMA mmap_size = 268435456',     # 256 MiB memory-mapped I/O
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA busy_timeout = 5000',
+]
+
+FTS_TABLE   = 'book_fts'    # see `migrations.add_full_text_index`
+
 
 class Book(Base):
     __tablename__ = 'book'
+    COLUMNS     = ('isbn', 'title', 'author', 'own', 'want', 'read', 'location')
+
     isbn        = Column(String(250), primary_key=True)
     title       = Column(String(250), nullable=False)
     author      = Column(String(250), nullable=False)
@@ -19,12 +39,39 @@ class Book(Base):
     want        = Column(Boolean, default=False)
     read        = Column(Boolean, default=False)
     location    = Column(String(250), nullable=True)
+    # Maintained by triggers, see `migrations.add_lookup_keys`
+    author_key  = Column(String(250), nullable=True)
+    title_key   = Column(String(250), nullable=True)
+    # Maintained by triggers, see `migrations.add_sort_keys`
+    title_sort  = Column(String(250), nullable=True)
+    author_sort = Column(String(250), nullable=True)
+
+    __table_args__ = (
+        Index('book_author_title', 'author', 'title'),
+        Index('book_author_title_key', 'author_key', 'title_key'),
+        Index('book_title_sort', 'title_sort', 'author_sort'),
+        Index('book_author_sort', 'author_sort', 'title_sort'),
+    )
 
     def to_list(self):
         return [self.isbn, self.title, self.author,
                 self.own, self.want, self.read,
                 self.location]
 
+    @classmethod
+    def row_to_dict(cls, row):
+        """Convert a row as returned by `Book.to_list` into a column dictionary."""
+        return dict(zip(cls.COLUMNS, row))
+
+    @classmethod
+    def matching(cls, query):
+        """Build a filter matching books whose ISBN, title, author or location
+        contain `query` (case insensitive for ASCII characters)."""
+        return or_(cls.isbn.contains(query, autoescape=True),
+                   cls.title.contains(query, autoescape=True),
+                   cls.author.contains(query, autoescape=True),
+                   cls.location.contains(query, autoescape=True))
+
     @classmethod
     def exists(cls, isbn, db):
         """Checks whether a `Book` with given ISBN exists.
@@ -39,13 +86,12 @@ class Book(Base):
     @classmethod
     def exists_author_title(cls, author, title, db):
         """Checks whether a `Book` with given author and title exists.
+        Case, accents and punctuation are ignored (see `utils.fold`).
         :param str author: The author of the book.
         :param str title: The title of the book.
         :return: The database entry or `None` if not found."""
-        try:
-            return db.query(cls).filter(cls.title == title and cls.author == author).one()
-        except NoResultFound:
-            return None
+        return db.query(cls).filter(and_(cls.author_key == fold(author),
+                                         cls.title_key == fold(title))).first()
 
     @classmethod
     def fetch(cls, isbn, author, title, db):
@@ -56,11 +102,260 @@ class Book(Base):
         return cls.exists_author_title(author, title, db)
 
 
-def get_db(path):
+class BookCache(object):
+    """An identity map of books by ISBN and by normalized author and title.
+    Looking up a cached book does not touch the database. Edits made elsewhere
+    (e.g. in the book list) have to be applied with `update` to keep it coherent.
+    """
+
+    def __init__(self, db):
+        """Initializes the instance.
+        :param sqlalchemy.orm.session.Session db: The session books are loaded with.
+        """
+        self.db         = db
+        self._by_isbn   = {}
+        self._by_key    = {}    # (author_key, title_key) -> Book
+
+    def __len__(self):
+        return len(self._by_isbn)
+
+    @staticmethod
+    def _key(author, title):
+        return fold(author), fold(title)
+
+    def fetch(self, isbn, author, title):
+        """Like `Book.fetch`, but only queries the database on a cache miss.
+        Author and title only identify books without ISBN, another edition of the
+        same book is a different book."""
+        if isbn:
+            book = self._by_isbn.get(isbn)
+        else:
+            book = self._by_key.get(self._key(author, title))
+        if book is None:
+            if isbn:
+                book = Book.exists(isbn, self.db)
+            else:
+                book = Book.exists_author_title(author, title, self.db)
+            if book is not None:
+                self.add(book)
+        return book
+
+    def add(self, book):
+        self._by_isbn[book.isbn] = book
+        self._by_key[self._key(book.author, book.title)] = book
+
+    def remove(self, book):
+        if self._by_isbn.get(book.isbn) is book:
+            del self._by_isbn[book.isbn]
+        key = self._key(book.author, book.title)
+        if self._by_key.get(key) is book:
+            del self._by_key[key]
+
+    def update(self, isbn, row):
+        """Apply an edit to the cached book without marking it as modified in the
+        session (the change is saved separately, see `save_books`).
+        :param str isbn: The ISBN of the book before the edit.
+        :param row: The edited row (as returned by `Book.to_list`)."""
+        book = self._by_isbn.get(isbn)
+        if book is None:
+            return
+        self.remove(book)
+        if row[0] != isbn:
+            # The session identifies the book by its primary key, reload it later
+            self.db.expunge(book)
+            return
+        for column, value in zip(Book.COLUMNS, row):
+            set_committed_value(book, column, value)
+        self.add(book)
+
+
+def _on_connect(dbapi_connection, connection_record):
+    dbapi_connection.create_function(migrations.FOLD_FUNCTION, 1, fold)
+    dbapi_connection.create_function(migrations.BLOCKS_FUNCTION, 3,
+                                     dedupe.blocking_keys)
+    dbapi_connection.create_function(migrations.TITLE_SORT_FUNCTION, 1, title_sort_key)
+    dbapi_connection.create_function(migrations.AUTHOR_SORT_FUNCTION, 1, author_sort_key)
+    cursor = dbapi_connection.cursor()
+    for pragma in PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+
+
+def get_engine(path):
+    """Create an engine for the database at `path`, upgrading its schema if needed."""
     engine = create_engine('sqlite:///{}'.format(path))
+    event.listen(engine, 'connect', _on_connect)
+    migrations.upgrade(engine)
+    return engine
+
+
+def get_db(path):
+    engine = get_engine(path)
     Base.metadata.bind = engine
 
     DBSession = sessionmaker(bind=engine)
     db = DBSession()
 
     return db
+
+
+def save_books(db, changes, batch_size=500, rejected=None):
+    """Write modified books back to the database.
+    Only the given rows are touched, each batch is written with a single
+    executemany UPDATE inside its own transaction.
+    :param sqlalchemy.orm.session.Session db: An SQLAlchemy session.
+    :param dict changes: Maps the rowid of a book (its `id`, which unlike the
+    ISBN never changes) to its new row (as returned by `Book.to_list`).
+    :param int batch_size: The number of rows written per transaction.
+    :param dict rejected: Collects the changes the database refuses (e.g. an ISBN
+    another book already has) like `changes`. A batch with such a row is then
+    written row by row and only the refused rows are skipped; without this
+    dictionary the `IntegrityError` is raised. Rows that no longer exist (deleted
+    elsewhere) are collected here as well.
+    :return: The number of rows written."""
+    row_id  = literal_column('id')
+    stmt    = Book.__table__.update().where(row_id == bindparam('stored_id'))
+    items   = list(changes.items())
+    refused = []
+
+    for i in range(0, len(items), batch_size):
+        params = []
+        for rowid, row in items[i:i + batch_size]:
+            values = Book.row_to_dict(row)
+            values['stored_id'] = rowid
+            params.append(values)
+        try:
+            if db.execute(stmt, params).rowcount != len(params):
+                ids     = [values['stored_id'] for values in params]
+                found   = {r[0] for r in db.execute(
+                    select([row_id]).select_from(Book.__table__)
+                    .where(row_id.in_(ids)))}
+                refused.extend(rowid for rowid in ids if rowid not in found)
+            db.commit()
+        except IntegrityError:
+            db.rollback()
+            if rejected is None:
+                raise
+            for values in params:
+                try:
+                    if db.execute(stmt, values).rowcount == 0:
+                        refused.append(values['stored_id'])
+                    db.commit()
+                except IntegrityError:
+                    db.rollback()
+                    refused.append(values['stored_id'])
+                except Exception:
+                    db.rollback()
+                    raise
+        except Exception:
+            db.rollback()
+            raise
+    if rejected is not None:
+        rejected.update((rowid, changes[rowid]) for rowid in refused)
+    return len(items) - len(refused)
+
+
+def delete_book(db, rowid):
+    """Delete a book by its rowid. Unlike the ISBN of a loaded `Book`, the rowid
+    is still right after the ISBN was edited and saved elsewhere.
+    :param sqlalchemy.orm.session.Session db: An SQLAlchemy session.
+    :return: `True` if the book was deleted."""
+    deleted = db.execute(text('DELETE FROM book WHERE rowid = :rowid'),
+                         {'rowid': rowid}).rowcount
+    db.commit()
+    return deleted == 1
+
+
+def isbn_key(isbn):
+    """The form of an ISBN that duplicate checks compare: the ISBN-13 of a valid
+    ISBN, so that a book stored with its ISBN-10 is found by its ISBN-13 and vice
+    versa, anything else unchanged."""
+    if len(isbn) == 13 and isbn.isdigit():
+        return isbn
+    return dedupe.to_isbn13(isbn) or isbn
+
+
+def existing_isbns(bind):
+    """Return the ISBNs of all books as a set, for bulk duplicate checks.
+    ISBNs are normalized with `isbn_key`."""
+    return {isbn_key(r[0]) for r in bind.execute(select([Book.__table__.c.isbn]))}
+
+
+def insert_books(conn, rows, existing=None, chunk_size=1000):
+    """Insert many books with executemany INSERTs, skipping known ISBNs.
+    The lookup and sort keys are computed here, so that the insert trigger does
+    not have to update every row again (see `migrations.skip_given_keys`).
+    The caller is responsible for the transaction, e.g. `engine.begin()`.
+    :param conn: An SQLAlchemy connection.
+    :param rows: An iterable of dictionaries with the keys of `Book.COLUMNS`.
+    :param set existing: The ISBNs already stored, see `existing_isbns`. The set is
+    updated with the inserted ISBNs (normalized with `isbn_key`, so an ISBN-10 and
+    the ISBN-13 of the same book are duplicates).
+    :param int chunk_size: The number of rows sent per statement.
+    :return: A tuple with the number of inserted and skipped rows."""
+    if existing is None:
+        existing = existing_isbns(conn)
+    stmt        = Book.__table__.insert()
+    inserted    = 0
+    skipped     = 0
+    chunk       = []
+    for row in rows:
+        key = isbn_key(row['isbn'])
+        if key in existing:
+            skipped += 1
+            continue
+        existing.add(key)
+        chunk.append(dict(row, author_key=fold(row['author']),
+                          title_key=fold(row['title']),
+                          author_sort=author_sort_key(row['author']),
+                          title_sort=title_sort_key(row['title'])))
+        if len(chunk) == chunk_size:
+            conn.execute(stmt, chunk)
+            inserted += len(chunk)
+            chunk = []
+    if chunk:
+        conn.execute(stmt, chunk)
+        inserted += len(chunk)
+    return inserted, skipped
+
+
+def has_fts(bind):
+    """Whether the library has a full-text index, i.e. whether SQLite supported
+    FTS5 when `migrations.add_full_text_index` ran.
+    :param bind: An SQLAlchemy engine, connection or session."""
+    return bind.execute(
+        text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+        {'name': FTS_TABLE}).scalar() is not None
+
+
+def fts_query(query):
+    """Turn user input into an FTS5 query matching all words as prefixes."""
+    words = re.findall(r'\w+', query.lower())
+    return ' '.join('"{}"*'.format(w) for w in words) or None
+
+
+def _search_fts(bind, query, column, limit):
+    match = fts_query(query)
+    if match is None:
+        return []
+    statement = 'SELECT {} FROM book_fts WHERE book_fts MATCH :match ' \
+                'ORDER BY bm25(book_fts)'.format(column)
+    if limit is not None:
+        statement += ' LIMIT {:d}'.format(limit)
+    return [r[0] for r in bind.execute(text(statement), {'match': match})]
+
+
+def search_fts(bind, query, limit=None):
+    """Search the full-text index, see `has_fts`.
+    Every word of the query has to match the beginning of a word in the ISBN,
+    title, author or location of a book.
+    :param bind: An SQLAlchemy engine, connection or session.
+    :param str query: The search term.
+    :param int limit: The maximum number of results.
+    :return: The ISBNs of the matching books, best matches (by bm25) first."""
+    return _search_fts(bind, query, 'isbn', limit)
+
+
+def search_fts_rowids(bind, query, limit=None):
+    """Like `search_fts`, but returns the rowids of the matching books."""
+    return _search_fts(bind, query, 'rowid', limit)
@@ -1,10 +1,106 @@
+import instrument
 import isbnlib
 import requests
+import threading
+import time
 
+from collections import deque
+from collections.abc import Sequence
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from enum import Enum
-from exc import InvalidISBNError, NoResultsError
-from model import Book
-from urllib.parse import quote_plus
+from exc import InvalidISBNError, NoResultsError, ProviderError
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlencode
+from urllib3.util.retry import Retry
+
+TIMEOUT = (5, 15)   # seconds to connect and to wait for data
+BIBKEYS_BATCH = 50  # ISBNs per api/books request
+POOL_SIZE = 8       # connections kept alive per host
+RETRIES = 3         # retries of failed connections and 429/5xx responses
+BACKOFF = 0.5       # seconds, doubled on each retry
+RATE_LIMITS = {     # base URL -> (requests per second, burst)
+    'https://openlibrary.org/': (5, 10),
+    'https://covers.openlibrary.org/': (10, 20),
+}
+DEFAULT_RATE_LIMIT = (5, 10)
+PAGE_SIZE = 50      # results per search.json page
+SEARCH_FIELDS = ('title', 'author_name', 'isbn')
+BIBKEYS_FIELDS = ('title', 'authors', 'cover')     # kept of api/books data
+GOOGLE_PAGE_SIZE = 40   # the maximum number of results per volumes request
+
+PROVIDERS = {}      # name -> provider class, see `register`
+
+
+def register(name):
+    """Register a provider class under a name, see `create_provider`."""
+    def decorate(cls):
+        cls.NAME = name
+        PROVIDERS[name] = cls
+        return cls
+    return decorate
+
+
+def create_provider(name, **kwargs):
+    """Create a registered provider, e.g. from the `providers` config value.
+    :param str name: The name the provider was registered under.
+    :param kwargs: Passed on to the provider, e.g. `cache` or `timeout`.
+    :raises KeyError: If no provider has this name."""
+    return PROVIDERS[name](**kwargs)
+
+
+class RateLimiter(object):
+    """A thread-safe token bucket."""
+    def __init__(self, rate, burst):
+        """Initializes the instance.
+        :param float rate: The number of tokens added per second.
+        :param int burst: The maximum number of tokens.
+        """
+        self.rate       = rate
+        self.burst      = burst
+        self._tokens    = burst
+        self._updated   = time.monotonic()
+        self._lock      = threading.Lock()
+
+    def acquire(self):
+        """Take a token, waiting until one is available."""
+        while True:
+            with self._lock:
+                now             = time.monotonic()
+                self._tokens    = min(self.burst,
+                                      self._tokens + (now - self._updated) * self.rate)
+                self._updated   = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+_limiters       = {}
+_limiters_lock  = threading.Lock()
+
+
+def rate_limiter(base_url):
+    """Return the limiter shared by all requests to `base_url`, see `RATE_LIMITS`."""
+    with _limiters_lock:
+        limiter = _limiters.get(base_url)
+        if limiter is None:
+            limiter = RateLimiter(*RATE_LIMITS.get(base_url, DEFAULT_RATE_LIMIT))
+            _limiters[base_url] = limiter
+        return limiter
+
+
+def create_session(pool_size=POOL_SIZE, retries=RETRIES):
+    """Create a session that keeps connections alive and retries failed requests
+    (including 429 and 5xx responses) with exponential backoff."""
+    retry   = Retry(total=retries, backoff_factor=BACKOFF,
+                    status_forcelist=(429, 500, 502, 503, 504))
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                          max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
 
 
 class Identifier(Enum):
@@ -15,6 +111,8 @@ class Identifier(Enum):
 
 class Entry(object):
     """A single search result."""
+    __slots__ = ('isbns', 'title', 'author', 'covers')
+
     def __init__(self, isbns, title, author, covers=None):
         self.isbns  = isbns
         self.title  = title
@@ -27,6 +125,7 @@ class Entry(object):
     def to_book(self, isbn):
         """Convert the entry into a `model.Book`.
         :param str isbn: The ISBN number of the actual book."""
+        from model import Book
         return Book(isbn=isbn, title=self.title, author=self.author,
                     own=True, want=False, read=False)
 
@@ -36,8 +135,49 @@ class Entry(object):
                 self.own, self.want, self.read]
 
 
+class Entries(Sequence):
+    """The entries of a result, parsed from the raw API data when first accessed.
+    Results are often only partly looked at (e.g. the first rows of a page), so
+    most of them never need to be turned into `Entry` objects."""
+    __slots__ = ('_raw', '_entries', '_parse')
+
+    def __init__(self, raw, parse):
+        """Initializes the instance.
+        :param list raw: The raw data of every entry.
+        :param parse: Turns the raw data of an entry into an `Entry`.
+        """
+        self._raw       = raw
+        self._entries   = [None] * len(raw)
+        self._parse     = parse
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self._entries)))]
+        entry = self._entries[index]
+        if entry is None:
+            entry = self._entries[index] = self._parse(self._raw[index])
+        return entry
+
+    def __add__(self, other):
+        return list(self) + list(other)
+
+    def __radd__(self, other):
+        return list(other) + list(self)
+
+    def extend(self, entries):
+        """Append entries, e.g. the next page of results."""
+        entries         = list(entries)
+        self._raw       = list(self._raw) + [None] * len(entries)
+        self._entries  += entries
+
+
 class Result(object):
     """A generic API result class."""
+    __slots__ = ('start', 'num_found', 'page', 'results')
+
     def __init__(self, start, num_found, page, results):
         self.start = start
         self.num_found = num_found
@@ -45,11 +185,167 @@ class Result(object):
         self.results = results
 
 
-class OpenLibrary(object):
+def _only(data, fields):
+    """Keep only the given fields of a decoded JSON object (`None` stays `None`),
+    so that cached responses hold what is parsed and nothing else."""
+    if data is None:
+        return None
+    return {field: data[field] for field in fields if field in data}
+
+
+class ResultStream(object):
+    """Streams search results page by page.
+    While a page is being consumed, the next one is already being fetched on a
+    background thread."""
+
+    def __init__(self, fetch_page, describe=''):
+        """Initializes the instance and starts fetching the first page.
+        :param fetch_page: Called with an offset, returns the raw JSON of a page.
+        :param str describe: Describes the search in error messages.
+        """
+        self.num_found  = None
+        self.page       = 0
+        self._fetch     = fetch_page
+        self._describe  = describe
+        self._executor  = ThreadPoolExecutor(max_workers=1)
+        self._next      = self._executor.submit(fetch_page, 0)
+        self._offset    = 0
+
+    @property
+    def exhausted(self):
+        return self._next is None
+
+    def wait_next(self, timeout=None):
+        """Wait for the next page to arrive (or fail) without consuming it.
+        :param float timeout: The maximum number of seconds to wait.
+        :return: `False` if the page is still being fetched."""
+        if self._next is None:
+            return True
+        return bool(wait([self._next], timeout=timeout)[0])
+
+    def has_next(self):
+        """Wait for the next page without consuming it.
+        :raises minerva.exc.ProviderError: If Open Library could not be reached.
+        :return: `True` if it has any results, e.g. if the search found anything
+        before the first page was read."""
+        if self._next is None:
+            return False
+        raw = self._next.result()
+        return bool(raw and raw.get('docs'))
+
+    def next_page(self):
+        """Return the next page, waiting for it if it has not arrived yet.
+        :raises minerva.exc.NoResultsError: If the search has no results at all.
+        :raises minerva.exc.ProviderError: If Open Library could not be reached.
+        :return: The next page, or `None` after the last one.
+        :rtype: OpenLibrary.Result"""
+        if self._next is None:
+            return None
+        try:
+            raw = self._next.result()
+        except Exception:
+            self.close()
+            raise
+        docs = raw.get('docs') if raw else None
+        if not docs:
+            self.close()
+            if self.page == 0:
+                raise NoResultsError('No book was found with {}'.format(self._describe))
+            return None
+
+        result          = OpenLibrary.Result.parse_json(raw, page=self.page)
+        self.num_found  = result.num_found
+        self.page      += 1
+        self._offset   += len(docs)
+        if self._offset < self.num_found:
+            self._next = self._executor.submit(self._fetch, self._offset)
+        else:
+            self.close()
+        return result
+
+    def __iter__(self):
+        result = self.next_page()
+        while result is not None:
+            for entry in result.results:
+                yield entry
+            result = self.next_page()
+
+    def close(self):
+        """Stop fetching pages."""
+        self._next = None
+        self._executor.shutdown(wait=False)
+
+
+class HTTPProvider(object):
+    """The base of providers querying a web API.
+    Subclasses implement `isbn_search(isbn)` and `query_search(query, identifier)`
+    and may implement `query_pages` and `get_cover`."""
+    NAME    = None
+    LABEL   = None  # used in error messages
+
+    def __init__(self, base_url, timeout=TIMEOUT, cache=None, session=None):
+        """Initializes the instance.
+        :param str base_url: The URL of the API (expects a trailing slash).
+        :param timeout: The timeout of each request, see `requests.request`.
+        :param cache.ResponseCache cache: Caches responses (and missing results).
+        :param requests.Session session: The session to send requests with, see
+        `create_session`.
+        """
+        self.base_url = base_url
+        self.timeout  = timeout
+        self.cache    = cache
+        self.session  = session or create_session()
+        self.limiter  = rate_limiter(base_url)
+
+    def _cached(self, key):
+        if self.cache is None:
+            return False, None
+        return self.cache.get(self.base_url + key)
+
+    def _store(self, key, value):
+        if self.cache is not None:
+            self.cache.set(self.base_url + key, value)
+
+    def _get(self, url):
+        """Send a GET request, respecting the rate limit of the base URL.
+        :raises minerva.exc.ProviderError: If the request fails or times out."""
+        self.limiter.acquire()
+        try:
+            with instrument.span('http.' + self.NAME, url=url):
+                return self.session.get(url, timeout=self.timeout)
+        except requests.RequestException as e:
+            raise ProviderError('Could not reach {}: {}'.format(self.LABEL, e))
+
+    def _get_json(self, url):
+        """Send a GET request and decode the JSON response.
+        :raises minerva.exc.ProviderError: If the request fails, or the response is
+        not a successful JSON response (e.g. 429 or 5xx). Such answers must not be
+        cached as 'not found'."""
+        r = self._get(url)
+        if r.status_code != 200:
+            raise ProviderError('{} answered with status {}'.format(
+                self.LABEL, r.status_code))
+        try:
+            return r.json()
+        except ValueError:
+            raise ProviderError('{} sent an invalid response'.format(self.LABEL))
+
+    @staticmethod
+    def _to_isbn13(isbn):
+        isbn13 = isbnlib.to_isbn13(isbn)
+        if not isbn13: raise InvalidISBNError(isbn + ' is not a valid ISBN number.')
+        return isbn13
+
+
+@register('openlibrary')
+class OpenLibrary(HTTPProvider):
     """Provides access to the Open Library API."""
+    LABEL = 'Open Library'
 
     class Entry(Entry):
         """Handles entries from the Open Library API."""
+        __slots__ = ()
+
         @classmethod
         def parse(cls, raw):
             if 'author_name' in raw.keys():
@@ -64,26 +360,24 @@ class OpenLibrary(object):
 
     class Result(Result):
         """Handles results from the Open Library API."""
+        __slots__ = ()
+
         @classmethod
-        def parse_json(cls, raw):
+        def parse_json(cls, raw, page=0):
             """Parses Open Library JSON responses into a SearchResult.
-            :param str raw: The raw JSON data.
-            :return: A `SearchResult` containing the parsed data."""
-            start = raw['start']
-            num_found = raw['num_found']
-            page = 0
-            results = []
-
-            for r in raw['docs']:
-                results.append(OpenLibrary.Entry.parse(r))
-            return cls(start=start, num_found=num_found, page=page, results=results)
-
-    def __init__(self, base_url='https://openlibrary.org/'):
+            :param dict raw: The decoded JSON data.
+            :param int page: The number of the page the data belongs to.
+            :return: A `SearchResult` whose entries are parsed when accessed."""
+            return cls(start=raw['start'], num_found=raw['num_found'], page=page,
+                       results=Entries(raw['docs'], OpenLibrary.Entry.parse))
+
+    def __init__(self, base_url='https://openlibrary.org/', timeout=TIMEOUT, cache=None,
+                 session=None):
         """Initializes the instance.
         :param str base_url: The URL pointing to the Open Library instance
         (expects a trailing slash).
         """
-        self.base_url = base_url
+        super().__init__(base_url, timeout=timeout, cache=cache, session=session)
 
     def isbn_search(self, isbn):
         """Search for a book by its ISBN number.
@@ -92,21 +386,102 @@ class OpenLibrary(object):
         ISBN-13 number.
         :raises minerva.exc.NoResultsError: If Open Library does not have an entry with
         ISBN `isbn`.
+        :raises minerva.exc.ProviderError: If Open Library could not be reached.
         :return: A `Book` containing the retrieved data.
         :rtype: OpenLibrary.Entry"""
-        isbn13 = isbnlib.to_isbn13(isbn)
-        if isbn13 is None: raise InvalidISBNError(isbn + ' is not a valid ISBN number.')
-        r = requests.get(
-            self.base_url + 'api/books?bibkeys=ISBN:' + isbn13 + '&jscmd=data&format=json'
-        )
-        if len(r.json()) > 0:
-            data        = r.json()['ISBN:{}'.format(isbn13)]
+        isbn13 = self._to_isbn13(isbn)
+        key = 'isbn:' + isbn13
+        hit, data = self._cached(key)
+        if not hit:
+            data = self._fetch_bibkeys([isbn13]).get('ISBN:' + isbn13)
+            self._store(key, _only(data, BIBKEYS_FIELDS))
+        return self._isbn_entry(isbn, isbn13, data)
+
+    def _fetch_bibkeys(self, isbns13):
+        """Fetch the data of several ISBN-13 numbers with a single request.
+        :return: A dictionary mapping 'ISBN:<isbn>' to the data of found books.
+        :raises minerva.exc.ProviderError: If Open Library could not answer."""
+        return self._get_json(self.base_url + 'api/books?bibkeys=' +
+                              ','.join('ISBN:' + i for i in isbns13) +
+                              '&jscmd=data&format=json')
+
+    @staticmethod
+    def _isbn_entry(isbn, isbn13, data):
+        if data is not None:
             entry       = OpenLibrary.Entry.parse(data)
             entry.isbns = [isbn13]
             return entry
         else:
             raise NoResultsError('No book was found with the ISBN ' + isbn)
 
+    def isbn_search_many(self, isbns, batch_size=BIBKEYS_BATCH, max_workers=4):
+        """Search for several books by their ISBN numbers.
+        ISBNs are normalized to ISBN-13 and looked up in batches (one request per
+        `batch_size` ISBNs), with up to `max_workers` requests running at once. The
+        input is consumed lazily, so it can be a long stream.
+        :param isbns: An iterable of ISBN numbers.
+        :param int batch_size: The number of ISBNs per request.
+        :param int max_workers: The number of concurrent requests.
+        :return: A generator of `(isbn, result)` tuples in order of completion, where
+        `result` is an `OpenLibrary.Entry` or the exception `isbn_search` would have
+        raised for this ISBN."""
+        ready   = deque()   # results waiting to be yielded
+        running = {}        # Future -> [(isbn, isbn13)]
+
+        def batches():
+            batch = []
+            for isbn in isbns:
+                try:
+                    isbn13 = self._to_isbn13(isbn)
+                except InvalidISBNError as e:
+                    ready.append((isbn, e))
+                    continue
+                hit, data = self._cached('isbn:' + isbn13)
+                if hit:
+                    ready.append((isbn, self._result_or_error(isbn, isbn13, data)))
+                    continue
+                batch.append((isbn, isbn13))
+                if len(batch) == batch_size:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+
+        def collect(timeout=None):
+            done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                ready.extend(self._batch_results(future, running.pop(future)))
+
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            for batch in batches():
+                running[pool.submit(self._fetch_bibkeys, [b[1] for b in batch])] = batch
+                collect(timeout=0 if len(running) < max_workers * 2 else None)
+                while ready:
+                    yield ready.popleft()
+            while running or ready:
+                if running:
+                    collect()
+                while ready:
+                    yield ready.popleft()
+
+    def _batch_results(self, future, batch):
+        try:
+            found = future.result()
+        except ProviderError as e:
+            for isbn, _ in batch:
+                yield isbn, e
+            return
+        for isbn, isbn13 in batch:
+            data = found.get('ISBN:' + isbn13)
+            self._store('isbn:' + isbn13, _only(data, BIBKEYS_FIELDS))
+            yield isbn, self._result_or_error(isbn, isbn13, data)
+
+    def _result_or_error(self, isbn, isbn13, data):
+        try:
+            return self._isbn_entry(isbn, isbn13, data)
+        except NoResultsError as e:
+            return e
+
     def query_search(self, query, identifier):
         """Search for books by querying an identifier.
         Queries the Open Library API for the given query. This is equivalent to calling
@@ -115,14 +490,50 @@ class OpenLibrary(object):
         :param model.Identifier identifier: The identifier to query by
         (except Identifier.ISBN).
         :raises minerva.exc.NoResultsError: If the number of returned results is 0.
+        :raises minerva.exc.ProviderError: If Open Library could not be reached.
         :return: The retrieved results.
         :rtype: OpenLibrary.Result
         """
-        url = self.base_url + 'search.json?' + identifier.value + '=' + quote_plus(query)
-        r = requests.get(url)
-        if r.status_code == 200 and len(r.json()) > 0:
-            return OpenLibrary.Result.parse_json(r.json())
-        else: raise NoResultsError('No book was found with the ' + identifier + query)
+        data = self._search_page(query, identifier, fields=SEARCH_FIELDS)
+        if data is not None and data.get('docs'):
+            return OpenLibrary.Result.parse_json(data)
+        else:
+            raise NoResultsError(
+                'No book was found with the {} {}'.format(identifier.value, query))
+
+    def _search_page(self, query, identifier, offset=0, limit=None, fields=None):
+        """Fetch the raw JSON of a single page of search results.
+        :raises minerva.exc.ProviderError: If Open Library could not answer.
+        :return: The decoded response, or `None` if the page has no results."""
+        params = [(identifier.value, query)]
+        if offset:
+            params.append(('offset', offset))
+        if limit is not None:
+            params.append(('limit', limit))
+        if fields is not None:
+            params.append(('fields', ','.join(fields)))
+
+        key = 'query:{}:{}:{}:{}:{}'.format(
+            identifier.value, ' '.join(query.lower().split()), offset, limit,
+            ','.join(fields or ()))
+        hit, data = self._cached(key)
+        if not hit:
+            data = self._get_json(self.base_url + 'search.json?' + urlencode(params))
+            if not (data and data.get('docs')):
+                data = None     # stored as a negative entry, which expires sooner
+            self._store(key, data)
+        return data
+
+    def query_pages(self, query, identifier, limit=PAGE_SIZE, fields=SEARCH_FIELDS):
+        """Search for books like `query_search`, but page through all results.
+        Only the given fields are requested. The first page is requested right
+        away, every further page while the previous one is being consumed.
+        :param int limit: The number of results per page.
+        :param fields: The fields Open Library should return for each result.
+        :rtype: ResultStream"""
+        return ResultStream(
+            lambda offset: self._search_page(query, identifier, offset, limit, fields),
+            describe='the {} {}'.format(identifier.value, query))
 
     def get_cover(self, entry, size='M'):
         """Retrieve the URL for the cover of the given entry.
@@ -132,3 +543,76 @@ class OpenLibrary(object):
         # @TODO: Is oclc better than isbn?
         return 'https://covers.openlibrary.org/b/ISBN/{}-{}.jpg'.format(
             entry.isbns[0], size)
+
+
+@register('googlebooks')
+class GoogleBooks(HTTPProvider):
+    """Provides access to the Google Books API (no API key needed)."""
+    LABEL = 'Google Books'
+
+    class Entry(Entry):
+        """Handles volumes from the Google Books API."""
+        __slots__ = ()
+
+        @classmethod
+        def parse(cls, raw):
+            info    = raw.get('volumeInfo', {})
+            authors = info.get('authors') or ['Unknown']
+            isbns   = [i['identifier'] for i in info.get('industryIdentifiers', [])
+                       if i.get('type') == 'ISBN_13'] or \
+                [isbnlib.to_isbn13(i['identifier'])
+                 for i in info.get('industryIdentifiers', [])
+                 if i.get('type') == 'ISBN_10'] or None
+            title   = info.get('title', '')
+            if info.get('subtitle'):
+                title = '{}: {}'.format(title, info['subtitle'])
+            return cls(isbns=isbns, title=title, author=authors[0],
+                       covers=info.get('imageLinks'))
+
+    def __init__(self, base_url='https://www.googleapis.com/books/v1/', timeout=TIMEOUT,
+                 cache=None, session=None):
+        super().__init__(base_url, timeout=timeout, cache=cache, session=session)
+
+    def _volumes(self, query, limit=GOOGLE_PAGE_SIZE):
+        """Fetch the raw JSON of a volumes search.
+        :return: The decoded response or `None` if nothing was found."""
+        key = 'volumes:{}:{}'.format(query, limit)
+        hit, data = self._cached(key)
+        if not hit:
+            data = self._get_json(self.base_url + 'volumes?' +
+                                  urlencode([('q', query), ('maxResults', limit)]))
+            data = data if data.get('items') else None
+            self._store(key, data)
+        return data
+
+    def isbn_search(self, isbn):
+        """Search for a book by its ISBN number, see `OpenLibrary.isbn_search`.
+        :rtype: GoogleBooks.Entry"""
+        isbn13 = self._to_isbn13(isbn)
+        data = self._volumes('isbn:' + isbn13, limit=1)
+        if data is None:
+            raise NoResultsError('No book was found with the ISBN ' + isbn)
+        entry       = GoogleBooks.Entry.parse(data['items'][0])
+        entry.isbns = [isbn13]
+        return entry
+
+    def query_search(self, query, identifier):
+        """Search for books by title or author, see `OpenLibrary.query_search`.
+        :rtype: Result"""
+        prefix = {Identifier.TITLE: 'intitle:', Identifier.AUTHOR: 'inauthor:'}
+        data = self._volumes(prefix[identifier] + query)
+        if data is None:
+            raise NoResultsError(
+                'No book was found with the {} {}'.format(identifier.value, query))
+        results = Entries(data['items'], GoogleBooks.Entry.parse)
+        return Result(start=0, num_found=data.get('totalItems', len(results)), page=0,
+                      results=results)
+
+    def get_cover(self, entry, size='M'):
+        """Retrieve the URL for the cover of the given entry, see
+        `OpenLibrary.get_cover`."""
+        sizes = {'S': 'smallThumbnail', 'M': 'thumbnail', 'L': 'thumbnail'}
+        if entry.covers and sizes[size] in entry.covers:
+            return entry.covers[sizes[size]]
+        return 'https://covers.openlibrary.org/b/ISBN/{}-{}.jpg'.format(
+            entry.isbns[0], size)
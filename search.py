@@ -0,0 +1,155 @@
+"""
+Search engines over the library used by the BookList.
+"""
+from collections import defaultdict
+from model import Book, has_fts, search_fts_rowids
+from sqlalchemy import func, literal_column, select
+
+GRAM = 3
+SEPARATOR = '\n'
+INDEX_LIMIT = 200000    # larger libraries use full-text search by default
+
+
+class SearchIndex(object):
+    """A trigram index for case insensitive substring search.
+    Each book is stored once as a lowercased string of its ISBN, title, author and
+    location. Queries with at least three characters only look at books sharing all
+    of the query's trigrams; a query extending the previous one only looks at the
+    previous result. Keys are arbitrary hashable values (the BookList uses rowids).
+    """
+    RANKED = False
+
+    def __init__(self):
+        self._text      = {}                # key -> lowercased searchable text
+        self._grams     = defaultdict(set)  # trigram -> keys
+        self._last      = (None, None)      # previous query and its result
+
+    def __len__(self):
+        return len(self._text)
+
+    def __contains__(self, key):
+        return key in self._text
+
+    @classmethod
+    def from_db(cls, bind):
+        """Build an index over all books.
+        :param bind: An SQLAlchemy engine or connection, so the index can be built
+        on a worker thread without touching the GUI's session.
+        :return: The index, keyed by the books' rowids."""
+        table   = Book.__table__
+        query   = select([literal_column('book.rowid'), table.c.isbn, table.c.title,
+                          table.c.author, table.c.location])
+        index   = cls()
+        for rowid, isbn, title, author, location in bind.execute(query):
+            index.add(rowid, isbn, title, author, location)
+        return index
+
+    @staticmethod
+    def _grams_of(text):
+        return {text[i:i + GRAM] for i in range(len(text) - GRAM + 1)
+                if SEPARATOR not in text[i:i + GRAM]}
+
+    def add(self, key, isbn, title, author, location):
+        """Add a book to the index (or replace it if the key is already known)."""
+        if key in self._text:
+            self.remove(key)
+        text = SEPARATOR.join((isbn or '', title or '', author or '',
+                               location or '')).lower()
+        self._text[key] = text
+        for gram in self._grams_of(text):
+            self._grams[gram].add(key)
+        self._last = (None, None)
+
+    def update(self, key, row):
+        """Update a book from a row as returned by `model.Book.to_list`."""
+        self.add(key, row[0], row[1], row[2], row[6])
+
+    def remove(self, key):
+        """Remove a book from the index, unknown keys are ignored."""
+        text = self._text.pop(key, None)
+        if text is None:
+            return
+        for gram in self._grams_of(text):
+            keys = self._grams[gram]
+            keys.discard(key)
+            if not keys:
+                del self._grams[gram]
+        self._last = (None, None)
+
+    def _candidates(self, query):
+        last_query, last_result = self._last
+        if last_query is not None and last_query in query:
+            return last_result
+        if len(query) < GRAM:
+            return self._text.keys()
+
+        postings = []
+        for gram in self._grams_of(query):
+            keys = self._grams.get(gram)
+            if not keys:
+                return ()
+            postings.append(keys)
+        postings.sort(key=len)
+        return postings[0].intersection(*postings[1:])
+
+    def search(self, query):
+        """Find all books containing the query in one of their fields.
+        :param str query: The search term, case is ignored.
+        :return: The set of matching keys, or `None` if the query is empty."""
+        query = query.lower()
+        if not query:
+            return None
+        text    = self._text
+        result  = {k for k in self._candidates(query) if query in text[k]}
+        self._last = (query, result)
+        return result
+
+
+class FullTextSearch(object):
+    """Searches the SQLite FTS5 index instead of keeping the library in memory.
+    Has the same interface as `SearchIndex`; the index is kept up to date by
+    database triggers, so edits only show up in results once they are saved.
+    Keys are rowids, results are ranked by relevance."""
+    RANKED = True
+
+    def __init__(self, bind):
+        self.bind = bind
+
+    @classmethod
+    def from_db(cls, bind):
+        """Use the full-text index of the library.
+        :return: The search engine, or `None` if the library has no index."""
+        return cls(bind) if has_fts(bind) else None
+
+    def add(self, key, isbn, title, author, location):
+        pass
+
+    def update(self, key, row):
+        pass
+
+    def remove(self, key):
+        pass
+
+    def search(self, query):
+        """Find all books matching all words of the query by prefix.
+        :return: A list of matching rowids, or `None` if the query is empty."""
+        if not query.strip():
+            return None
+        return search_fts_rowids(self.bind, query)
+
+
+def create_engine(bind, engine='auto'):
+    """Build the search engine selected in the config file.
+    :param bind: An SQLAlchemy engine.
+    :param str engine: 'index' for `SearchIndex`, 'fts' for `FullTextSearch` or
+    'auto' to pick one by library size.
+    :return: The engine, or `None` if no engine is available."""
+    if engine == 'auto':
+        count   = bind.execute(
+            select([func.count()]).select_from(Book.__table__)).scalar()
+        engine  = 'index' if count <= INDEX_LIMIT else 'fts'
+    if engine == 'fts':
+        fts = FullTextSearch.from_db(bind)
+        if fts is not None:
+            return fts
+    return SearchIndex.from_db(bind)
@@ -0,0 +1,434 @@
+"""
+A read-only JSON API over the library for other programs on the network.
+
+    GET /books/<isbn>           a single book
+    GET /books?after=&limit=    a page of books in rowid order, with the cursor of
+                                the next page (`facet` restricts it, see `facets`)
+    GET /books.jsonl            all books as JSON Lines, streamed
+    GET /search?q=&limit=       books matching all words, best matches first
+    GET /facets?q=              the number of books per sidebar facet
+
+The server runs on asyncio, the queries on a small pool of read-only SQLite
+connections in worker threads, so slow clients never hold a connection. Every
+response carries an ETag derived from SQLite's `data_version`: until another
+program (e.g. the GUI) commits a change, identical requests are answered from
+memory, and clients sending `If-None-Match` get a bodiless 304.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import queue
+import re
+import sqlite3
+import threading
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from facets import ALL, FLAGS, PREFIX
+from model import FTS_TABLE, Book, fts_query
+from urllib.parse import parse_qs, unquote, urlsplit
+from utils import log_warning
+
+POOL_SIZE       = 4         # read-only connections
+PAGE_SIZE       = 100       # books per page by default
+MAX_PAGE_SIZE   = 1000
+STREAM_BATCH    = 500       # rows fetched per chunk of a streamed listing
+CACHED          = 256       # responses kept in memory per data version
+MAX_LINE        = 8192      # bytes of the request line and of each header
+MAX_HEADERS     = 100
+KEEP_ALIVE      = 60        # seconds an idle connection is kept open
+
+SELECT = 'SELECT {}, rowid FROM book'.format(', '.join(Book.COLUMNS))
+REASONS = {200: 'OK', 304: 'Not Modified', 400: 'Bad Request', 404: 'Not Found',
+           405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message=None):
+        super().__init__(message or REASONS[status])
+        self.status = status
+
+
+def _book(row):
+    """Turn a row of `SELECT` into a JSON object."""
+    book = dict(zip(Book.COLUMNS, row))
+    for flag in FLAGS:
+        book[flag] = bool(book[flag])
+    return book
+
+
+def facet_clause(facet):
+    """Turn a facet (see `facets.Facets`) into a WHERE clause and its parameters.
+    :raises HTTPError: For unknown facets."""
+    if facet in (None, '', ALL):
+        return '1', ()
+    if facet in FLAGS:
+        return '{} = 1'.format(facet), ()
+    if facet.startswith(PREFIX):
+        return 'location = ?', (facet[len(PREFIX):],)
+    raise HTTPError(400, 'Unknown facet ' + facet)
+
+
+class ConnectionPool(object):
+    """A fixed number of read-only connections to the library, shared by the
+    worker threads. Also tracks the version of the data, see `version`."""
+
+    def __init__(self, path, size=POOL_SIZE):
+        """Initializes the instance.
+        :param str path: The library database.
+        :param int size: The number of connections.
+        """
+        self.path           = path
+        self._idle          = queue.Queue()
+        for _ in range(size):
+            self._idle.put(self._connect())
+        self.fts            = self._has_fts()
+        self._watcher       = self._connect()
+        self._watch_lock    = threading.Lock()
+        self._data_version  = None
+        self._generation    = 0
+
+    def _connect(self):
+        uri = 'file:{}?mode=ro'.format(os.path.abspath(os.path.expanduser(self.path)))
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        conn.execute('PRAGMA query_only = ON')
+        conn.execute('PRAGMA busy_timeout = 5000')
+        return conn
+
+    def _has_fts(self):
+        return bool(self.run(lambda conn: conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+            (FTS_TABLE,)).fetchone()))
+
+    def run(self, function):
+        """Call `function(connection)` with a connection of the pool (blocking)."""
+        conn = self._idle.get()
+        try:
+            return function(conn)
+        finally:
+            self._idle.put(conn)
+
+    def version(self):
+        """A number that changes whenever another connection committed a change.
+        `PRAGMA data_version` only compares within one connection, so a dedicated
+        connection watches it."""
+        with self._watch_lock:
+            data_version = self._watcher.execute('PRAGMA data_version').fetchone()[0]
+            if data_version != self._data_version:
+                self._data_version  = data_version
+                self._generation   += 1
+            return self._generation
+
+    def close(self):
+        while not self._idle.empty():
+            self._idle.get().close()
+        self._watcher.close()
+
+
+class Library(object):
+    """The queries behind the endpoints. All methods block, see `Server`."""
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def book(self, isbn):
+        rows = self.pool.run(lambda conn: conn.execute(
+            SELECT + ' WHERE isbn = ?', (isbn,)).fetchall())
+        if not rows:
+            raise HTTPError(404, 'No book with the ISBN ' + isbn)
+        return _book(rows[0])
+
+    def page(self, after=0, limit=PAGE_SIZE, facet=None):
+        """A page of books with a rowid above `after` (keyset pagination).
+        :return: The books and the cursor of the next page (or `None`)."""
+        where, params = facet_clause(facet)
+        rows = self.pool.run(lambda conn: conn.execute(
+            SELECT + ' WHERE rowid > ? AND {} ORDER BY rowid LIMIT ?'.format(where),
+            (after,) + params + (limit + 1,)).fetchall())
+        following = rows[limit - 1][-1] if len(rows) > limit else None
+        return {'books': [_book(r) for r in rows[:limit]], 'next': following}
+
+    def batches(self, after=0, facet=None, size=STREAM_BATCH):
+        """Yield all books after a rowid as lists of rows, one query per batch so
+        that no connection is held while a chunk is being sent."""
+        while True:
+            rows = self.page(after, size, facet)
+            if rows['books']:
+                yield rows['books']
+            if rows['next'] is None:
+                return
+            after = rows['next']
+
+    def _matching(self, query):
+        """A query selecting the rowids of books matching all words of `query`
+        (with the full-text index if the library has one), best matches first.
+        :return: The SQL and its parameters, or `None` if `query` has no words."""
+        if self.pool.fts:
+            match = fts_query(query)
+            if match is None:
+                return None
+            return 'SELECT rowid FROM {0} WHERE {0} MATCH ? ORDER BY bm25({0})' \
+                .format(FTS_TABLE), (match,)
+        words = re.findall(r'\w+', query.lower())
+        if not words:
+            return None
+        return 'SELECT rowid FROM book WHERE ' + ' AND '.join(
+            "(isbn || ' ' || title || ' ' || author || ' ' || "
+            "coalesce(location, '')) LIKE ?" for _ in words), \
+            tuple('%{}%'.format(w) for w in words)
+
+    def search(self, query, limit=PAGE_SIZE, offset=0):
+        matching = self._matching(query)
+        if matching is None:
+            return {'query': query, 'books': []}
+
+        def run(conn):
+            rowids = [r[0] for r in conn.execute(
+                matching[0] + ' LIMIT {:d} OFFSET {:d}'.format(limit, offset),
+                matching[1])]
+            rows = {r[-1]: r for r in conn.execute(
+                SELECT + ' WHERE rowid IN ({})'.format(','.join('?' * len(rowids))),
+                rowids)} if rowids else {}
+            return [_book(rows[rowid]) for rowid in rowids if rowid in rows]
+        return {'query': query, 'books': self.pool.run(run)}
+
+    def facets(self, query=None):
+        """Count the books of every facet, of the search results if `query` is
+        given."""
+        where, params = 'WHERE 1', ()
+        if query:
+            matching = self._matching(query)
+            if matching is None:
+                return {ALL: 0}
+            where, params = 'WHERE rowid IN ({})'.format(matching[0]), matching[1]
+
+        def run(conn):
+            counts = conn.execute(
+                'SELECT count(*), total(own), total(want), total(read) FROM book ' +
+                where, params).fetchone()
+            result = {ALL: counts[0]}
+            result.update((flag, int(n)) for flag, n in zip(FLAGS, counts[1:]))
+            for location, n in conn.execute(
+                    'SELECT location, count(*) FROM book {} AND location IS NOT NULL '
+                    "AND location != '' GROUP BY location".format(where), params):
+                result[PREFIX + location] = n
+            return result
+        return self.pool.run(run)
+
+
+def _int(params, name, default, low=0, high=None):
+    try:
+        value = int(params.get(name, [default])[0])
+    except ValueError:
+        raise HTTPError(400, '{} must be a number'.format(name))
+    if value < low or (high is not None and value > high):
+        raise HTTPError(400, '{} must be between {} and {}'.format(name, low, high))
+    return value
+
+
+class Server(object):
+    """Answers HTTP/1.1 requests (with keep-alive) on an asyncio event loop."""
+
+    def __init__(self, path, pool_size=POOL_SIZE):
+        """Initializes the instance.
+        :param str path: The library database, opened read-only.
+        :param int pool_size: The number of database connections and worker threads.
+        """
+        self.pool       = ConnectionPool(path, pool_size)
+        self.library    = Library(self.pool)
+        self.executor   = ThreadPoolExecutor(max_workers=pool_size)
+        self._cache     = OrderedDict()     # target -> Future of the body
+        self._version   = None
+        # Versions restart with the server, ETags of an earlier run must not match
+        self._instance  = os.urandom(4).hex()
+
+    async def _blocking(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, function, *args)
+
+    def _route(self, path, params):
+        """Find the query answering a request.
+        :return: A function returning the JSON of the response, or, for streamed
+        responses, a tuple `('stream', batches)`."""
+        if path == '/books':
+            after   = _int(params, 'after', 0)
+            limit   = _int(params, 'limit', PAGE_SIZE, 1, MAX_PAGE_SIZE)
+            facet   = params.get('facet', [None])[0]
+            return lambda: self.library.page(after, limit, facet)
+        if path == '/books.jsonl':
+            after   = _int(params, 'after', 0)
+            facet   = params.get('facet', [None])[0]
+            facet_clause(facet)     # reject unknown facets before the response starts
+            return 'stream', lambda: self.library.batches(after, facet)
+        if path.startswith('/books/') and len(path) > len('/books/'):
+            isbn = unquote(path[len('/books/'):])
+            return lambda: self.library.book(isbn)
+        if path == '/search':
+            query   = params.get('q', [''])[0]
+            limit   = _int(params, 'limit', PAGE_SIZE, 1, MAX_PAGE_SIZE)
+            offset  = _int(params, 'offset', 0)
+            return lambda: self.library.search(query, limit, offset)
+        if path == '/facets':
+            query = params.get('q', [None])[0]
+            return lambda: self.library.facets(query)
+        raise HTTPError(404)
+
+    async def _body(self, version, target, handler):
+        """The JSON body of a response. It is computed once per data version, also
+        when many clients ask for it at the same time."""
+        if version != self._version:
+            self._cache.clear()
+            self._version = version
+        body = self._cache.get(target)
+        if body is None:
+            body = self._cache[target] = asyncio.ensure_future(self._render(handler))
+            if len(self._cache) > CACHED:
+                self._cache.popitem(last=False)
+        else:
+            self._cache.move_to_end(target)
+        try:
+            # A client hanging up must not cancel the query for the others
+            return await asyncio.shield(body)
+        except Exception:
+            if self._cache.get(target) is body:
+                del self._cache[target]
+            raise
+
+    async def _render(self, handler):
+        return json.dumps(await self._blocking(handler)).encode()
+
+    async def handle(self, reader, writer):
+        """Serve the requests of one client connection."""
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(self._read_request(reader),
+                                                     KEEP_ALIVE)
+                except (asyncio.TimeoutError, ConnectionError,
+                        ValueError):   # a line longer than MAX_LINE
+                    return
+                if request is None:
+                    return
+                method, target, headers = request
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                try:
+                    await self._respond(writer, method, target, headers, keep_alive)
+                except HTTPError as e:
+                    self._send(writer, e.status, json.dumps({'error': str(e)}).encode(),
+                               keep_alive=keep_alive)
+                except ConnectionError:
+                    raise
+                except Exception:
+                    log_warning('{} {} failed:\n{}'.format(
+                        method, target, traceback.format_exc()))
+                    self._send(writer, 500,
+                               json.dumps({'error': REASONS[500]}).encode(),
+                               keep_alive=keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    return
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader):
+        """Read the request line and headers.
+        :return: `(method, target, headers)`, or `None` at the end of the stream."""
+        line = await reader.readline()
+        if not line:
+            return None
+        parts = line.decode('latin-1').split()
+        if len(parts) != 3:
+            raise ConnectionError('Malformed request line')
+        headers = {}
+        for _ in range(MAX_HEADERS + 1):
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        else:
+            raise ConnectionError('Too many headers')
+        return parts[0], parts[1], headers
+
+    async def _respond(self, writer, method, target, headers, keep_alive):
+        if method not in ('GET', 'HEAD'):
+            raise HTTPError(405)
+        url     = urlsplit(target)
+        handler = self._route(url.path.rstrip('/') or '/', parse_qs(url.query))
+        # Reading data_version does not touch the database file, no need for a thread
+        version = self.pool.version()
+        etag    = '"{}-{}-{}"'.format(self._instance, version,
+                                      hashlib.sha1(target.encode()).hexdigest()[:16])
+        if etag in [t.strip() for t in headers.get('if-none-match', '').split(',')]:
+            self._send(writer, 304, b'', etag=etag, keep_alive=keep_alive)
+            return
+
+        if isinstance(handler, tuple):
+            await self._stream(writer, handler[1], etag, method == 'HEAD', keep_alive)
+            return
+        body = await self._body(version, target, handler)
+        self._send(writer, 200, body, etag=etag, keep_alive=keep_alive,
+                   head=method == 'HEAD')
+
+    @staticmethod
+    def _headers(status, content_type, etag, keep_alive, extra=()):
+        lines = ['HTTP/1.1 {} {}'.format(status, REASONS[status]),
+                 'Content-Type: ' + content_type,
+                 'Connection: ' + ('keep-alive' if keep_alive else 'close')]
+        if etag:
+            lines.append('ETag: ' + etag)
+        lines.extend(extra)
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+    def _send(self, writer, status, body, etag=None, keep_alive=True, head=False):
+        writer.write(self._headers(status, 'application/json', etag, keep_alive,
+                                   ['Content-Length: {}'.format(len(body))]))
+        if not head and status != 304:
+            writer.write(body)
+
+    async def _stream(self, writer, batches, etag, head, keep_alive):
+        """Send a listing in chunks as it is read, one batch of rows at a time.
+        A failure after the headers were sent can only be reported by hanging up."""
+        writer.write(self._headers(200, 'application/x-ndjson', etag, keep_alive,
+                                   ['Transfer-Encoding: chunked']))
+        if head:
+            return
+        iterator = batches()
+        try:
+            while True:
+                books = await self._blocking(next, iterator, None)
+                if books is None:
+                    break
+                chunk = ''.join(json.dumps(b) + '\n' for b in books).encode()
+                writer.write('{:x}\r\n'.format(len(chunk)).encode() + chunk + b'\r\n')
+                await writer.drain()    # wait for slow clients before reading more
+        except ConnectionError:
+            raise
+        except Exception as e:
+            log_warning('Streaming the books failed:\n{}'.format(traceback.format_exc()))
+            raise ConnectionAbortedError(str(e)) from e
+        writer.write(b'0\r\n\r\n')
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle, host, port, limit=MAX_LINE)
+        async with server:
+            await server.serve_forever()
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.pool.close()
+
+
+def serve(path, host='127.0.0.1', port=8080, pool_size=POOL_SIZE):
+    """Serve a library until interrupted.
+    :param str path: The library database."""
+    server = Server(path, pool_size)
+    try:
+        asyncio.run(server.serve(host, port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
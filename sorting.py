@@ -0,0 +1,138 @@
+"""
+Sort orders of the book list by title, author, location or one of the flags.
+
+Every book's sort key is a tuple computed once from the keys stored in the
+database (see `migrations.add_sort_keys`), so sorting compares tuples of plain
+strings natively instead of collating titles in a callback per comparison, and a
+single edit only moves one book (see `SortKeys.update` and `SortKeys.position`).
+"""
+from bisect import bisect_left, insort
+from migrations import FOLD_FUNCTION
+from model import Book
+from sqlalchemy import func, literal_column, select
+from utils import author_sort_key, fold, title_sort_key
+
+TITLE       = 'title'
+AUTHOR      = 'author'
+LOCATION    = 'location'
+FLAGS       = ('own', 'want', 'read')
+COLUMNS     = {TITLE: 1, AUTHOR: 2, 'own': 3, 'want': 4, 'read': 5,
+               LOCATION: 6}     # see `model.Book.to_list`
+
+
+def order_by(column, descending=False):
+    """The SQL ORDER BY clauses of a sort order, e.g. while `SortKeys` are loading.
+    :return: A list of clauses, ending with the rowid as tie breaker."""
+    table   = Book.__table__
+    title   = (table.c.title_sort, False)
+    if column == TITLE:
+        keys = [title, (table.c.author_sort, False)]
+    elif column == AUTHOR:
+        keys = [(table.c.author_sort, False), title]
+    elif column == LOCATION:
+        # Folded like `SortKeys`, by the function `model.get_engine` registers
+        keys = [(func.coalesce(table.c.location, '') == '', False),
+                (getattr(func, FOLD_FUNCTION)(table.c.location), False), title]
+    else:
+        keys = [(table.c[column], True), title]
+    keys.append((literal_column('book.rowid'), False))
+    return [c.desc() if desc != descending else c.asc() for c, desc in keys]
+
+
+class SortKeys(object):
+    """The sort keys of every book for one column, keyed by rowid, and all books
+    in that order. Titles and authors sort by their stored keys, locations folded
+    with books without a location last, flags with the flagged books first; ties
+    are broken by the title and finally the rowid, so that keys are unique."""
+
+    def __init__(self, column):
+        self.column     = column
+        self._keys      = {}    # rowid -> sort key
+        self._order     = []    # all sort keys, ascending
+        self._places    = {}    # location -> folded location
+
+    def __len__(self):
+        return len(self._keys)
+
+    @classmethod
+    def from_db(cls, bind, column):
+        """Load the sort keys of all books.
+        :param bind: An SQLAlchemy engine or connection (see `Facets.from_db`).
+        :param str column: One of `COLUMNS`.
+        :return: The sort keys, ready to sort any set of books."""
+        table   = Book.__table__
+        keys    = cls(column)
+        query   = select([literal_column('book.rowid'), table.c.title_sort,
+                          table.c.author_sort, table.c[column]])
+        if column in (TITLE, AUTHOR):
+            # Read along the index, sorting the (nearly) sorted keys is then linear
+            query = query.order_by(*order_by(column))
+        make    = keys._make
+        keys._keys = {rowid: make(rowid, title or '', author or '', value)
+                      for rowid, title, author, value in bind.execute(query).fetchall()}
+        keys._order = sorted(keys._keys.values())
+        return keys
+
+    def _make(self, rowid, title, author, value):
+        if self.column == TITLE:
+            return title, author, rowid
+        if self.column == AUTHOR:
+            return author, title, rowid
+        if self.column == LOCATION:
+            place = self._places.get(value)
+            if place is None:
+                place = self._places[value] = fold(value)
+            return not value, place, title, rowid
+        return not value, title, rowid
+
+    def key(self, rowid, row):
+        """Compute the sort key of a row as returned by `model.Book.to_list`."""
+        return self._make(rowid, title_sort_key(row[COLUMNS[TITLE]]),
+                          author_sort_key(row[COLUMNS[AUTHOR]]),
+                          row[COLUMNS[self.column]])
+
+    def add(self, rowid, row):
+        """Add a book, replacing it if the rowid is already known.
+        :return: `True` if the book's key changed."""
+        key = self.key(rowid, row)
+        old = self._keys.get(rowid)
+        if old == key:
+            return False
+        if old is not None:
+            del self._order[bisect_left(self._order, old)]
+        self._keys[rowid] = key
+        insort(self._order, key)
+        return True
+
+    update = add
+
+    def remove(self, rowid):
+        """Remove a book, unknown rowids are ignored."""
+        key = self._keys.pop(rowid, None)
+        if key is not None:
+            del self._order[bisect_left(self._order, key)]
+
+    def sort(self, rowids=None, descending=False):
+        """Sort books.
+        :param rowids: The rowids to sort, `None` for all books.
+        :return: A new list of rowids."""
+        if rowids is None:
+            rowids = [key[-1] for key in self._order]
+            if descending:
+                rowids.reverse()
+            return rowids
+        return sorted(rowids, key=self._keys.__getitem__, reverse=descending)
+
+    def position(self, rowids, rowid, descending=False):
+        """Find where a book belongs in a sorted list of rowids without it.
+        :return: The index to insert the book at."""
+        key         = self._keys[rowid]
+        lo, hi      = 0, len(rowids)
+        while lo < hi:
+            mid     = (lo + hi) // 2
+            other   = self._keys[rowids[mid]]
+            if (other > key) if descending else (other < key):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
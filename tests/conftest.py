@@ -0,0 +1,15 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def db(tmp_path):
+    """A session on an empty library."""
+    import model
+    session = model.get_db(str(tmp_path / 'library.sqlite'))
+    yield session
+    session.close()
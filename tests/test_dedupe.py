@@ -0,0 +1,21 @@
+from dedupe import Candidate, Record, group
+
+
+def test_group_needs_every_member_to_match():
+    a = Record(1, '', 'J.R.R. Tolkien', 'The Hobbit')
+    b = Record(2, '', 'J.R.R. Tolkien', 'The Hobbit or There and Back Again')
+    c = Record(3, '', 'Joanne Rowling', 'Harry Potter')
+    groups = group([Candidate(a, b, 0.95), Candidate(b, c, 0.9)])
+    assert [[r.key for r in g] for g in groups] == [[1, 2]]
+
+
+def test_group_drops_groups_above_the_size_limit():
+    records = [Record(i, '', 'J.R.R. Tolkien', 'The Hobbit') for i in range(4)]
+    candidates = [Candidate(a, b, 1.0) for a in records for b in records
+                  if a.key < b.key]
+    assert len(group(candidates)) == 1
+    assert group(candidates, max_size=3) == []
+
+
+def test_initials_only_come_from_names():
+    assert Record(1, '', 'Tolkien 1937', 'The Hobbit').signature == 'tolkien '
@@ -0,0 +1,24 @@
+import instrument
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+
+
+@pytest.fixture
+def enabled():
+    instrument.reset()
+    instrument.enable()
+    yield
+    instrument.disable()
+    instrument.reset()
+
+
+def test_failed_statements_leave_no_start_behind(enabled):
+    engine = create_engine('sqlite://')
+    with engine.connect() as conn:
+        with pytest.raises(OperationalError):
+            conn.execute('SELECT * FROM missing')
+        assert not conn.info.get('instrument_start')
+        conn.execute('SELECT 1')
+        assert not conn.info.get('instrument_start')
+    assert instrument.stats()['sql.select']['count'] == 1
@@ -0,0 +1,62 @@
+from model import (Book, BookCache, delete_book, existing_isbns, insert_books,
+                   save_books)
+from sqlalchemy import text
+
+
+def _add(db, isbn, location):
+    db.add(Book(isbn=isbn, title='The Hobbit', author='J.R.R. Tolkien',
+                location=location))
+    db.commit()
+
+
+def test_book_cache_keeps_editions_apart(db):
+    _add(db, '9780261103344', 'Shelf')
+    _add(db, '9780547928227', 'Attic')
+    cache = BookCache(db)
+    first = cache.fetch('9780261103344', 'J.R.R. Tolkien', 'The Hobbit')
+    second = cache.fetch('9780547928227', 'J.R.R. Tolkien', 'The Hobbit')
+    assert (first.isbn, first.location) == ('9780261103344', 'Shelf')
+    assert (second.isbn, second.location) == ('9780547928227', 'Attic')
+
+
+def test_book_cache_finds_books_without_isbn_by_author_and_title(db):
+    _add(db, '', 'Shelf')
+    cache = BookCache(db)
+    assert cache.fetch('', 'J. R. R. Tolkien', 'the hobbit').location == 'Shelf'
+
+
+def _row(isbn):
+    return {'isbn': isbn, 'title': 'The Hobbit', 'author': 'J.R.R. Tolkien',
+            'own': True, 'want': False, 'read': False, 'location': None}
+
+
+def test_insert_books_treats_isbn10_and_isbn13_as_duplicates(db):
+    _add(db, '0261103342', 'Shelf')
+    with db.get_bind().begin() as conn:
+        assert insert_books(conn, [_row('9780261103344')]) == (0, 1)
+        assert insert_books(conn, [_row('9780547928227'), _row('054792822X')],
+                            existing_isbns(conn)) == (1, 1)
+
+
+def _rowid(db, isbn):
+    return db.execute(text('SELECT id FROM book WHERE isbn = :isbn'),
+                      {'isbn': isbn}).scalar()
+
+
+def test_save_books_rejects_deleted_books_and_taken_isbns(db):
+    _add(db, '9780261103344', 'Shelf')
+    _add(db, '9780547928227', 'Attic')
+    first, second = _rowid(db, '9780261103344'), _rowid(db, '9780547928227')
+    delete_book(db, second)
+    renamed = ['9780007525492', 'The Hobbit', 'J.R.R. Tolkien', True, False, False,
+               'Desk']
+    rejected = {}
+    assert save_books(db, {first: renamed, second: renamed}, rejected=rejected) == 1
+    assert rejected == {second: renamed}
+    assert db.query(Book).get('9780007525492').location == 'Desk'
+
+    _add(db, '9780261103344', 'Shelf')
+    taken = ['9780261103344'] + renamed[1:]
+    rejected = {}
+    assert save_books(db, {first: taken}, rejected=rejected) == 0
+    assert rejected == {first: taken}
@@ -0,0 +1,47 @@
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+from cache import ResponseCache
+from exc import ProviderError
+from provider import Identifier, OpenLibrary, create_session
+
+
+class _Handler(BaseHTTPRequestHandler):
+    status  = 200
+    body    = b'{}'
+
+    def do_GET(self):
+        self.send_response(self.status)
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = HTTPServer(('127.0.0.1', 0), _Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.mark.parametrize('status, body', [(503, b'{}'),
+                                          (200, b'<html>Maintenance</html>')])
+def test_failed_search_is_a_provider_error(server, tmp_path, status, body):
+    _Handler.status, _Handler.body = status, body
+    cache = ResponseCache(str(tmp_path / 'cache.sqlite'))
+    ol = OpenLibrary('http://127.0.0.1:{}/'.format(server.server_port), cache=cache,
+                     session=create_session(retries=0))
+    with pytest.raises(ProviderError):
+        ol.query_search('hobbit', Identifier.TITLE)
+    stream = ol.query_pages('hobbit', Identifier.TITLE)
+    with pytest.raises(ProviderError):
+        stream.next_page()
+    assert len(cache._conn.execute('SELECT key FROM response').fetchall()) == 0
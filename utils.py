@@ -1,24 +1,80 @@
-import click
+import re
 import sys
+import unicodedata
 from pathlib import Path
 
 
 def log_error(msg):
     """Logs an error and exits."""
+    import click
     click.secho(msg, err=True, fg='red')
     sys.exit(1)
 
 
+def log_warning(msg):
+    """Logs a warning without exiting."""
+    import click
+    click.secho(msg, err=True, fg='yellow')
+
+
 def read_config_file():
-    """Reads the config file at ~/.libraryrc"""
+    """Reads the config file at ~/.libraryrc
+    Each line holds a `key = value` pair, `db_path` is required."""
+    config = {'search_engine': 'auto', 'cache_dir': '~/.cache/minerva',
+              'instrument': 'off', 'trace_path': '', 'providers': 'openlibrary',
+              'search_budget': '3', 'catalog_path': '~/.cache/minerva/catalog.sqlite',
+              'enrich': 'off'}
     try:
-        f = open('{}/.libraryrc'.format(Path.home()), 'r')
-        # We only have one config option, the path to the database
-        db_path = f.readline().split("=")[1].strip()
-        # Replace '~' with the path to the home directory
-        if db_path.startswith('~'):
-            db_path = '{}{}'.format(Path.home(), db_path.lstrip('~'))
-        f.close()
-        return {'db_path': db_path}
+        with open('{}/.libraryrc'.format(Path.home()), 'r') as f:
+            for line in f:
+                if '=' not in line:
+                    continue
+                key, value = line.split('=', 1)
+                config[key.strip()] = value.strip()
     except IOError as e:
         log_error(e)
+
+    if 'db_path' not in config:
+        log_error('db_path is not set in ~/.libraryrc')
+    # Replace '~' with the path to the home directory
+    if config['db_path'].startswith('~'):
+        config['db_path'] = '{}{}'.format(Path.home(), config['db_path'].lstrip('~'))
+    return config
+
+
+def config_flag(value):
+    """Interpret a config value like 'on', 'yes' or '1' as a boolean."""
+    return value.strip().lower() in ('1', 'on', 'true', 'yes')
+
+
+def fold(text):
+    """Normalize text for comparisons: strips accents and punctuation, ignores case
+    and collapses whitespace (e.g. 'Tolkien, J.R.R.' -> 'tolkien j r r')."""
+    if not text:
+        return ''
+    text = unicodedata.normalize('NFKD', text)
+    text = ''.join(c for c in text if not unicodedata.combining(c)).casefold()
+    return ' '.join(w for w in re.split(r'[\W_]+', text) if w)
+
+
+# Leading words ignored when sorting titles ('The Hobbit' sorts under 'hobbit')
+ARTICLES = frozenset(('the', 'a', 'an', 'der', 'die', 'das', 'ein', 'eine', 'le', 'la',
+                      'les', 'l', 'un', 'une', 'el', 'los', 'las', 'il', 'lo', 'gli'))
+
+
+def title_sort_key(title):
+    """The key a title sorts by: folded (see `fold`) without a leading article,
+    e.g. 'The Hobbit' -> 'hobbit' and "L'Étranger" -> 'etranger'."""
+    words = fold(title).split(' ')
+    if len(words) > 1 and words[0] in ARTICLES:
+        del words[0]
+    return ' '.join(words)
+
+
+def author_sort_key(author):
+    """The key an author sorts by: folded with the surname first, e.g.
+    'J. R. R. Tolkien' and 'Tolkien, J.R.R.' -> 'tolkien j r r'."""
+    if not author or ',' in author:
+        return fold(author)
+    words = fold(author).split(' ')
+    return ' '.join(words[-1:] + words[:-1])